@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of scan, hash, transfer and remote run
+
+Generates synthetic trees, starts 'bo server' on loopback and measures
+BoFilesCache.rescan_files, BoFilesCache.resave_cache, BoSocketClient.run_sync
+and BoSocketClient.run_command on the same steps for every tree:
+ - initial: the first scan and full sync
+ - noop: nothing is changed
+ - modify: part of files is changed
+ - rename: part of files is renamed (moved)
+ - delete: half of files is removed
+
+With --clients=<N> it measures concurrent sessions instead: N clients sync their
+own small trees and run a command at once, while --idle=<M> more connections
+stay open without requests; peak threads and peak RSS of server are reported
+(linux only), so threaded and async (--server-args="--async") servers can be
+compared.
+
+Usage:
+    python3 benchmarks/bench.py [--scale=<k>] [--shapes=tiny,huge,deep]
+        [--latency=<ms>] [--server-args="--async ..."] [--output=<file>]
+        [--baseline=<file>] [--tolerance=<ratio>] [--clients=<N> [--idle=<M>]]
+
+Results are printed as JSON (or written to --output). With --baseline every
+result is compared with result of the same name, exit status is 1 if some of them
+is slower than baseline more than tolerance (default 0.2, i.e. 20%).
+"""
+
+import contextlib
+import json
+import os
+import queue
+import random
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from startup import BO_PY, free_port, wait_for
+
+sys.path.insert(0, os.path.dirname(BO_PY))
+import bo  # noqa: E402  pylint: disable=wrong-import-position,import-error
+
+SEED = 4319
+COMMAND_RUNS = 20
+COMMAND_OUTPUT_SIZE = 64 * 1024 * 1024
+# tree of every concurrent client
+CLIENT_FILES = 20
+CLIENT_FILE_SIZE = 4096
+# results faster than this are too noisy for comparison with baseline
+COMPARE_MIN_SECONDS = 0.05
+
+
+class TreeGenerator:
+    """ synthetic trees, content is reproducible by seed """
+
+    def __init__(self, _root, _scale):
+        self.__root = _root
+        self.__scale = _scale
+        self.__random = random.Random(SEED)
+
+    def __data(self, _size, _compressible=0.5):
+        """ part of data is random, the rest is repeated text """
+        _random_size = int(_size * (1 - _compressible))
+        _data = self.__random.getrandbits(_random_size * 8).to_bytes(_random_size, "little")
+        _text = b"bo benchmark line of text\n"
+        return _data + (_text * ((_size - _random_size) // len(_text) + 1))[:_size - _random_size]
+
+    def write(self, _path, _size):
+        """ write file of size """
+        _fullpath = os.path.join(self.__root, _path)
+        os.makedirs(os.path.dirname(_fullpath), exist_ok=True)
+        with open(_fullpath, "wb") as _file:
+            _file.write(self.__data(_size))
+
+    def generate(self, _shape):
+        """ create tree of shape: tiny, huge or deep """
+        if _shape == "tiny":
+            # many tiny files
+            for _num in range(int(5000 * self.__scale)):
+                self.write(os.path.join("d" + str(_num % 50), "f" + str(_num) + ".txt"),
+                           self.__random.randint(16, 1024))
+        elif _shape == "huge":
+            # few huge files
+            for _num in range(3):
+                self.write("huge" + str(_num) + ".bin", int(32 * 1024 * 1024 * self.__scale))
+        elif _shape == "deep":
+            # deep nesting, files on every level
+            _dir = ""
+            for _level in range(int(40 * self.__scale) or 1):
+                _dir = os.path.join(_dir, "level" + str(_level))
+                for _num in range(20):
+                    self.write(os.path.join(_dir, "f" + str(_num) + ".c"),
+                               self.__random.randint(1024, 16 * 1024))
+        else:
+            raise ValueError("Unknown shape '" + _shape + "'")
+
+    def files(self):
+        """ relative paths of all files, sorted """
+        _files = []
+        for _dirpath, _, _filenames in os.walk(self.__root):
+            for _name in _filenames:
+                _files.append(os.path.relpath(os.path.join(_dirpath, _name), self.__root))
+        return sorted(_files)
+
+    def modify(self, _ratio):
+        """ change part of files (at least one), huge files are changed in the middle """
+        for _path in self.__sample(_ratio):
+            _fullpath = os.path.join(self.__root, _path)
+            with open(_fullpath, "r+b") as _file:
+                _file.seek(os.path.getsize(_fullpath) // 2)
+                _file.write(self.__data(4096, 0))
+
+    def rename(self, _ratio):
+        """ rename part of files (at least one) """
+        for _path in self.__sample(_ratio):
+            _fullpath = os.path.join(self.__root, _path)
+            os.rename(_fullpath, _fullpath + ".renamed")
+
+    def delete(self, _ratio):
+        """ remove part of files (at least one) """
+        for _path in self.__sample(_ratio):
+            os.remove(os.path.join(self.__root, _path))
+
+    def __sample(self, _ratio):
+        _files = self.files()
+        return self.__random.sample(_files, max(1, int(len(_files) * _ratio)))
+
+
+class LatencyProxy:  # pylint: disable=too-few-public-methods
+    """ tcp proxy which delays data in both directions, like slow network """
+
+    def __init__(self, _target_port, _delay):
+        self.__target = ("127.0.0.1", _target_port)
+        self.__delay = _delay
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__sock.bind(("127.0.0.1", 0))
+        self.__sock.listen(16)
+        threading.Thread(target=self.__accept, daemon=True).start()
+
+    def get_port(self):
+        """ port for clients """
+        return self.__sock.getsockname()[1]
+
+    def __accept(self):
+        while True:
+            _client, _ = self.__sock.accept()
+            _server = socket.create_connection(self.__target)
+            for _src, _dst in ((_client, _server), (_server, _client)):
+                _chunks = queue.Queue()
+                threading.Thread(target=self.__read, args=(_src, _chunks), daemon=True).start()
+                threading.Thread(target=self.__write, args=(_dst, _chunks), daemon=True).start()
+
+    @staticmethod
+    def __read(_sock, _chunks):
+        """ read chunks with time of their arrival """
+        while True:
+            try:
+                _data = _sock.recv(bo.BUF_READ_SIZE)
+            except OSError:
+                _data = b""
+            _chunks.put((time.monotonic(), _data))
+            if not _data:
+                return
+
+    def __write(self, _sock, _chunks):
+        """ send every chunk after delay since its arrival """
+        while True:
+            _arrived, _data = _chunks.get()
+            _wait = _arrived + self.__delay - time.monotonic()
+            if _wait > 0:
+                time.sleep(_wait)
+            try:
+                if not _data:
+                    _sock.shutdown(socket.SHUT_WR)
+                    return
+                _sock.sendall(_data)
+            except OSError:
+                return
+
+
+class Bench:
+    """ loopback server and results of measures """
+
+    def __init__(self, _root, _server_args):
+        self.__root = _root
+        self.__port = free_port()
+        self.__results = {}
+        _home = os.path.join(_root, "server-home")
+        os.makedirs(_home)
+        self.__server = subprocess.Popen(  # pylint: disable=consider-using-with
+            [sys.executable, BO_PY, "server", "--host=127.0.0.1", "--port=" + str(self.__port)]
+            + _server_args,
+            cwd=_home, env=dict(os.environ, HOME=_home),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+        def _is_listening():
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as _sock:
+                return _sock.connect_ex(("127.0.0.1", self.__port)) == 0
+        wait_for(_is_listening)
+
+    def get_port(self):
+        """ port of server """
+        return self.__port
+
+    def get_results(self):
+        """ name -> measure """
+        return self.__results
+
+    def measure(self, _name, _func, _files=0, _bytes=0):
+        """ run func, keep time and throughput """
+        _start = time.perf_counter()
+        _func()
+        _seconds = time.perf_counter() - _start
+        self.__results[_name] = {"seconds": round(_seconds, 4), "files": _files, "bytes": _bytes}
+        if _seconds > 0:
+            self.__results[_name]["files_per_sec"] = round(_files / _seconds, 1)
+            self.__results[_name]["mb_per_sec"] = round(_bytes / _seconds / 1024 / 1024, 2)
+
+    def sync_steps(self, _shape, _scale, _port):
+        """ scan and sync tree of shape after every step of changes """
+        _workdir = os.path.join(self.__root, _shape)
+        _target_dir = os.path.join(self.__root, _shape + "-target")
+        os.makedirs(_target_dir)
+        _tree = TreeGenerator(_workdir, _scale)
+        _tree.generate(_shape)
+        _files = bo.BoFilesCache(os.path.join(self.__root, _shape + "-cache.yml"))
+        _client = bo.BoSocketClient({
+            "workdir": _workdir,
+            "target_dir": _target_dir,
+            "server_host": "127.0.0.1",
+            "server_port": _port,
+        })
+        _steps = [
+            ("initial", None),
+            ("noop", None),
+            ("modify", lambda: _tree.modify(0.01)),
+            ("rename", lambda: _tree.rename(0.1)),
+            ("delete", lambda: _tree.delete(0.5)),
+        ]
+        for _step, _change in _steps:
+            if _change is not None:
+                _change()
+            _name = _shape + "." + _step + "."
+            _count = len(_tree.files())
+            self.measure(_name + "rescan_files", lambda: _files.rescan_files(_workdir), _count)
+            _to_update = _files.get_files_to_update()
+            _size = sum(
+                _info["size"] for _info in _to_update.values()
+                if _info["required_sync"] == "UPDATE"
+            )
+            self.measure(_name + "resave_cache", _files.resave_cache, len(_to_update))
+            self.measure(_name + "run_sync", lambda: _client.run_sync(_files),
+                         len(_to_update), _size)
+
+    def run_command_steps(self, _port):
+        """ latency of short command and throughput of command output """
+        _client = bo.BoSocketClient({
+            "target_dir": self.__root,
+            "server_host": "127.0.0.1",
+            "server_port": _port,
+        })
+
+        def _run(_command):
+            if _client.run_command("", [_command]) != 0:
+                raise RuntimeError("Command '" + _command + "' failed")
+
+        _latencies = []
+        for _ in range(COMMAND_RUNS):
+            _start = time.perf_counter()
+            _run("true")
+            _latencies.append(time.perf_counter() - _start)
+        _latencies.sort()
+        self.__results["run_command.latency"] = {
+            "seconds": round(statistics.median(_latencies), 4),
+            "p95_seconds": round(_latencies[int(len(_latencies) * 0.95) - 1], 4),
+            "runs": COMMAND_RUNS,
+        }
+        self.measure(
+            "run_command.output",
+            lambda: _run("head -c " + str(COMMAND_OUTPUT_SIZE) + " /dev/zero"),
+            0, COMMAND_OUTPUT_SIZE
+        )
+
+    def clients_steps(self, _port, _clients, _idle):
+        """ concurrent clients: sync of own tree and run of command by every client """
+        _sessions = []
+        for _num in range(_clients):
+            _tree = TreeGenerator(os.path.join(self.__root, "client" + str(_num)), 1)
+            for _file in range(CLIENT_FILES):
+                _tree.write(os.path.join("src", str(_file) + ".c"), CLIENT_FILE_SIZE)
+            _sessions.append(ClientSession(self.__root, "client" + str(_num), _port))
+        _idle_socks = []
+        for _ in range(_idle):
+            _sock = socket.create_connection(("127.0.0.1", _port))
+            # server sends banner and waits for the first command
+            _sock.recv(1024)
+            _idle_socks.append(_sock)
+        _sampler = ServerSampler(self.__server.pid)
+        _start_barrier = threading.Barrier(_clients + 1)
+        _threads = [
+            threading.Thread(target=_session.run, args=(_start_barrier,))
+            for _session in _sessions
+        ]
+        for _thread in _threads:
+            _thread.start()
+        _start_barrier.wait()
+        _start = time.perf_counter()
+        for _thread in _threads:
+            _thread.join()
+        _seconds = time.perf_counter() - _start
+        _sampler.stop()
+        _peak = _sampler.get_peak()
+        for _sock in _idle_socks:
+            _sock.close()
+        _latencies = sorted(_session.get_seconds() for _session in _sessions)
+        self.__results["clients.sync_and_run"] = {
+            "seconds": round(_seconds, 4),
+            "clients": _clients,
+            "idle": _idle,
+            "failed": sum(1 for _session in _sessions if not _session.is_ok()),
+            "median_client_seconds": round(statistics.median(_latencies), 4),
+            "p95_client_seconds": round(_latencies[max(0, int(len(_latencies) * 0.95) - 1)], 4),
+            "peak_threads": _peak["threads"],
+            "peak_rss_mb": _peak["rss_mb"],
+        }
+
+    def stop(self):
+        """ stop server """
+        self.__server.terminate()
+        self.__server.wait()
+
+
+class ClientSession:
+    """ one of concurrent clients: sync of own tree, then short command """
+
+    def __init__(self, _root, _name, _port):
+        self.__workdir = os.path.join(_root, _name)
+        self.__target_dir = os.path.join(_root, _name + "-target")
+        os.makedirs(self.__target_dir)
+        self.__files = bo.BoFilesCache(os.path.join(_root, _name + "-cache.yml"))
+        self.__client = bo.BoSocketClient({
+            "workdir": self.__workdir,
+            "target_dir": self.__target_dir,
+            "server_host": "127.0.0.1",
+            "server_port": _port,
+        })
+        self.__seconds = 0.0
+        self.__ok = False
+
+    def run(self, _start_barrier):
+        """ wait for other clients and run session """
+        self.__files.rescan_files(self.__workdir)
+        self.__files.resave_cache()
+        _start_barrier.wait()
+        _start = time.perf_counter()
+        try:
+            self.__client.run_sync(self.__files)
+            self.__ok = self.__client.run_command("", ["true"]) == 0
+        except (SystemExit, Exception):  # pylint: disable=broad-except
+            # fatal() already printed the reason
+            self.__ok = False
+        self.__seconds = time.perf_counter() - _start
+
+    def get_seconds(self):
+        """ time of session """
+        return self.__seconds
+
+    def is_ok(self):
+        """ sync and command are done """
+        return self.__ok
+
+
+class ServerSampler:
+    """ peak count of threads and peak RSS of server process (linux /proc) """
+
+    def __init__(self, _pid):
+        self.__path = "/proc/" + str(_pid) + "/status"
+        self.__peak = {"threads": None, "rss_mb": None}
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__sample, daemon=True)
+        if os.path.isfile(self.__path):
+            self.__thread.start()
+
+    def __read(self):
+        """ Threads and VmHWM (peak resident size) of status """
+        _values = {}
+        try:
+            with open(self.__path, encoding="utf-8") as _file:
+                for _line in _file:
+                    _name, _, _value = _line.partition(":")
+                    _values[_name] = _value.split()
+        except OSError:
+            return
+        if "Threads" in _values:
+            self.__peak["threads"] = max(self.__peak["threads"] or 0, int(_values["Threads"][0]))
+        if "VmHWM" in _values:
+            self.__peak["rss_mb"] = round(int(_values["VmHWM"][0]) / 1024, 1)
+
+    def __sample(self):
+        while not self.__stopped.wait(0.01):
+            self.__read()
+
+    def stop(self):
+        """ stop sampling """
+        self.__stopped.set()
+        if self.__thread.is_alive():
+            self.__thread.join()
+            self.__read()
+
+    def get_peak(self):
+        """ peak values, None if they are not known """
+        return self.__peak
+
+
+def compare(_results, _baseline, _tolerance):
+    """ print comparison with baseline, return names of regressions """
+    _regressions = []
+    for _name, _result in _results.items():
+        if _name not in _baseline or _baseline[_name]["seconds"] <= 0:
+            continue
+        _was = _baseline[_name]["seconds"]
+        _ratio = _result["seconds"] / _was
+        _mark = ""
+        if _ratio > 1 + _tolerance and max(_was, _result["seconds"]) >= COMPARE_MIN_SECONDS:
+            _mark = "  REGRESSION"
+            _regressions.append(_name)
+        print(
+            _name.ljust(32) + " " + str(_was).rjust(9) + " -> " +
+            str(_result["seconds"]).rjust(9) + " sec  x" + str(round(_ratio, 2)) + _mark,
+            file=sys.stderr
+        )
+    return _regressions
+
+
+def main():
+    """ run benchmarks, write results and compare with baseline """
+    _options = dict(_arg[2:].partition("=")[::2] for _arg in sys.argv[1:])
+    _scale = float(_options.get("scale", 1))
+    _shapes = _options.get("shapes", "tiny,huge,deep").split(",")
+    _latency = float(_options.get("latency", 0)) / 1000
+    _results = {}
+    with tempfile.TemporaryDirectory() as _root, open(os.devnull, "w",
+                                                      encoding="utf-8") as _devnull:
+        _bench = Bench(_root, shlex.split(_options.get("server-args", "")))
+        try:
+            _port = _bench.get_port()
+            if _latency > 0:
+                _port = LatencyProxy(_port, _latency).get_port()
+            # output of bo is not measured
+            with contextlib.redirect_stdout(_devnull):
+                if "clients" in _options:
+                    _bench.clients_steps(
+                        _port, int(_options["clients"]), int(_options.get("idle", 0))
+                    )
+                else:
+                    for _shape in _shapes:
+                        _bench.sync_steps(_shape, _scale, _port)
+                    _bench.run_command_steps(_port)
+        finally:
+            _bench.stop()
+        _results = _bench.get_results()
+    _report = {
+        "meta": {
+            "python": sys.version.split()[0],
+            "platform": sys.platform,
+            "cpus": os.cpu_count(),
+            "scale": _scale,
+            "latency_ms": _latency * 1000,
+            "server_args": _options.get("server-args", ""),
+            "clients": int(_options.get("clients", 0)),
+            "idle": int(_options.get("idle", 0)),
+        },
+        "results": _results,
+    }
+    if "output" in _options:
+        with open(_options["output"], "w", encoding="utf-8") as _file:
+            json.dump(_report, _file, indent=2)
+    else:
+        print(json.dumps(_report, indent=2))
+    if "baseline" in _options:
+        with open(_options["baseline"], encoding="utf-8") as _file:
+            _baseline = json.load(_file)
+        _regressions = compare(
+            _results, _baseline["results"], float(_options.get("tolerance", 0.2))
+        )
+        if _regressions:
+            print("Slower than baseline: " + ", ".join(_regressions), file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Startup time of bo commands
+
+Runs every command several times in a temporary home directory with loopback server
+and prints median wall time in ms as JSON. Two ways to start bo are measured:
+ - script: 'python3 bo.py ...' (bo.py is compiled on every start)
+ - module: launcher which imports bo, so bytecode of bo.py is cached
+
+Usage:
+    python3 benchmarks/startup.py [--runs=<n>] [--target=<ms>]
+
+Exit status is 1 if warm 'bo remote run' via launcher and agent is slower than target.
+"""
+
+import json
+import os
+import py_compile
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BO_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bo.py")
+DEFAULT_RUNS = 15
+DEFAULT_TARGET_MS = 50
+
+
+def free_port():
+    """ free tcp port on loopback """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as _sock:
+        _sock.bind(("127.0.0.1", 0))
+        return _sock.getsockname()[1]
+
+
+def wait_for(_check, _timeout=10.0):
+    """ wait until check() is true """
+    _deadline = time.time() + _timeout
+    while not _check():
+        if time.time() > _deadline:
+            raise TimeoutError("bo did not start in time")
+        time.sleep(0.05)
+
+
+class StartupBench:  # pylint: disable=too-many-instance-attributes
+    """ temporary home, workdir and server for measuring of bo commands """
+
+    def __init__(self, _root):
+        self.__root = _root
+        self.__home = os.path.join(_root, "home")
+        self.__workdir = os.path.join(_root, "workdir")
+        self.__target_dir = os.path.join(_root, "target")
+        self.__module_dir = os.path.join(_root, "module")
+        self.__procs = []
+        self.__port = free_port()
+        self.__env = dict(os.environ, HOME=self.__home)
+        self.__env.pop("PYTHONDONTWRITEBYTECODE", None)
+        for _dir in (self.__home, self.__workdir, self.__target_dir, self.__module_dir):
+            os.makedirs(_dir)
+        # bytecode of module is compiled once, like after install by launcher
+        shutil.copyfile(BO_PY, os.path.join(self.__module_dir, "bo.py"))
+        py_compile.compile(os.path.join(self.__module_dir, "bo.py"), doraise=True)
+
+    def command(self, _mode, _args):
+        """ command line which starts bo """
+        if _mode == "script":
+            return [sys.executable, BO_PY] + _args
+        return [
+            sys.executable, "-c",
+            "import sys; sys.path.insert(0, " + repr(self.__module_dir) + "); "
+            "import bo; sys.exit(bo.main())",
+        ] + _args
+
+    def start(self, _args):
+        """ start long running bo command """
+        _proc = subprocess.Popen(  # pylint: disable=consider-using-with
+            self.command("module", _args), cwd=self.__root, env=self.__env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        self.__procs.append(_proc)
+        return _proc
+
+    def setup(self):
+        """ start server and write config of workdir (yaml is superset of json) """
+        self.start(["server", "--host=127.0.0.1", "--port=" + str(self.__port)])
+        os.makedirs(os.path.join(self.__home, ".bo-by-sea5kg"))
+        with open(os.path.join(self.__home, ".bo-by-sea5kg", "config.yml"), "w",
+                  encoding="utf-8") as _file:
+            json.dump({"bo_version": "", "workdirs": {self.__workdir: {"servers": {"base": {
+                "host": "127.0.0.1",
+                "port": self.__port,
+                "target_dir": self.__target_dir,
+                "cache_path": os.path.join(self.__root, "cache.yml"),
+            }}}}}, _file)
+
+        def _is_listening():
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as _sock:
+                return _sock.connect_ex(("127.0.0.1", self.__port)) == 0
+        wait_for(_is_listening)
+        self.run("script", ["sync", "--no-agent"])
+
+    def start_agent(self):
+        """ start 'bo agent' and wait for its socket """
+        self.start(["agent"])
+        wait_for(lambda: os.path.exists(
+            os.path.join(self.__home, ".bo-by-sea5kg", "agent.sock")
+        ))
+
+    def run(self, _mode, _args):
+        """ run bo command, return wall time in seconds """
+        _start = time.perf_counter()
+        subprocess.run(
+            self.command(_mode, _args), cwd=self.__workdir, env=self.__env, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        return time.perf_counter() - _start
+
+    def measure(self, _mode, _args, _runs):
+        """ median wall time of command in ms, the first (cold) run is not counted """
+        self.run(_mode, _args)
+        return round(statistics.median(self.run(_mode, _args) for _ in range(_runs)) * 1000, 1)
+
+    def stop(self):
+        """ stop server and agent """
+        for _proc in self.__procs:
+            _proc.terminate()
+            _proc.wait()
+
+
+def main():
+    """ measure startup of commands and compare with target """
+    _options = dict(_arg[2:].partition("=")[::2] for _arg in sys.argv[1:])
+    _runs = int(_options.get("runs", DEFAULT_RUNS))
+    _target = float(_options.get("target", DEFAULT_TARGET_MS))
+    _commands = {
+        "help": ["help"],
+        "config path": ["config", "path"],
+        "remote run": ["remote", "--no-agent", "run", "true"],
+    }
+    _results = {"python": sys.version.split()[0], "runs": _runs, "target_ms": _target}
+    with tempfile.TemporaryDirectory() as _root:
+        _bench = StartupBench(_root)
+        try:
+            _bench.setup()
+            _empty = [sys.executable, "-c", "pass"]
+            _start = time.perf_counter()
+            for _ in range(_runs):
+                subprocess.run(_empty, check=True)
+            _results["python -c pass"] = round((time.perf_counter() - _start) * 1000 / _runs, 1)
+            for _mode in ("script", "module"):
+                for _name, _args in _commands.items():
+                    _results[_mode + ": " + _name] = _bench.measure(_mode, _args, _runs)
+            _bench.start_agent()
+            for _mode in ("script", "module"):
+                _results[_mode + ": remote run (agent)"] = _bench.measure(
+                    _mode, ["remote", "run", "true"], _runs
+                )
+        finally:
+            _bench.stop()
+    print(json.dumps(_results, indent=2))
+    return 0 if _results["module: remote run (agent)"] <= _target else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -26,143 +26,1202 @@ Original repository: https://github.com/sea5kg/bo
 
 """
 
+# pylint: disable=too-many-lines
+
 import os
 import sys
 import time
 import socket
 import re
-import platform
 import json
-import subprocess
+import signal
 import threading
 import errno
+import select
+import stat
 import hashlib
-from pathlib import Path
-import yaml
+import io
+import math
+import mmap
+import zlib
+import struct
+import bisect
+import collections
+import queue
+# modules which are slow to import (yaml, asyncio, sqlite3, subprocess, concurrent.futures,
+# lzma, bz2, ctypes, shutil) are imported by functions which use them, so each subcommand
+# loads only what it needs
 
 BUF_READ_SIZE = 65536
-SEND_BUFFER_SIZE = 512
+HASH_CHUNK_SIZE = 64
+HASH_ALGOS = ["md5", "sha1", "sha256", "blake2b", "blake2s"]
+SEND_BUFFER_SIZE = 65536
+RECV_BUFFER_MIN_SIZE = 256 * 1024
+RECV_BUFFER_MAX_SIZE = 8 * 1024 * 1024
 
 VERSION = "v0.0.2"
 
-print(
-    "Welcom to bo (" + VERSION + ")!\n"
-    "Utilite for sync files (like rsync) and "
-    "run build on remote server (or Virtual Machine in local network)\n"
-)
+# protocol 1: raw text messages in lock-step
+# protocol 2: frames [type: 1 byte][length: 4 bytes][payload]
+PROTOCOL_VERSION = 2
+FRAME_HEADER = struct.Struct("!BI")
+FRAME_MAX_SIZE = 1 << 30
+FRAME_DATA_MAX_SIZE = 16 * 1024 * 1024
+FRAME_TEXT = 1
+FRAME_DATA = 2
+FRAME_DATA_END = 3
+FRAME_DELTA_COPY = 4
+FRAME_OUTPUT = 5
+FRAME_EXIT = 6
+
+# output of remote command is read by chunks and queued up to limit
+OUTPUT_CHUNK_SIZE = 65536
+OUTPUT_QUEUE_CHUNKS = 128
+OUTPUT_FRAME_MAX_SIZE = 1024 * 1024
+EXIT_STATUS = struct.Struct("!i")
+
+# command stacks: steps run in parallel when their needs are done,
+# output and exit status of each step are sent with index of step
+FRAME_STEP_OUTPUT = 7
+FRAME_STEP_EXIT = 8
+STEP_ID = struct.Struct("!H")
+STEP_EXIT_STATUS = struct.Struct("!Hi")
+STACK_MAX_STEPS = 1024
+STACK_MAX_PARALLEL = min(32, (os.cpu_count() or 1) * 4)
+# seconds for cancelled step to exit after SIGTERM before SIGKILL
+STACK_STOP_TIMEOUT = 5.0
+
+# server
+SERVER_PORT = 4319
+SERVER_MAX_CONNECTIONS = 256
+SERVER_MAX_JOBS = min(32, (os.cpu_count() or 1) * 4)
+# client which does not read or write so long is disconnected by async server
+SERVER_CLIENT_TIMEOUT = 120
+# default size of cache of remote command results (server option --result-cache)
+RESULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+# delta transfer (like rsync) for big modified files
+DELTA_MIN_SIZE = 1024 * 1024
+DELTA_BLOCK_MIN_SIZE = 2048
+DELTA_BLOCK_MAX_SIZE = 128 * 1024
+DELTA_MAX_ROLLING = 4 * 1024 * 1024
+DELTA_COPY = struct.Struct("!II")
+
+# small files are sent packed together
+PACK_MAX_FILE_SIZE = 64 * 1024
+PACK_MAX_SIZE = 4 * 1024 * 1024
+PACK_MAX_FILES = 4096
+# packs sent without waiting for PACK_DONE, keeps server writes close behind
+PACK_WINDOW = 4
+
+# files with .gitignore syntax, used for exclude files from sync
+IGNORE_FILES = (".gitignore", ".boignore")
+
+# big files are received into target_dir/.bo-partial/ and could be resumed
+RESUME_MIN_SIZE = 8 * 1024 * 1024
+PARTIAL_DIR = ".bo-partial"
+
+# received files are written by background threads of connection on the server,
+# chunks of streamed file are queued between receiving and writing threads
+SERVER_WRITER_THREADS = 2
+SERVER_WRITER_QUEUE = 64
+
+# watch mode: wait for quiet period after last event, but not longer than max delay
+WATCH_DEBOUNCE = 0.1
+WATCH_MAX_DELAY = 1.0
+WATCH_POLL_INTERVAL = 2.0
+# directories with events in this period are rescanned after overflow of inotify queue
+WATCH_ACTIVE_PERIOD = 10.0
+WATCH_RECONNECT_DELAY = 3.0
+INOTIFY_EVENT = struct.Struct("iIII")
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONTFOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO \
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONTFOLLOW
+
+# compression of transferred files
+COMPRESSION_ALGOS = ["zlib", "lzma", "bz2"]
+COMPRESSION_DEFAULT_LEVELS = {"zlib": 6, "lzma": 1, "bz2": 9}
+COMPRESSION_AUTO_LEVELS = [1, 6, 9]
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_MAX_SAMPLE_RATIO = 0.9
+COMPRESSION_CHUNK_SIZE = 1024 * 1024
+COMPRESSION_MIN_LINK_SAMPLE = 8 * 1024 * 1024
+# stats: upper bounds of buckets of latency histograms, 1 ms .. 8 s
+STATS_BUCKETS = [0.001 * 2 ** _power for _power in range(14)]
+LOG_INFO = 1
+LOG_DEBUG = 2
+COMPRESSION_SKIP_EXTENSIONS = {
+    ".gz", ".tgz", ".bz2", ".xz", ".lzma", ".zst", ".lz4", ".zip", ".7z", ".rar",
+    ".jar", ".war", ".apk", ".whl", ".nupkg", ".png", ".jpg", ".jpeg", ".gif", ".webp",
+    ".mp3", ".mp4", ".mkv", ".avi", ".mov", ".ogg", ".flac", ".woff", ".woff2",
+    ".docx", ".xlsx", ".pptx", ".odt", ".ods",
+}
+
+
+# lines of threads (streams of sync, connections of server) are printed at once
+PRINT_LOCK = threading.Lock()
+
+
+def say(*_args):
+    """ print line by one write, so lines printed by threads are not mixed """
+    _line = " ".join(str(_arg) for _arg in _args) + "\n"
+    with PRINT_LOCK:
+        sys.stdout.write(_line)
 
 
 def fatal(error_num, msg):
     """ print error and exit """
-    print("\n[ERROR] (" + str(error_num) + ") " + msg + "\n\n")
+    say("\n[ERROR] (" + str(error_num) + ") " + msg + "\n\n")
     sys.exit(-1)
 
 
-CURRENT_DIR = os.path.normpath(os.path.realpath(os.getcwd()))
-# init config in home dir
-BO_HOME_CONFIG_DIR = os.path.join(Path.home(), ".bo-by-sea5kg")
-if not os.path.isdir(BO_HOME_CONFIG_DIR):
-    os.mkdir(BO_HOME_CONFIG_DIR)
-    if not os.path.isdir(BO_HOME_CONFIG_DIR):
-        fatal(1, "Could not create directory: '" + BO_HOME_CONFIG_DIR + "'")
+# level of output, messages of protocol and about every file are printed only with --verbose
+BO_LOG = {"level": LOG_INFO}
+
+
+def log_debug(*_args):
+    """ print message which is needed only for debugging (protocol, every file) """
+    if BO_LOG["level"] >= LOG_DEBUG:
+        say(*_args)
+
+
+BO_HOME_CONFIG_DIR = os.path.join(os.path.expanduser("~"), ".bo-by-sea5kg")
 BO_CONFIG_FILEPATH = os.path.join(BO_HOME_CONFIG_DIR, "config.yml")
+# parsed config.yml, used while config.yml is not changed (yaml is slow to import and parse)
+BO_CONFIG_CACHE_FILEPATH = os.path.join(BO_HOME_CONFIG_DIR, "config.cache.json")
+AGENT_SOCKET_PATH = os.path.join(BO_HOME_CONFIG_DIR, "agent.sock")
 BO_CONFIG = {
     "bo_version": VERSION,
     "workdirs": {}
 }
 
 
+def init_home_config_dir():
+    """ create directory for config and caches in home dir """
+    if not os.path.isdir(BO_HOME_CONFIG_DIR):
+        os.mkdir(BO_HOME_CONFIG_DIR)
+        if not os.path.isdir(BO_HOME_CONFIG_DIR):
+            fatal(1, "Could not create directory: '" + BO_HOME_CONFIG_DIR + "'")
+
+
+def config_stamp(_stat):
+    """ identity of config.yml version, cached config is valid only for same stamp """
+    return [_stat.st_mtime_ns, _stat.st_size, _stat.st_ino]
+
+
+def load_config_cache(_stamp):
+    """ return cached parsed config or None if cache is missing or outdated """
+    try:
+        with open(BO_CONFIG_CACHE_FILEPATH, encoding="utf-8") as _file:
+            _cache = json.load(_file)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(_cache, dict) or _cache.get("stamp") != _stamp:
+        return None
+    return _cache.get("config")
+
+
+def resave_config_cache(_stamp):
+    """ write parsed config next to config.yml, failures only make next start slower """
+    _tmp_path = BO_CONFIG_CACHE_FILEPATH + "." + str(os.getpid()) + ".tmp"
+    try:
+        with open(_tmp_path, 'w', encoding="utf-8") as _file:
+            json.dump({"stamp": _stamp, "config": BO_CONFIG}, _file)
+        os.replace(_tmp_path, BO_CONFIG_CACHE_FILEPATH)
+    except (OSError, TypeError, ValueError):
+        if os.path.exists(_tmp_path):
+            os.remove(_tmp_path)
+
+
+def load_config():
+    """ read config file into BO_CONFIG """
+    init_home_config_dir()
+    try:
+        _stamp = config_stamp(os.stat(BO_CONFIG_FILEPATH))
+    except FileNotFoundError:
+        _stamp = None
+    if _stamp is not None:
+        _config = load_config_cache(_stamp)
+        if _config is None:
+            import yaml  # pylint: disable=import-outside-toplevel
+            with open(BO_CONFIG_FILEPATH, encoding="utf-8") as _file:
+                try:
+                    _config = yaml.safe_load(_file)
+                except yaml.YAMLError as exc:
+                    print(exc)
+                    fatal(2, "Problem with reading config, description: " + str(exc))
+            BO_CONFIG.clear()
+            BO_CONFIG.update(_config or {})
+            resave_config_cache(_stamp)
+        else:
+            BO_CONFIG.clear()
+            BO_CONFIG.update(_config)
+    else:
+        resave_config()
+    if "workdirs" not in BO_CONFIG:
+        BO_CONFIG["workdirs"] = {}
+
+
 def resave_config():
     """ resave config file """
+    import yaml  # pylint: disable=import-outside-toplevel
+    init_home_config_dir()
     BO_CONFIG["bo_version"] = VERSION
     with open(BO_CONFIG_FILEPATH, 'w', encoding="utf-8") as _file:
         yaml.dump(BO_CONFIG, _file, indent=2)
+    resave_config_cache(config_stamp(os.stat(BO_CONFIG_FILEPATH)))
 
 
-def get_all_files(_startdir):
-    """ recursive find all files in dir """
-    _ret = []
-    _rec = [_startdir]
-    while len(_rec) > 0:
-        _dirpath = _rec[0]
-        del _rec[0]
-        for _file in os.listdir(_dirpath):
-            _filepath = os.path.join(_dirpath, _file)
-            if _file == '.git' and os.path.isdir(_filepath):
+class BoStatsTimer:  # pylint: disable=too-few-public-methods
+    """ context manager which adds time of block to timer of stats """
+
+    def __init__(self, _stats, _name):
+        self.__stats = _stats
+        self.__name = _name
+        self.__start = 0.0
+
+    def __enter__(self):
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc):
+        self.__stats.add_time(self.__name, time.perf_counter() - self.__start)
+
+
+class BoStats:
+    """
+        metrics of process: time of phases, counters and histograms of latency
+        of every file, updated from several threads
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__started = time.time()
+        # name -> [count, seconds]
+        self.__timers = {}
+        self.__counters = {}
+        # name -> counts by STATS_BUCKETS, the last one is for slower
+        self.__histograms = {}
+
+    def timer(self, _name):
+        """ with stats.timer(name): ... - measure time of block """
+        return BoStatsTimer(self, _name)
+
+    def add_time(self, _name, _seconds):
+        """ add time to timer """
+        with self.__lock:
+            _timer = self.__timers.setdefault(_name, [0, 0.0])
+            _timer[0] += 1
+            _timer[1] += _seconds
+
+    def add(self, _name, _value=1):
+        """ increase counter """
+        with self.__lock:
+            self.__counters[_name] = self.__counters.get(_name, 0) + _value
+
+    def observe(self, _name, _seconds):
+        """ add latency of one file to histogram """
+        _bucket = bisect.bisect_left(STATS_BUCKETS, _seconds)
+        with self.__lock:
+            if _name not in self.__histograms:
+                self.__histograms[_name] = [0] * (len(STATS_BUCKETS) + 1)
+            self.__histograms[_name][_bucket] += 1
+
+    def to_dict(self):
+        """ all metrics, seconds of timers are wall time summed over calls """
+        with self.__lock:
+            _stats = {
+                "uptime": round(time.time() - self.__started, 3),
+                "timers": {
+                    _name: {"count": _timer[0], "seconds": round(_timer[1], 6)}
+                    for _name, _timer in self.__timers.items()
+                },
+                "counters": dict(self.__counters),
+                "histograms": {
+                    _name: {
+                        "le_ms": [round(_bound * 1000) for _bound in STATS_BUCKETS] + [None],
+                        "counts": list(_counts),
+                    }
+                    for _name, _counts in self.__histograms.items()
+                },
+            }
+        _transfer = _stats["timers"].get("transfer", {}).get("seconds", 0)
+        if _transfer > 0:
+            _counters = _stats["counters"]
+            _files = _counters.get("files_sent", 0) + _counters.get("files_received", 0)
+            _bytes = _counters.get("file_bytes_sent", 0) + _counters.get("file_bytes_received", 0)
+            _stats["files_per_sec"] = round(_files / _transfer, 1)
+            _stats["mb_per_sec"] = round(_bytes / _transfer / 1024 / 1024, 2)
+        return _stats
+
+    @staticmethod
+    def report(_stats):
+        """ human readable text of to_dict() """
+        _lines = ["Stats (uptime " + str(_stats["uptime"]) + " sec):"]
+        for _name, _timer in sorted(_stats["timers"].items()):
+            _lines.append(
+                "    " + _name + ": " + str(round(_timer["seconds"], 3)) + " sec"
+                + ("" if _timer["count"] == 1 else " (" + str(_timer["count"]) + " times)")
+            )
+        for _name, _value in sorted(_stats["counters"].items()):
+            _lines.append("    " + _name + ": " + str(_value))
+        for _name in ("files_per_sec", "mb_per_sec"):
+            if _name in _stats:
+                _lines.append("    " + _name + ": " + str(_stats[_name]))
+        for _name, _histogram in sorted(_stats["histograms"].items()):
+            _buckets = []
+            for _bound, _count in zip(_histogram["le_ms"], _histogram["counts"]):
+                if _count > 0:
+                    _buckets.append(
+                        ("<=" + str(_bound) + "ms" if _bound is not None else "slower")
+                        + ": " + str(_count)
+                    )
+            _lines.append("    " + _name + " latency: " + ", ".join(_buckets))
+        return "\n".join(_lines)
+
+
+# metrics of this process (client or server)
+STATS = BoStats()
+
+
+class BoScannedFile:  # pylint: disable=too-few-public-methods
+    """ stat info of file collected while scanning directory """
+    __slots__ = ("size", "mtime", "mtime_ns", "inode", "ctime_ns")
+
+    def __init__(self, _stat):
+        self.size = _stat.st_size
+        self.mtime = _stat.st_mtime
+        self.mtime_ns = _stat.st_mtime_ns
+        self.inode = _stat.st_ino
+        self.ctime_ns = _stat.st_ctime_ns
+
+    def fingerprint(self):
+        """ if fingerprint is not changed then content is not changed too """
+        return [self.size, self.mtime_ns, self.inode, self.ctime_ns]
+
+
+def _glob_to_regex(_pattern):
+    """ translate gitignore glob (without leading / and trailing /) to regex """
+    _regex = ""
+    _pos = 0
+    while _pos < len(_pattern):
+        _char = _pattern[_pos]
+        if _pattern.startswith("**/", _pos) and (_pos == 0 or _pattern[_pos - 1] == "/"):
+            _regex += "(?:.*/)?"
+            _pos += 3
+            continue
+        if _pattern.startswith("**", _pos) and _pos + 2 == len(_pattern) \
+                and (_pos == 0 or _pattern[_pos - 1] == "/"):
+            _regex += ".*"
+            _pos += 2
+            continue
+        if _char == "*":
+            _regex += "[^/]*"
+        elif _char == "?":
+            _regex += "[^/]"
+        elif _char == "\\" and _pos + 1 < len(_pattern):
+            _pos += 1
+            _regex += re.escape(_pattern[_pos])
+        elif _char == "[":
+            _end = _pattern.find("]", _pos + 2)
+            if _end < 0:
+                _regex += re.escape(_char)
+            else:
+                _class = _pattern[_pos + 1:_end].replace("\\", "\\\\")
+                if _class[0] in "!^":
+                    _class = "^" + _class[1:]
+                _regex += "[" + _class + "]"
+                _pos = _end
+        else:
+            _regex += re.escape(_char)
+        _pos += 1
+    return _regex
+
+
+def find_artifacts(_root, _patterns):
+    """
+        files under root matched by glob patterns relative to root
+        (** matches any subdirectories, pattern of directory matches all files in it),
+        only static beginning of pattern is scanned; return dict: path -> BoScannedFile
+    """
+    _found = {}
+    _scanned = {}
+    for _pattern in _patterns:
+        _pattern = _pattern.replace("\\", "/").strip("/")
+        _parts = _pattern.split("/")
+        if _pattern == "" or ".." in _parts:
+            raise ValueError("Wrong pattern '" + _pattern + "'")
+        _regex = re.compile(_glob_to_regex(_pattern) + "(?:/.*)?$")
+        _base = []
+        for _part in _parts[:-1]:
+            if any(_char in _part for _char in "*?[\\"):
+                break
+            _base.append(_part)
+        _basedir = os.path.join(*_base) if _base else ""
+        if _basedir not in _scanned:
+            _startdir = os.path.join(_root, _basedir)
+            _scanned[_basedir] = scan_files(_startdir) if os.path.isdir(_startdir) else {}
+        for _file, _stat in _scanned[_basedir].items():
+            _path = os.path.join(_basedir, _file) if _basedir else _file
+            if _path.startswith(PARTIAL_DIR + os.sep) or _path.endswith(".bo-delta"):
                 continue
-            if os.path.isdir(_filepath):
-                _rec.append(_filepath)
+            if _regex.match(_path.replace(os.sep, "/")):
+                _found[_path] = _stat
+    return _found
+
+
+class BoIgnoreMatcher:  # pylint: disable=too-few-public-methods
+    """
+        compiled rules of .gitignore-like files of one directory,
+        rules of deeper directory override rules of parent, last matched rule wins
+    """
+
+    def __init__(self, _dirpath, _lines, _parent=None):
+        self.__base = os.path.join(_dirpath, "")
+        self.__parent = _parent
+        self.__rules = []
+        for _line in _lines:
+            self.__add_rule(_line)
+        # without negations any matched rule means ignored, so rules are combined
+        self.__combined = None
+        if not any(_negate for _, _negate, _ in self.__rules):
+            _any = [_regex.pattern for _regex, _, _dir_only in self.__rules if not _dir_only]
+            _dirs = [_regex.pattern for _regex, _, _dir_only in self.__rules if _dir_only]
+            self.__combined = (
+                re.compile("|".join(_any)) if _any else None,
+                re.compile("|".join(_any + _dirs)) if _dirs else None,
+            )
+
+    def __add_rule(self, _line):
+        """ compile one line of ignore file """
+        _line = _line.rstrip("\n").rstrip("\r")
+        if not _line.endswith("\\ "):
+            _line = _line.rstrip(" ")
+        if _line == "" or _line.startswith("#"):
+            return
+        _negate = _line.startswith("!")
+        if _negate or _line.startswith("\\!") or _line.startswith("\\#"):
+            _line = _line[1:]
+        _dir_only = _line.endswith("/")
+        _line = _line.rstrip("/")
+        if _line == "":
+            return
+        _anchored = "/" in _line
+        _regex = _glob_to_regex(_line.lstrip("/"))
+        if not _anchored:
+            _regex = "(?:.*/)?" + _regex
+        self.__rules.append((re.compile(_regex), _negate, _dir_only))
+
+    def __match(self, _path, _is_dir):
+        """ True - ignored, False - included again by negation, None - no rule """
+        _relpath = _path[len(self.__base):]
+        if os.sep != "/":
+            _relpath = _relpath.replace(os.sep, "/")
+        if self.__combined is not None:
+            _regex = self.__combined[1] if _is_dir and self.__combined[1] else self.__combined[0]
+            if _regex is not None and _regex.fullmatch(_relpath):
+                return True
+            return None
+        for _regex, _negate, _dir_only in reversed(self.__rules):
+            if (_is_dir or not _dir_only) and _regex.fullmatch(_relpath):
+                return not _negate
+        return None
+
+    def is_ignored(self, _path, _is_dir=False):
+        """ check full path of file or directory inside of base directory """
+        _result = self.__match(_path, _is_dir)
+        if _result is not None:
+            return _result
+        if self.__parent is not None:
+            return self.__parent.is_ignored(_path, _is_dir)
+        return False
+
+
+def load_ignore_matcher(_dirpath, _names, _parent=None):
+    """ parent matcher extended by ignore files of directory """
+    _lines = []
+    for _name in _names:
+        try:
+            with open(os.path.join(_dirpath, _name), encoding="utf-8", errors="replace") as _file:
+                _lines += _file.readlines()
+        except OSError:
+            continue
+    if not _lines:
+        return _parent
+    return BoIgnoreMatcher(_dirpath, _lines, _parent)
+
+
+def ignore_matcher_for_dir(_workdir, _reldir, _names):
+    """
+        matcher for directory inside of workdir by ignore files of all parents,
+        return (matcher, directory is ignored)
+    """
+    _matcher = load_ignore_matcher(_workdir, _names)
+    _dirpath = _workdir
+    for _part in [_part for _part in _reldir.split(os.sep) if _part]:
+        _dirpath = os.path.join(_dirpath, _part)
+        if _part == '.git' or (_matcher is not None and _matcher.is_ignored(_dirpath, True)):
+            return _matcher, True
+        _matcher = load_ignore_matcher(_dirpath, _names, _matcher)
+    return _matcher, False
+
+
+def _scan_one_dir(_dir, _startlen, _files, _subdirs, _scan_options):
+    """
+        scan one directory, fill files and return subdirectories,
+        dir is pair (path, ignore matcher)
+    """
+    _dirpath, _matcher = _dir
+    _names, _ignored = _scan_options
+    try:
+        with os.scandir(_dirpath) as _it:
+            _entries = list(_it)
+    except OSError as _err:
+        print("WARNING: could not scan directory '" + _dirpath + "': " + str(_err))
+        return
+    if _names and any(_entry.name in _names for _entry in _entries):
+        _matcher = load_ignore_matcher(_dirpath, _names, _matcher)
+    for _entry in _entries:
+        try:
+            if _entry.is_dir():
+                if _entry.name == '.git':
+                    continue
+                if _matcher is not None and _matcher.is_ignored(_entry.path, True):
+                    _ignored.append(os.path.join(_entry.path[_startlen:], ""))
+                    continue
+                _subdirs.append((_entry.path, _matcher))
                 continue
-            if os.path.isfile(_filepath):
-                _ret.append(_filepath[len(_startdir)+1:])
-    return _ret
+            if _entry.is_file():
+                if _matcher is not None and _matcher.is_ignored(_entry.path):
+                    _ignored.append(_entry.path[_startlen:])
+                    continue
+                _files[_entry.path[_startlen:]] = BoScannedFile(_entry.stat())
+        except OSError:
+            # removed while scanning
+            continue
 
 
-def md5_by_file(_filepath):
-    """ Calculate md5 by file """
-    md5 = hashlib.md5()
+def scan_files(_startdir, _workers=None, _ignore_names=(), _matcher=None, _ignored=None):
+    """
+        recursive find all files in dir (skip .git and files matched by ignore files)
+        return dict: relative path -> BoScannedFile
+        ignored paths are added to list ignored (directories with trailing separator)
+    """
+    _start = time.perf_counter()
+    _startlen = len(os.path.join(_startdir, ""))
+    _files = {}
+    _subdirs = []
+    _scan_options = (_ignore_names, [] if _ignored is None else _ignored)
+    _scan_one_dir((_startdir, _matcher), _startlen, _files, _subdirs, _scan_options)
+    if _workers is None:
+        _workers = min(16, (os.cpu_count() or 1) * 2)
+    if _workers <= 1 or not _subdirs:
+        while _subdirs:
+            _scan_one_dir(_subdirs.pop(), _startlen, _files, _subdirs, _scan_options)
+        STATS.add_time("scan", time.perf_counter() - _start)
+        return _files
+
+    # fan out subtrees to pool, every worker pulls directories from shared queue
+    _queue = collections.deque(_subdirs)
+    _cond = threading.Condition()
+    _state = {"busy": 0}
+
+    def _worker():
+        _local_files = {}
+        while True:
+            with _cond:
+                while not _queue and _state["busy"] > 0:
+                    _cond.wait()
+                if not _queue:
+                    _cond.notify_all()
+                    break
+                _dirpath = _queue.pop()
+                _state["busy"] += 1
+            _found = []
+            _scan_one_dir(_dirpath, _startlen, _local_files, _found, _scan_options)
+            with _cond:
+                _queue.extend(_found)
+                _state["busy"] -= 1
+                _cond.notify_all()
+        return _local_files
+
+    import concurrent.futures  # pylint: disable=import-outside-toplevel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=_workers) as _pool:
+        for _future in [_pool.submit(_worker) for _ in range(_workers)]:
+            _files.update(_future.result())
+    STATS.add_time("scan", time.perf_counter() - _start)
+    return _files
+
+
+def get_all_files(_startdir):
+    """ recursive find all files in dir """
+    return list(scan_files(_startdir))
+
+
+def check_hash_algo(_algo):
+    """ check that hash algorithm is supported """
+    if _algo not in HASH_ALGOS:
+        fatal(
+            12,
+            "Unsupported hash algorithm '" + str(_algo) + "', expected one of: " +
+            ", ".join(HASH_ALGOS)
+        )
+
+
+def hash_by_file(_filepath, _algo="md5"):
+    """ Calculate hash by file """
+    _hash = hashlib.new(_algo)
     with open(_filepath, 'rb') as _file:
         while True:
             data = _file.read(BUF_READ_SIZE)
             if not data:
                 break
-            md5.update(data)
-    return md5.hexdigest()
+            _hash.update(data)
+    return _hash.hexdigest()
+
+
+def md5_by_file(_filepath):
+    """ Calculate md5 by file """
+    return hash_by_file(_filepath, "md5")
+
+
+def hash_files(_workdir, _files, _algo="md5", _workers=None):
+    """
+        Calculate hashes for list of files in thread pool
+        return dict: file -> hexdigest (or None if file could not be read)
+    """
+    def _hash_chunk(_chunk):
+        _ret = {}
+        for _file in _chunk:
+            _file_start = time.perf_counter()
+            try:
+                _ret[_file] = hash_by_file(os.path.join(_workdir, _file), _algo)
+            except OSError as _err:
+                print("WARNING: could not read file '" + _file + "': " + str(_err))
+                _ret[_file] = None
+            STATS.observe("hash_file", time.perf_counter() - _file_start)
+        return _ret
+
+    _start = time.perf_counter()
+    _files = list(_files)
+    if _workers is None:
+        _workers = os.cpu_count() or 1
+    if _workers <= 1 or len(_files) <= HASH_CHUNK_SIZE:
+        _hashes = _hash_chunk(_files)
+    else:
+        _hashes = {}
+        import concurrent.futures  # pylint: disable=import-outside-toplevel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=_workers) as _pool:
+            _futures = [
+                _pool.submit(_hash_chunk, _files[_i:_i + HASH_CHUNK_SIZE])
+                for _i in range(0, len(_files), HASH_CHUNK_SIZE)
+            ]
+            for _future in _futures:
+                _hashes.update(_future.result())
+    STATS.add_time("hash", time.perf_counter() - _start)
+    STATS.add("files_hashed", len(_files))
+    return _hashes
+
+
+class BoWorkdirScan:  # pylint: disable=too-many-instance-attributes
+    """
+        one scan of workdir shared by caches of several servers,
+        every file is hashed at most once
+    """
+
+    def __init__(self, _workdir, _ignore_names=(), _full=True):
+        self.__workdir = _workdir
+        self.__ignore_names = _ignore_names
+        _ignored = []
+        self.__files = {}
+        if _full:
+            self.__files = scan_files(_workdir, None, _ignore_names, None, _ignored)
+        self.__ignored = tuple(_ignored)
+        self.__hashes = {}
+        # relative dir -> (ignore matcher, dir is ignored), kept between rescans of paths
+        self.__matchers = {}
+        # (found files, ignored, scope) of the last rescan_paths()
+        self.__rescanned = ({}, (), lambda _file: False)
+        self.__lock = threading.Lock()
+
+    def get_files(self):
+        """ return scanned files: path -> BoScannedFile """
+        return self.__files
+
+    def get_ignored(self):
+        """ return ignored files and directories (with trailing separator) """
+        return self.__ignored
+
+    def hash_files(self, _files, _algo="md5"):
+        """ like hash_files() but reuses hashes calculated for other caches """
+        with self.__lock:
+            _to_hash = [_file for _file in _files if (_algo, _file) not in self.__hashes]
+            for _file, _hash in hash_files(self.__workdir, _to_hash, _algo).items():
+                self.__hashes[(_algo, _file)] = _hash
+            return {_file: self.__hashes[(_algo, _file)] for _file in _files}
+
+    def rescan_paths(self, _files, _dirs):
+        """
+            update scan by changed files and subtrees (relative paths, empty string
+            is whole workdir), their hashes are calculated again
+        """
+        current_files = {}
+        _ignored = []
+        for _path in _files:
+            if os.path.basename(_path) in self.__ignore_names:
+                self.__forget_matchers(os.path.dirname(_path))
+        for _dir in _dirs:
+            # subtree could be moved in with own ignore files
+            self.__forget_matchers(_dir)
+        for _dir in _dirs:
+            _matcher, _is_ignored = self.__ignore_matcher(_dir)
+            if _is_ignored:
+                _ignored.append(os.path.join(_dir, ""))
+                continue
+            if not os.path.isdir(os.path.join(self.__workdir, _dir)):
+                continue
+            _found = []
+            _files_in_dir = scan_files(
+                os.path.join(self.__workdir, _dir), None, self.__ignore_names, _matcher, _found
+            )
+            for _file, _stat in _files_in_dir.items():
+                current_files[os.path.join(_dir, _file) if _dir else _file] = _stat
+            _ignored += [os.path.join(_dir, _path) if _dir else _path for _path in _found]
+        for _file in _files:
+            if _file in current_files:
+                continue
+            _matcher, _is_ignored = self.__ignore_matcher(os.path.dirname(_file))
+            if _is_ignored or (
+                _matcher is not None and _matcher.is_ignored(os.path.join(self.__workdir, _file))
+            ):
+                _ignored.append(_file)
+                continue
+            try:
+                _stat = os.stat(os.path.join(self.__workdir, _file))
+            except OSError:
+                continue
+            if stat.S_ISREG(_stat.st_mode):
+                current_files[_file] = BoScannedFile(_stat)
+        _prefixes = tuple(os.path.join(_dir, "") for _dir in _dirs if _dir)
+
+        def _scope(_file):
+            return "" in _dirs or _file in _files or _file.startswith(_prefixes)
+        with self.__lock:
+            self.__files = {
+                _file: _stat for _file, _stat in self.__files.items() if not _scope(_file)
+            }
+            self.__files.update(current_files)
+            self.__ignored = tuple(
+                _path for _path in self.__ignored if not _scope(_path)
+            ) + tuple(_ignored)
+            self.__hashes = {
+                _key: _hash for _key, _hash in self.__hashes.items() if not _scope(_key[1])
+            }
+        self.__rescanned = (current_files, tuple(_ignored), _scope)
+
+    def get_rescanned(self):
+        """ return (found files, ignored paths, scope) of the last rescan_paths() """
+        return self.__rescanned
+
+    def __ignore_matcher(self, _reldir):
+        """ like ignore_matcher_for_dir(), but ignore files of every directory are read once """
+        if _reldir in self.__matchers:
+            return self.__matchers[_reldir]
+        if _reldir == "":
+            _result = (load_ignore_matcher(self.__workdir, self.__ignore_names), False)
+        else:
+            _matcher, _is_ignored = self.__ignore_matcher(os.path.dirname(_reldir))
+            _dirpath = os.path.join(self.__workdir, _reldir)
+            if _is_ignored or os.path.basename(_reldir) == '.git' \
+                    or (_matcher is not None and _matcher.is_ignored(_dirpath, True)):
+                _result = (_matcher, True)
+            else:
+                _result = (load_ignore_matcher(_dirpath, self.__ignore_names, _matcher), False)
+        self.__matchers[_reldir] = _result
+        return _result
+
+    def __forget_matchers(self, _reldir):
+        """ ignore files of directory are changed, so matchers of its subtree too """
+        if _reldir == "":
+            self.__matchers = {}
+            return
+        _prefix = os.path.join(_reldir, "")
+        for _dir in [_dir for _dir in self.__matchers if _dir.startswith(_prefix)]:
+            del self.__matchers[_dir]
+        self.__matchers.pop(_reldir, None)
+
+
+def get_file_hash(_info):
+    """ return (algorithm, hexdigest) of file info, old caches has only md5 """
+    if "hash" in _info:
+        return _info.get("hash_algo", "md5"), _info["hash"]
+    return "md5", _info["md5"]
 
 
 def is_linux():
     """ current system is linux? """
-    return platform.platform().lower().startswith("linux")
+    return sys.platform.startswith("linux")
 
 
 def is_windows():
     """ current system is windows? """
-    return platform.platform().lower().startswith("windows")
+    return sys.platform.startswith("win")
+
+
+def lock_file(_fd):
+    """
+        take exclusive lock of open file without waiting, it is released when file
+        is closed; return False if file is locked by other connection or process
+    """
+    try:
+        if is_windows():
+            import msvcrt  # pylint: disable=import-outside-toplevel,import-error
+            _fd.seek(0)
+            msvcrt.locking(_fd.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl  # pylint: disable=import-outside-toplevel
+            fcntl.flock(_fd.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
 
+def is_file_locked(_path):
+    """ file is locked by lock_file() of other connection or process """
+    try:
+        with open(_path, 'rb') as _fd:
+            return not lock_file(_fd)
+    except OSError:
+        return False
 
-class BoFilesCache:
-    """ helper class for control of cache """
 
-    def __init__(self, _cache_path):
+def start_process(_cmds, _cwd, _new_session=False):
+    """ start command with stdout and stderr in one pipe """
+    import subprocess  # pylint: disable=import-outside-toplevel
+    return subprocess.Popen(  # pylint: disable=consider-using-with
+        _cmds,
+        cwd=_cwd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        shell=False,
+        start_new_session=_new_session,
+    )
+
+
+def kill_process_group(_proc, _force=False):
+    """
+        stop command started by start_process(..., _new_session=True) together
+        with its children (build tools started by shell)
+    """
+    if _proc.poll() is not None:
+        return
+    try:
+        if is_windows() and _force:
+            _proc.kill()
+        elif is_windows():
+            _proc.terminate()
+        else:
+            os.killpg(_proc.pid, signal.SIGKILL if _force else signal.SIGTERM)
+    except OSError:
+        pass
+
+
+def delta_block_size(_size):
+    """ size of block for delta transfer, like in rsync it is about square root of file size """
+    _block_size = int(math.sqrt(_size)) // 8 * 8
+    return max(DELTA_BLOCK_MIN_SIZE, min(DELTA_BLOCK_MAX_SIZE, _block_size))
+
+
+def delta_signature(_filepath):
+    """ weak (adler32) and strong (md5) checksums for every block of file """
+    _block_size = delta_block_size(os.path.getsize(_filepath))
+    _blocks = []
+    with open(_filepath, 'rb') as _file:
+        while True:
+            _block = _file.read(_block_size)
+            if not _block:
+                break
+            _blocks.append([zlib.adler32(_block), hashlib.md5(_block).hexdigest()])
+    return {"block_size": _block_size, "blocks": _blocks}
+
+
+def delta_ops(_data, _signature):  # pylint: disable=too-many-locals
+    """
+        find blocks of other copy (by signature) in data with rolling checksum
+        return list of ("copy", first_block, count) and ("data", begin, end)
+        or None when data is too different and it is better to send all of it
+    """
+    _block_size = _signature["block_size"]
+    _table = {}
+    for _index, (_weak, _strong) in enumerate(_signature["blocks"]):
+        _table.setdefault(_weak, {}).setdefault(_strong, _index)
+    _ops = []
+    _size = len(_data)
+    _max_rolling = min(DELTA_MAX_ROLLING, _size // 2)
+    _rolled = 0
+    _pos = 0
+    _literal_start = 0
+    _weak = None
+    _a = _b = 0
+    while _pos + _block_size <= _size:
+        if _weak is None:
+            _weak = zlib.adler32(_data[_pos:_pos + _block_size])
+            _a = _weak & 0xffff
+            _b = _weak >> 16
+        _candidates = _table.get(_weak)
+        if _candidates is not None:
+            _index = _candidates.get(hashlib.md5(_data[_pos:_pos + _block_size]).hexdigest())
+            if _index is not None:
+                if _literal_start < _pos:
+                    _ops.append(("data", _literal_start, _pos))
+                if _ops and _ops[-1][0] == "copy" and _ops[-1][1] + _ops[-1][2] == _index:
+                    _ops[-1] = ("copy", _ops[-1][1], _ops[-1][2] + 1)
+                else:
+                    _ops.append(("copy", _index, 1))
+                _pos += _block_size
+                _literal_start = _pos
+                _weak = None
+                continue
+        if _pos + _block_size >= _size:
+            break
+        _rolled += 1
+        if _rolled > _max_rolling:
+            return None
+        # roll adler32 by one byte
+        _out = _data[_pos]
+        _a = (_a - _out + _data[_pos + _block_size]) % 65521
+        _b = (_b - _block_size * _out + _a - 1) % 65521
+        _weak = (_b << 16) | _a
+        _pos += 1
+    if _literal_start < _size:
+        _ops.append(("data", _literal_start, _size))
+    return _ops
+
+
+def new_compressor(_algo, _level):
+    """ create stream compressor """
+    if _algo == "lzma":
+        import lzma  # pylint: disable=import-outside-toplevel
+        return lzma.LZMACompressor(preset=_level)
+    if _algo == "bz2":
+        import bz2  # pylint: disable=import-outside-toplevel
+        return bz2.BZ2Compressor(max(1, _level))
+    return zlib.compressobj(_level)
+
+
+def new_decompressor(_algo):
+    """ create stream decompressor """
+    if _algo == "lzma":
+        import lzma  # pylint: disable=import-outside-toplevel
+        return lzma.LZMADecompressor()
+    if _algo == "bz2":
+        import bz2  # pylint: disable=import-outside-toplevel
+        return bz2.BZ2Decompressor()
+    if _algo == "zlib":
+        return zlib.decompressobj()
+    raise BoProtocolError("Unsupported compression: " + str(_algo))
+
+
+class BoCompressionPolicy:
+    """
+        Decide per file how to compress it: skip tiny and already compressed files,
+        in auto mode choose zlib level by measured speed of link and of compression
+    """
+    def __init__(self, _mode="auto", _supported=()):
+        self.__mode = _mode if _mode in _supported or _mode == "auto" else "none"
+        if _mode == "auto" and "zlib" not in _supported:
+            self.__mode = "none"
+        self.__link_speed = None
+        # level -> [input bytes per second, ratio], start from rough estimates
+        self.__levels = {1: [60e6, 0.40], 6: [20e6, 0.33], 9: [8e6, 0.32]}
+        self.__raw = 0
+        self.__wire = 0
+        self.__lock = threading.Lock()
+
+    def set_link(self, _bytes, _seconds):
+        """ update measured link throughput """
+        if _bytes >= COMPRESSION_MIN_LINK_SAMPLE and _seconds > 0:
+            self.__link_speed = _bytes / _seconds
+
+    def choose(self, _path, _size, _sample=b""):
+        """
+            return (algorithm, level) or None if file should not be compressed
+            sample is beginning of file for detect of incompressible data
+        """
+        if self.__mode == "none" or _size < COMPRESSION_MIN_SIZE:
+            return None
+        if os.path.splitext(_path)[1].lower() in COMPRESSION_SKIP_EXTENSIONS:
+            return None
+        if len(_sample) >= COMPRESSION_SAMPLE_SIZE \
+                and len(zlib.compress(_sample, 1)) > len(_sample) * COMPRESSION_MAX_SAMPLE_RATIO:
+            return None
+        if self.__mode != "auto":
+            return self.__mode, COMPRESSION_DEFAULT_LEVELS[self.__mode]
+        if self.__link_speed is None:
+            return "zlib", COMPRESSION_AUTO_LEVELS[0]
+        # seconds per input byte: compression and sending are serial
+        _best = None
+        _best_cost = 1.0 / self.__link_speed
+        for _level in COMPRESSION_AUTO_LEVELS:
+            _speed, _ratio = self.__levels[_level]
+            _cost = 1.0 / _speed + _ratio / self.__link_speed
+            if _cost < _best_cost:
+                _best = ("zlib", _level)
+                _best_cost = _cost
+        return _best
+
+    def on_compressed(self, _level, _raw, _compressed, _seconds):
+        """ update measured speed and ratio of compression level """
+        if _level not in self.__levels or _raw < COMPRESSION_MIN_SIZE or _seconds <= 0:
+            return
+        with self.__lock:
+            _stat = self.__levels[_level]
+            _stat[0] = 0.7 * _stat[0] + 0.3 * (_raw / _seconds)
+            _stat[1] = 0.7 * _stat[1] + 0.3 * (_compressed / _raw)
+
+    def on_sent(self, _raw, _wire):
+        """ count bytes of file and bytes on the wire """
+        with self.__lock:
+            self.__raw += _raw
+            self.__wire += _wire
+
+    def report(self):
+        """ summary of compression """
+        _ratio = self.__raw / self.__wire if self.__wire > 0 else 1.0
+        return (
+            "Compression: " + self.__mode + ", " + str(self.__raw) + " bytes sent as " +
+            str(self.__wire) + " bytes (ratio " + str(round(_ratio, 2)) + ")"
+        )
+
+
+class BoFilesCache:  # pylint: disable=too-many-instance-attributes
+    """
+        helper class for control of cache
+        state is kept in sqlite database near to configured cache path
+        and only changed entries are written on resave
+    """
+
+    def __init__(self, _cache_path, _hash_algo="md5", _ignore_names=IGNORE_FILES):
+        check_hash_algo(_hash_algo)
+        self.__hash_algo = _hash_algo
+        self.__ignore_names = _ignore_names
+        # scan for rescan_paths() without shared scan
+        self.__paths_scan = None
         self.__files = {}
         self.__files_to_update = {}
+        self.__dirty = set()
+        self.__lock = threading.Lock()
         self.__cache_path = _cache_path
-        self.__cache_path_to_update = _cache_path[:-4] + "_to_update.yml"
-        # load
-        if os.path.isfile(self.__cache_path):
-            with open(self.__cache_path, encoding="utf-8") as _file:
-                try:
-                    self.__files = yaml.safe_load(_file)
-                except yaml.YAMLError as _exc:
-                    print(_exc)
-                    sys.exit(_exc)
-        for _file in self.__files:
-            if self.__files[_file]['required_sync'] != 'NONE':
-                self.__files_to_update[_file] = self.__files[_file]
+        self.__cache_path_db = os.path.splitext(_cache_path)[0] + ".db"
+        _is_new = not os.path.isfile(self.__cache_path_db)
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        try:
+            self.__db = sqlite3.connect(self.__cache_path_db, check_same_thread=False)
+            self.__db.execute("PRAGMA journal_mode=WAL")
+            self.__db.execute("PRAGMA synchronous=NORMAL")
+            self.__db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                " path TEXT PRIMARY KEY, required_sync TEXT, hash_algo TEXT, hash TEXT,"
+                " size INTEGER, last_modify REAL, mtime_ns INTEGER, inode INTEGER,"
+                " ctime_ns INTEGER, version INTEGER)"
+            )
+            if _is_new:
+                self.__migrate_from_yaml()
+            self.__load()
+        except sqlite3.Error as _exc:
+            fatal(13, "Problem with cache '" + self.__cache_path_db + "': " + str(_exc))
+
+    def __migrate_from_yaml(self):
+        """ one time migration from yaml cache of previous versions """
+        if not os.path.isfile(self.__cache_path):
+            return
+        print("Migrating cache " + self.__cache_path + " ...")
+        import yaml  # pylint: disable=import-outside-toplevel
+        with open(self.__cache_path, encoding="utf-8") as _file:
+            try:
+                _files = yaml.load(_file, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+            except yaml.YAMLError as _exc:
+                print(_exc)
+                sys.exit(_exc)
+        for _file, _fileinfo in (_files or {}).items():
+            if "hash" not in _fileinfo:
+                _fileinfo["hash_algo"], _fileinfo["hash"] = get_file_hash(_fileinfo)
+            self.__files[_file] = _fileinfo
+            self.__dirty.add(_file)
+        self.resave_cache()
+        os.replace(self.__cache_path, self.__cache_path + ".migrated")
+        _cache_path_to_update = self.__cache_path[:-4] + "_to_update.yml"
+        if os.path.isfile(_cache_path_to_update):
+            os.remove(_cache_path_to_update)
+
+    def __load(self):
+        """ load all entries from database """
+        self.__files = {}
+        for _row in self.__db.execute("SELECT * FROM files"):
+            _fileinfo = {
+                "required_sync": _row[1],
+                "hash_algo": _row[2],
+                "hash": _row[3],
+                "size": _row[4],
+                "last_modify": _row[5],
+                "version": _row[9],
+            }
+            if _row[6] is not None:
+                _fileinfo["fingerprint"] = [_row[4], _row[6], _row[7], _row[8]]
+            self.__files[_row[0]] = _fileinfo
+            if _fileinfo['required_sync'] != 'NONE':
+                self.__files_to_update[_row[0]] = _fileinfo
 
     def get_cache_path(self):
         """ return cache path """
         return self.__cache_path
 
-    def get_cache_path_to_update(self):
-        """ return cache path to_update """
-        return self.__cache_path_to_update
-
     def has(self, _file):
         """ is contains file """
         return _file in self.__files
 
-    def add(self, _file, _fullpath):
+    def get_hash_algo(self):
+        """ return hash algorithm for new entries """
+        return self.__hash_algo
+
+    def add(self, _file, _fullpath, _stat=None, _hash=None):
         """ added file to cache """
+        if _stat is None:
+            _stat = BoScannedFile(os.stat(_fullpath))
+        if _hash is None:
+            _hash = hash_by_file(_fullpath, self.__hash_algo)
         self.__files[_file] = {
             "required_sync": "UPDATE",
-            "md5": md5_by_file(_fullpath),
-            "size": os.path.getsize(_fullpath),
-            "last_modify": os.path.getmtime(_fullpath),
-            "last_modify_formatted": time.ctime(os.path.getmtime(_fullpath)),
+            "hash_algo": self.__hash_algo,
+            "hash": _hash,
         }
+        self.__set_stat(_file, _stat)
         self.__files_to_update[_file] = self.__files[_file]
 
+    def __set_stat(self, _file, _stat):
+        """ update stat fields of file info """
+        _fileinfo = self.__files[_file]
+        _fileinfo["size"] = _stat.size
+        _fileinfo["last_modify"] = _stat.mtime
+        _fileinfo["fingerprint"] = _stat.fingerprint()
+        self.__dirty.add(_file)
+
     def get(self, _file):
         """ return file info """
         return self.__files[_file]
@@ -174,6 +1233,7 @@ class BoFilesCache:
         if 'version' not in self.__files[_file]:
             self.__files[_file]['version'] = 0
         self.__files[_file]['version'] += 1
+        self.__dirty.add(_file)
         if self.__files[_file]['required_sync'] == 'NONE':
             if _file in self.__files_to_update:
                 del self.__files_to_update[_file]
@@ -183,6 +1243,7 @@ class BoFilesCache:
     def remove(self, _file):
         """ remove file from list """
         del self.__files[_file]
+        self.__dirty.add(_file)
         if _file in self.__files_to_update:
             del self.__files_to_update[_file]
 
@@ -194,53 +1255,875 @@ class BoFilesCache:
         """ return all the file list """
         return self.__files_to_update
 
+    def dump_files_to_update(self, _legacy=False):
+        """
+            serialize files to update for sending to server
+            legacy - server with protocol 1 knows only about md5
+        """
+        _files = self.__files_to_update
+        if _legacy:
+            _files = {}
+            for _file, _fileinfo in self.__files_to_update.items():
+                _hash_algo, _hash = get_file_hash(_fileinfo)
+                if _hash_algo != "md5":
+                    fatal(14, "Server does not support hash algorithm '" + _hash_algo + "'")
+                _files[_file] = dict(_fileinfo, md5=_hash)
+        # json is subset of yaml, so server could read it by yaml too
+        return json.dumps(_files).encode("utf-8")
+
     def resave_cache(self):
-        """ resave file """
-        with open(self.__cache_path, 'w', encoding="utf-8") as _file:
-            yaml.dump(self.__files, _file, indent=2)
-        with open(self.__cache_path_to_update, 'w', encoding="utf-8") as _file:
-            yaml.dump(self.__files_to_update, _file, indent=2)
-
-    def rescan_files(self, _workdir):
-        """ Update list of files (scan again) """
+        """ write changed entries to database """
+        with self.__lock, STATS.timer("cache_write"):
+            _dirty = self.__dirty
+            self.__dirty = set()
+            _rows = []
+            _removed = []
+            for _file in _dirty:
+                _fileinfo = self.__files.get(_file)
+                if _fileinfo is None:
+                    _removed.append((_file,))
+                    continue
+                _fingerprint = _fileinfo.get("fingerprint", [None, None, None, None])
+                _rows.append((
+                    _file, _fileinfo["required_sync"], _fileinfo.get("hash_algo", "md5"),
+                    _fileinfo["hash"], _fileinfo["size"], _fileinfo["last_modify"],
+                    _fingerprint[1], _fingerprint[2], _fingerprint[3],
+                    _fileinfo.get("version", 0),
+                ))
+            with self.__db:
+                self.__db.executemany(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    _rows
+                )
+                self.__db.executemany("DELETE FROM files WHERE path = ?", _removed)
+
+    def rescan_files(self, _workdir, _scan=None):
+        """
+            Update list of files (scan again),
+            scan - BoWorkdirScan already made for cache of other server
+        """
         print("Scanning files...")
         _start = time.time()
-        current_files = get_all_files(_workdir)
+        if _scan is None:
+            _scan = BoWorkdirScan(_workdir, self.__ignore_names)
+        current_files = _scan.get_files()
+        _hashed, _changes = self.__apply_scan(
+            _workdir, current_files, lambda _file: True, _scan.get_ignored(), _scan.hash_files
+        )
+        _end = time.time()
+        print(
+            "Done. Found all files:", len(current_files), ". \n"
+            "   Hashed: ", _hashed, ", Changes: ", _changes,
+            ", Elapsed ", _end - _start, "sec"
+        )
+
+    def rescan_paths(self, _workdir, _files, _dirs, _scan=None):
+        """
+            Update only changed files and rescan only given subtrees
+            (relative paths, empty string is whole workdir), return count of changes;
+            scan - BoWorkdirScan shared with caches of other servers, it is refreshed
+            by the first of them (see BoWorkdirScan.rescan_paths)
+        """
+        if _scan is None:
+            if self.__paths_scan is None:
+                self.__paths_scan = BoWorkdirScan(_workdir, self.__ignore_names, False)
+            _scan = self.__paths_scan
+            _scan.rescan_paths(_files, _dirs)
+        current_files, _ignored, _scope = _scan.get_rescanned()
+        return self.__apply_scan(_workdir, current_files, _scope, _ignored, _scan.hash_files)[1]
+
+    def __apply_scan(  # pylint: disable=too-many-arguments
+        self, _workdir, current_files, _scope, _ignored=(), _hasher=None
+    ):
+        """
+            update entries by scanned files, scope(path) tells that file
+            would be found by the scan if it exists, return (hashed, changes);
+            ignored files and directories (trailing separator) are forgotten
+            without deleting on the server; hasher(files, algo) -> hashes
+        """
         _changes = 0
-        for _file in current_files:
-            fullpath = os.path.join(_workdir, _file)
+        _to_hash = []
+        for _file, _stat in current_files.items():
+            _fileinfo = self.__files.get(_file)
+            if _fileinfo is None:
+                _to_hash.append(_file)
+            elif "fingerprint" in _fileinfo:
+                if _fileinfo["fingerprint"] != _stat.fingerprint():
+                    _to_hash.append(_file)
+            elif _stat.mtime == _fileinfo["last_modify"]:
+                # cache from previous version, trust to mtime once
+                self.__set_stat(_file, _stat)
+            else:
+                _to_hash.append(_file)
+        if _hasher is None:
+            _hashes = hash_files(_workdir, _to_hash, self.__hash_algo)
+        else:
+            _hashes = _hasher(_to_hash, self.__hash_algo)
+        for _file in _to_hash:
+            _hash = _hashes[_file]
+            if _hash is None:
+                continue
+            _stat = current_files[_file]
             if not self.has(_file):
-                self.add(_file, fullpath)
+                self.add(_file, os.path.join(_workdir, _file), _stat, _hash)
                 _changes += 1
+                continue
+            _fileinfo = self.__files[_file]
+            if _fileinfo["required_sync"] == "NONE" \
+                    and get_file_hash(_fileinfo) == (self.__hash_algo, _hash):
+                # touched but content is the same
+                self.__set_stat(_file, _stat)
+                continue
+            self.update(_file, {
+                "required_sync": "UPDATE",
+                "hash_algo": self.__hash_algo,
+                "hash": _hash,
+            })
+            self.__set_stat(_file, _stat)
+            _changes += 1
+        _changes += self.__remove_missing(current_files, _scope, _ignored)
+        return len(_to_hash), _changes
+
+    def __remove_missing(self, current_files, _scope, _ignored):
+        """ mark files not found by scan for delete, return count of changes """
+        _removed = [
+            _file for _file, _fileinfo in self.__files.items()
+            if _file not in current_files and _scope(_file)
+            and _fileinfo["required_sync"] != "DELETE"
+        ]
+        _ignored_dirs = tuple(_path for _path in _ignored if _path.endswith(os.sep))
+        _ignored_files = set(_ignored).difference(_ignored_dirs)
+        for _file in _removed:
+            if _file in _ignored_files or (_ignored_dirs and _file.startswith(_ignored_dirs)):
+                self.remove(_file)
             else:
-                _fileinfo = self.__files[_file]
-                if os.path.getmtime(fullpath) != _fileinfo["last_modify"]:
-                    self.update(_file, {
-                        "required_sync": "UPDATE",
-                        "md5": md5_by_file(fullpath),
-                        "size": os.path.getsize(fullpath),
-                        "last_modify": os.path.getmtime(fullpath),
-                        "last_modify_formatted": time.ctime(os.path.getmtime(fullpath)),
-                    })
-                if not os.path.isfile(fullpath):
-                    self.update(_file, {"required_sync": "DELETE"})
-        for _file in self.__files:
-            if _file not in current_files:
                 self.update(_file, {"required_sync": "DELETE"})
-                _changes += 1
-        _end = time.time()
+        return len(_removed)
+
+
+class BoPollWatcher:
+    """ fallback watcher: rescan whole workdir by stat periodically """
+
+    def wait_changes(self):
+        """ return (changed files, subtrees for rescan) as relative paths """
+        time.sleep(WATCH_POLL_INTERVAL)
+        return set(), {""}
+
+    def poll_changes(self):
+        """ return changes until now without waiting: whole workdir for rescan """
+        return set(), {""}
+
+    def close(self):
+        """ nothing to release """
+
+
+class BoInotifyWatcher:  # pylint: disable=too-many-instance-attributes
+    """
+        watcher by linux inotify (called by ctypes), every directory has own watch;
+        directories which could not be watched (limit of watches) are rescanned
+        periodically, overflow of events queue leads to rescan by stat of
+        recently active directories
+    """
+
+    def __init__(self, _root, _ignore_names=()):
+        self.__root = _root
+        self.__ignore_names = _ignore_names
+        import ctypes  # pylint: disable=import-outside-toplevel
+        self.__get_errno = ctypes.get_errno
+        self.__libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self.__libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+        self.__fd = self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            raise OSError(self.__get_errno(), "inotify_init1 failed")
+        self.__dirs = {}
+        self.__unwatched = set()
+        # directory -> time of its last event
+        self.__active = {}
+        self.__watch_tree("")
+
+    def __watch_tree(self, _dir):
+        """ add watches for directory and all its not ignored subdirectories """
+        _matcher, _is_ignored = ignore_matcher_for_dir(self.__root, _dir, self.__ignore_names)
+        if _is_ignored:
+            return
+        _stack = [(_dir, _matcher)]
+        while _stack:
+            _dir, _matcher = _stack.pop()
+            _path = os.path.join(self.__root, _dir)
+            if self.__ignore_names:
+                _matcher = load_ignore_matcher(_path, self.__ignore_names, _matcher)
+            _wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(_path), INOTIFY_MASK)
+            if _wd < 0:
+                _errno = self.__get_errno()
+                if _errno == errno.ENOSPC:
+                    print("WARNING: limit of inotify watches, '" + _path + "' will be polled")
+                    self.__unwatched.add(_dir)
+                continue
+            self.__dirs[_wd] = _dir
+            try:
+                with os.scandir(_path) as _it:
+                    for _entry in _it:
+                        if _entry.name == '.git' or not _entry.is_dir(follow_symlinks=False):
+                            continue
+                        if _matcher is None or not _matcher.is_ignored(_entry.path, True):
+                            _stack.append((os.path.join(_dir, _entry.name), _matcher))
+            except OSError:
+                continue
+
+    def __unwatch_tree(self, _dir):
+        """ remove watches of directory and its subdirectories """
+        _prefix = os.path.join(_dir, "")
+        for _wd, _watched in list(self.__dirs.items()):
+            if _watched == _dir or _watched.startswith(_prefix):
+                self.__libc.inotify_rm_watch(self.__fd, _wd)
+                del self.__dirs[_wd]
+
+    def __read_events(self, _files, _dirs):
+        """ read available events into changed files and subtrees """
+        try:
+            _data = os.read(self.__fd, 65536)
+        except BlockingIOError:
+            return
+        _pos = 0
+        _overflow = False
+        _now = time.time()
+        while _pos < len(_data):
+            _wd, _mask, _, _len = INOTIFY_EVENT.unpack_from(_data, _pos)
+            _name = os.fsdecode(_data[_pos + INOTIFY_EVENT.size:_pos + INOTIFY_EVENT.size + _len])
+            _name = _name.rstrip("\0")
+            _pos += INOTIFY_EVENT.size + _len
+            if _mask & IN_Q_OVERFLOW:
+                _overflow = True
+                continue
+            if _mask & IN_IGNORED:
+                self.__dirs.pop(_wd, None)
+                continue
+            if _wd not in self.__dirs or _name == '.git' or not _name:
+                continue
+            _dir = self.__dirs[_wd]
+            self.__active[_dir] = _now
+            _path = os.path.join(_dir, _name)
+            if _name in self.__ignore_names:
+                # rules are changed, so subtree could have other set of files
+                self.__unwatch_tree(_dir)
+                self.__watch_tree(_dir)
+                _dirs.add(_dir)
+                continue
+            if not _mask & IN_ISDIR:
+                _files.add(_path)
+                continue
+            if _mask & (IN_MOVED_FROM | IN_DELETE):
+                self.__unwatch_tree(_path)
+            if _mask & (IN_CREATE | IN_MOVED_TO):
+                # files could be created before watch was added
+                self.__watch_tree(_path)
+            _dirs.add(_path)
+        if _overflow:
+            _dirs.update(self.__overflow_rescan(_now))
+
+    def __overflow_rescan(self, _now):
+        """
+            subtrees for rescan after lost events: directories which had events
+            recently, events are lost mostly where files are written now
+        """
+        _active = {
+            _dir for _dir, _time in self.__active.items() if _now - _time < WATCH_ACTIVE_PERIOD
+        }
+        if not _active or "" in _active:
+            print("WARNING: inotify queue overflow, full rescan of workdir by stat")
+            return {""}
         print(
-            "Done. Found all files:", len(current_files), ". \n"
-            "   Changes: ", _changes, ", Elapsed ", _end - _start, "sec"
+            "WARNING: inotify queue overflow, rescan by stat of " + str(len(_active)) +
+            " recently changed directories"
+        )
+        return _active
+
+    def wait_changes(self):
+        """ return (changed files, subtrees for rescan) as relative paths """
+        _files = set()
+        _dirs = set()
+        _now = time.time()
+        self.__active = {
+            _dir: _time for _dir, _time in self.__active.items()
+            if _now - _time < WATCH_ACTIVE_PERIOD
+        }
+        _timeout = WATCH_POLL_INTERVAL if self.__unwatched else None
+        while not _files and not _dirs:
+            if not select.select([self.__fd], [], [], _timeout)[0]:
+                _dirs.update(self.__unwatched)
+                break
+            self.__read_events(_files, _dirs)
+        _first = time.time()
+        while time.time() - _first < WATCH_MAX_DELAY:
+            if not select.select([self.__fd], [], [], WATCH_DEBOUNCE)[0]:
+                break
+            self.__read_events(_files, _dirs)
+        return _files, _dirs
+
+    def poll_changes(self):
+        """ return changes queued until now without waiting """
+        _files = set()
+        _dirs = set(self.__unwatched)
+        while select.select([self.__fd], [], [], 0)[0]:
+            self.__read_events(_files, _dirs)
+        return _files, _dirs
+
+    def close(self):
+        """ release inotify descriptor """
+        os.close(self.__fd)
+
+
+def new_watcher(_root, _ignore_names=()):
+    """ inotify watcher on linux, polling otherwise """
+    if is_linux():
+        try:
+            return BoInotifyWatcher(_root, _ignore_names)
+        except OSError as _err:
+            print("WARNING: inotify is not available (" + str(_err) + "), use polling")
+    return BoPollWatcher()
+
+
+class BoContentIndex:
+    """
+        index of files already received by server, keyed by hash of content;
+        entries are checked by size and mtime before use, so changes of files
+        on the server side do not produce wrong copies;
+        hashes of pulled artifacts are kept too, but only synced files are in digest
+    """
+
+    def __init__(self, _index_path):
+        self.__lock = threading.Lock()
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        self.__db = sqlite3.connect(_index_path, check_same_thread=False)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("PRAGMA synchronous=NORMAL")
+        self.__db.execute(
+            "CREATE TABLE IF NOT EXISTS content ("
+            " target_dir TEXT, path TEXT, hash_algo TEXT, hash TEXT,"
+            " size INTEGER, mtime_ns INTEGER, synced INTEGER DEFAULT 1,"
+            " PRIMARY KEY (target_dir, path))"
         )
+        _columns = [_row[1] for _row in self.__db.execute("PRAGMA table_info(content)")]
+        if "synced" not in _columns:
+            self.__db.execute("ALTER TABLE content ADD COLUMN synced INTEGER DEFAULT 1")
+        self.__db.execute(
+            "CREATE INDEX IF NOT EXISTS content_hash ON content (target_dir, hash_algo, hash)"
+        )
+        self.__db.commit()
+
+    def add(self, _target_dir, _files, _synced=True):
+        """
+            remember content of files, files is list of (path, hash_algo, hash);
+            not synced files (artifacts) keep the flag of file if it was synced
+        """
+        _rows = []
+        for _file, _hash_algo, _hash in _files:
+            try:
+                _stat = os.stat(os.path.join(_target_dir, _file))
+            except OSError:
+                continue
+            _rows.append((_target_dir, _file, _hash_algo, _hash, _stat.st_size, _stat.st_mtime_ns))
+        with self.__lock:
+            if _synced:
+                self.__db.executemany(
+                    "INSERT OR REPLACE INTO content VALUES (?, ?, ?, ?, ?, ?, 1)", _rows
+                )
+            else:
+                self.__db.executemany(
+                    "INSERT INTO content VALUES (?, ?, ?, ?, ?, ?, 0)"
+                    " ON CONFLICT (target_dir, path) DO UPDATE SET hash_algo = excluded.hash_algo,"
+                    " hash = excluded.hash, size = excluded.size, mtime_ns = excluded.mtime_ns",
+                    _rows
+                )
+            self.__db.commit()
+
+    def remove(self, _target_dir, _files):
+        """ forget files """
+        with self.__lock:
+            self.__db.executemany(
+                "DELETE FROM content WHERE target_dir = ? AND path = ?",
+                [(_target_dir, _file) for _file in _files]
+            )
+            self.__db.commit()
+
+    def __is_actual(self, _target_dir, _file, _size, _mtime_ns):
+        """ file was not changed after indexing """
+        try:
+            _stat = os.stat(os.path.join(_target_dir, _file))
+        except OSError:
+            return False
+        return _stat.st_size == _size and _stat.st_mtime_ns == _mtime_ns
+
+    def has(self, _target_dir, _file, _hash_algo, _hash):
+        """ file is indexed with the same content and was not changed """
+        with self.__lock:
+            _row = self.__db.execute(
+                "SELECT hash_algo, hash, size, mtime_ns FROM content"
+                " WHERE target_dir = ? AND path = ?", (_target_dir, _file)
+            ).fetchone()
+        return _row is not None and _row[0] == _hash_algo and _row[1] == _hash \
+            and self.__is_actual(_target_dir, _file, _row[2], _row[3])
+
+    def get_hash(self, _target_dir, _file, _hash_algo):
+        """ hash of file if it is indexed by the algorithm and was not changed, or None """
+        with self.__lock:
+            _row = self.__db.execute(
+                "SELECT hash, size, mtime_ns FROM content"
+                " WHERE target_dir = ? AND path = ? AND hash_algo = ?",
+                (_target_dir, _file, _hash_algo)
+            ).fetchone()
+        if _row is None or not self.__is_actual(_target_dir, _file, _row[1], _row[2]):
+            return None
+        return _row[0]
+
+    def digest(self, _target_dir):
+        """
+            digest of all synced files of target dir,
+            files changed on the server side are taken by size and mtime
+        """
+        with self.__lock:
+            _rows = self.__db.execute(
+                "SELECT path, hash_algo, hash, size, mtime_ns FROM content"
+                " WHERE target_dir = ? AND synced = 1 ORDER BY path", (_target_dir,)
+            ).fetchall()
+        _digest = hashlib.sha256()
+        for _file, _hash_algo, _hash, _size, _mtime_ns in _rows:
+            try:
+                _stat = os.stat(os.path.join(_target_dir, _file))
+                if _stat.st_size == _size and _stat.st_mtime_ns == _mtime_ns:
+                    _line = _file + " " + _hash_algo + " " + _hash
+                else:
+                    _line = _file + " changed " + str(_stat.st_size) + " " + str(_stat.st_mtime_ns)
+            except OSError:
+                _line = _file + " removed"
+            _digest.update((_line + "\n").encode("utf-8", "surrogateescape"))
+        return _digest.hexdigest()
+
+    def find(self, _target_dir, _hash_algo, _hash):
+        """ path of actual file with the content or None """
+        with self.__lock:
+            _rows = self.__db.execute(
+                "SELECT path, size, mtime_ns FROM content"
+                " WHERE target_dir = ? AND hash_algo = ? AND hash = ?",
+                (_target_dir, _hash_algo, _hash)
+            ).fetchall()
+        for _file, _size, _mtime_ns in _rows:
+            if self.__is_actual(_target_dir, _file, _size, _mtime_ns):
+                return _file
+        return None
+
+
+class BoResultCache:
+    """
+        output and exit status of remote commands keyed by command and digest
+        of synced files, total size is bounded by eviction of least recently used
+    """
+
+    def __init__(self, _cache_dir, _max_size):
+        self.__dir = _cache_dir
+        self.__max_size = _max_size
+        self.__lock = threading.Lock()
+        os.makedirs(_cache_dir, exist_ok=True)
+        # spools of interrupted runs
+        for _name in os.listdir(_cache_dir):
+            if _name.endswith(".tmp"):
+                os.remove(os.path.join(_cache_dir, _name))
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        self.__db = sqlite3.connect(os.path.join(_cache_dir, "results.db"), check_same_thread=False)
+        self.__db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY, exit_status INTEGER, size INTEGER, last_used REAL)"
+        )
+        self.__db.commit()
+
+    @staticmethod
+    def make_key(_target_dir, _sub_dir, _command, _digest):
+        """ key of result """
+        return hashlib.sha256(
+            json.dumps([_target_dir, _sub_dir, _command, _digest]).encode("utf-8")
+        ).hexdigest()
+
+    def get_max_entry_size(self):
+        """ bigger output is not cached """
+        return self.__max_size // 4
+
+    def get(self, _key):
+        """ return (opened file with output, exit status) or None """
+        with self.__lock:
+            _row = self.__db.execute(
+                "SELECT exit_status FROM results WHERE key = ?", (_key,)
+            ).fetchone()
+            if _row is None:
+                return None
+            _path = os.path.join(self.__dir, _key)
+            try:
+                _file = open(_path, 'rb')  # pylint: disable=consider-using-with
+            except OSError:
+                self.__db.execute("DELETE FROM results WHERE key = ?", (_key,))
+                self.__db.commit()
+                return None
+            self.__db.execute(
+                "UPDATE results SET last_used = ? WHERE key = ?", (time.time(), _key)
+            )
+            self.__db.commit()
+        return _file, _row[0]
+
+    def new_spool(self):
+        """ return path and opened file for write output of command """
+        _path = os.path.join(self.__dir, os.urandom(16).hex() + ".tmp")
+        return _path, open(_path, 'wb')  # pylint: disable=consider-using-with
+
+    def put(self, _key, _spool_path, _exit_status):
+        """ store written spool as result and evict least recently used results """
+        _size = os.path.getsize(_spool_path)
+        with self.__lock:
+            os.replace(_spool_path, os.path.join(self.__dir, _key))
+            self.__db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (_key, _exit_status, _size, time.time())
+            )
+            _total = self.__db.execute("SELECT SUM(size) FROM results").fetchone()[0]
+            for _old_key, _old_size in self.__db.execute(
+                "SELECT key, size FROM results ORDER BY last_used"
+            ).fetchall():
+                if _total <= self.__max_size:
+                    break
+                self.__db.execute("DELETE FROM results WHERE key = ?", (_old_key,))
+                try:
+                    os.remove(os.path.join(self.__dir, _old_key))
+                except OSError:
+                    pass
+                _total -= _old_size
+            self.__db.commit()
+
+
+class BoResultSpool:
+    """ output of running command written for the result cache while it fits """
+
+    def __init__(self, _result_cache: BoResultCache, _key):
+        self.__result_cache = _result_cache
+        self.__key = _key
+        self.__size = 0
+        self.__path, self.__file = _result_cache.new_spool()
+
+    def write(self, _chunks):
+        """ append chunks of output, too big output is dropped """
+        if self.__file is None:
+            return
+        for _chunk in _chunks:
+            self.__size += len(_chunk)
+            self.__file.write(_chunk)
+        if self.__size > self.__result_cache.get_max_entry_size():
+            self.discard()
+
+    def close(self):
+        """ close file of spool """
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def discard(self):
+        """ remove output which is not stored (too big, or command did not finish) """
+        self.close()
+        if self.__path is not None:
+            try:
+                os.remove(self.__path)
+            except OSError:
+                pass
+            self.__path = None
+
+    def store(self, _exit_status):
+        """ put complete output to the cache """
+        try:
+            if self.__path is not None:
+                self.__result_cache.put(self.__key, self.__path, _exit_status)
+                self.__path = None
+        finally:
+            self.discard()
+
+
+class BoProtocolError(Exception):
+    """ unexpected data from other side """
+
+
+def parse_command_stack(_commands):
+    """
+        steps of configured command: string runs after previous step,
+        dict {name, run, needs: [names of steps above]} runs when its needs are done
+        return list of {name, command, needs: [indexes of steps]}
+    """
+    _steps = []
+    _indexes = {}
+    for _item in _commands:
+        if isinstance(_item, str):
+            _item = {"run": _item, "needs": [_steps[-1]["name"]] if _steps else []}
+        if not isinstance(_item, dict) or not isinstance(_item.get("run"), str):
+            raise ValueError("step should be string or dict with 'run': " + str(_item))
+        _name = str(_item.get("name", len(_steps) + 1))
+        if _name in _indexes:
+            raise ValueError("duplicate step '" + _name + "'")
+        _needs = _item.get("needs", [])
+        if not isinstance(_needs, list):
+            _needs = [_needs]
+        _needs = [str(_need) for _need in _needs]
+        for _need in _needs:
+            if _need not in _indexes:
+                raise ValueError("step '" + _name + "' needs unknown step '" + _need + "'")
+        _indexes[_name] = len(_steps)
+        _steps.append({
+            "name": _name,
+            "command": _item["run"],
+            "needs": [_indexes[_need] for _need in _needs],
+        })
+    if len(_steps) > STACK_MAX_STEPS:
+        raise ValueError("too many steps, maximum is " + str(STACK_MAX_STEPS))
+    return _steps
+
+
+class BoConnection:
+    """
+        Wrapper of socket for exchange messages
+        by protocol 1 (raw text) or protocol 2 (frames)
+    """
+    def __init__(self, _sock):
+        self.__sock = _sock
+        self.__version = 1
+        # time of blocking in send is used for measure of link speed
+        self.__sent_bytes = 0
+        self.__send_seconds = 0.0
+        self.__received_bytes = 0
+        # buffer for receive data, grows while link fills it completely,
+        # allocated on first use so idle connections are cheap
+        self.__recv_buffer = None
+        if _sock.family in (socket.AF_INET, socket.AF_INET6):
+            _sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def get_socket(self):
+        """ return socket """
+        return self.__sock
+
+    def get_version(self):
+        """ return version of protocol """
+        return self.__version
+
+    def set_version(self, _version):
+        """ switch to another version of protocol """
+        self.__version = _version
+
+    def send_message(self, _text):
+        """ send control message (command or response) """
+        if self.__version == 1:
+            self.__sent_bytes += self.__sock.send(_text.encode())
+            return
+        self.send_frame(FRAME_TEXT, _text.encode())
+
+    def recv_message(self):
+        """ receive control message, return empty string if connection closed """
+        if self.__version == 1:
+            _data = self.__sock.recv(1024)
+            self.__received_bytes += len(_data)
+            return _data.decode("utf-8")
+        try:
+            _type, _payload = self.recv_frame()
+        except ConnectionError:
+            return ""
+        if _type != FRAME_TEXT:
+            raise BoProtocolError("Expected text frame but got frame with type " + str(_type))
+        return _payload.decode("utf-8")
+
+    def get_send_stats(self):
+        """ return (sent bytes, seconds spent in send) """
+        return self.__sent_bytes, self.__send_seconds
+
+    def send_frame(self, _type, _payload=b""):
+        """ send one frame (protocol 2) """
+        _start = time.perf_counter()
+        self.__sock.sendall(FRAME_HEADER.pack(_type, len(_payload)) + _payload)
+        self.__send_seconds += time.perf_counter() - _start
+        self.__sent_bytes += FRAME_HEADER.size + len(_payload)
+
+    def recv_frame(self):
+        """ receive one frame (protocol 2), return (type, payload) """
+        _type, _size = self.recv_header()
+        return _type, self.recv_exact(_size)
+
+    def recv_header(self):
+        """ receive header of frame (protocol 2), return (type, size of payload) """
+        _type, _size = FRAME_HEADER.unpack(self.recv_exact(FRAME_HEADER.size))
+        if _size > FRAME_MAX_SIZE:
+            raise BoProtocolError("Too big frame: " + str(_size) + " bytes")
+        return _type, _size
+
+    def recv_payload(self, _size, _callback):
+        """
+            receive payload by chunks into reusable buffer
+            callback gets memoryview which is valid only while call
+        """
+        if self.__recv_buffer is None:
+            self.__recv_buffer = memoryview(bytearray(RECV_BUFFER_MIN_SIZE))
+        while _size > 0:
+            _view = self.__recv_buffer
+            _got = self.__sock.recv_into(_view, min(_size, len(_view)))
+            if _got == 0:
+                raise ConnectionError("Connection closed by other side")
+            self.__received_bytes += _got
+            _callback(_view[:_got])
+            _size -= _got
+            if _got == len(_view) and len(_view) < RECV_BUFFER_MAX_SIZE:
+                self.__recv_buffer = memoryview(bytearray(len(_view) * 2))
+
+    def send_file(self, _file, _size, _from=0):
+        """
+            send content of file from offset as data frames by zero-copy sendfile
+            (socket.sendfile falls back to send where it is not available)
+            return count of sent bytes of file
+        """
+        _offset = _from
+        _start = time.perf_counter()
+        while _offset < _size:
+            _count = min(FRAME_DATA_MAX_SIZE, _size - _offset)
+            self.__sock.sendall(FRAME_HEADER.pack(FRAME_DATA, _count))
+            _sent = self.__sock.sendfile(_file, _offset, _count)
+            self.__sent_bytes += FRAME_HEADER.size + _count
+            if _sent < _count:
+                # file was truncated while sending, keep frame consistent
+                self.__sock.sendall(bytes(_count - _sent))
+                _offset += _sent
+                break
+            _offset += _count
+        self.__send_seconds += time.perf_counter() - _start
+        return _offset - _from
+
+    def recv_exact(self, _size):
+        """ receive exactly size bytes """
+        _buf = bytearray(_size)
+        _view = memoryview(_buf)
+        _pos = 0
+        while _pos < _size:
+            _got = self.__sock.recv_into(_view[_pos:], _size - _pos)
+            if _got == 0:
+                raise ConnectionError("Connection closed by other side")
+            _pos += _got
+        self.__received_bytes += _size
+        return bytes(_buf)
+
+    def close(self):
+        """ close socket, traffic is added to stats """
+        self.__sock.close()
+        STATS.add("bytes_sent", self.__sent_bytes)
+        STATS.add("bytes_received", self.__received_bytes)
+        self.__sent_bytes = 0
+        self.__received_bytes = 0
+
+
+def receive_data_frames(  # pylint: disable=too-many-arguments
+    _conn, _file, _hash=None, _basis=None, _block_size=0, _decompressor=None
+):
+    """
+        receive data frames until end of data (protocol 2)
+        file could be None for skip data
+        basis is previous copy of file for delta transfer
+    """
+    _received = [0]
+
+    def _on_data(_chunk):
+        _received[0] += len(_chunk)
+        if _file is not None:
+            _file.write(_chunk)
+        if _hash is not None:
+            _hash.update(_chunk)
+
+    def _on_chunk(_chunk):
+        if _decompressor is None:
+            _on_data(_chunk)
+        elif _file is not None:
+            _on_data(_decompressor.decompress(_chunk))
+
+    while True:
+        _type, _size = _conn.recv_header()
+        if _type == FRAME_DATA_END:
+            _conn.recv_exact(_size)
+            if _decompressor is not None and _file is not None \
+                    and hasattr(_decompressor, "flush"):
+                _on_data(_decompressor.flush())
+            return _received[0]
+        if _type == FRAME_DELTA_COPY and _basis is not None:
+            _first, _count = DELTA_COPY.unpack(_conn.recv_exact(_size))
+            _basis.seek(_first * _block_size)
+            _left = _count * _block_size
+            while _left > 0:
+                _chunk = _basis.read(min(_left, BUF_READ_SIZE))
+                if not _chunk:
+                    break
+                _left -= len(_chunk)
+                _on_data(_chunk)
+            continue
+        if _type != FRAME_DATA:
+            raise BoProtocolError("Expected data frame but got frame with type " + str(_type))
+        _conn.recv_payload(_size, _on_chunk)
+
+
+def send_file_frames(_conn, _header, _fd, _compression: BoCompressionPolicy, _offset=0):
+    """
+        send FILE message with header and rest of file from offset by data frames
+        (protocol 2): compressed by stream compressor if policy chooses it,
+        by zero-copy sendfile otherwise
+    """
+    _size = os.fstat(_fd.fileno()).st_size
+    _compression.set_link(*_conn.get_send_stats())
+    _fd.seek(_offset)
+    _sample = b""
+    if _size - _offset > COMPRESSION_SAMPLE_SIZE:
+        _sample = _fd.read(COMPRESSION_SAMPLE_SIZE)
+        _fd.seek(_offset)
+    _chosen = _compression.choose(_header["path"], _size - _offset, _sample)
+    if _chosen is None:
+        _conn.send_message("FILE " + json.dumps(_header))
+        _sent = _conn.send_file(_fd, _size, _offset)
+        _compression.on_sent(_sent, _sent)
+        _conn.send_frame(FRAME_DATA_END)
+        return
+    _algo, _level = _chosen
+    _conn.send_message("FILE " + json.dumps(dict(_header, compression=_algo)))
+    _compressor = new_compressor(_algo, _level)
+    _raw = 0
+    _wire = 0
+    _seconds = 0.0
+    while True:
+        _data = _fd.read(COMPRESSION_CHUNK_SIZE)
+        _start = time.perf_counter()
+        _packed = _compressor.compress(_data) if _data else _compressor.flush()
+        _seconds += time.perf_counter() - _start
+        _raw += len(_data)
+        if _packed:
+            _wire += len(_packed)
+            _conn.send_frame(FRAME_DATA, _packed)
+        if not _data:
+            break
+    _conn.send_frame(FRAME_DATA_END)
+    _compression.on_compressed(_level, _raw, _wire, _seconds)
+    _compression.on_sent(_raw, _wire)
 
 
-class BoSocketClient:
+class BoSocketClient:  # pylint: disable=too-many-instance-attributes
     """ Implementation for clietn protocol """
     def __init__(self, config):
         self.__config = config
         self.__hostport = self.__config['server_host'] + ":" + str(self.__config['server_port'])
-        self.__sock = None
+        self.__conn = None
+        self.__delta = {}
+        self.__resume = {}
+        self.__compression = BoCompressionPolicy("none")
+        self.__pack_files = []
+        self.__pack_data = bytearray()
+        self.__packs_in_flight = 0
+        self.__taken = []
+        self.__results = {"accepted": [], "failed": {}}
+        self.__stopped = False
+        self.__exit_status = 1
+        # FORCE_RUN option of kept connection
+        self.__force_run = False
 
     def check_connection(self):
         """ check connection """
@@ -262,46 +2145,80 @@ class BoSocketClient:
             fatal(112, "Exception is " + str(err))
         return True
 
+    def __connect(self, _timeout=None):
+        """ connect to server and negotiate version of protocol """
+        say("Connecting... " + self.__hostport)
+        _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        _sock.settimeout(_timeout)
+        with STATS.timer("connect"):
+            _sock.connect((self.__config['server_host'], self.__config['server_port']))
+        _start = time.perf_counter()
+        self.__conn = BoConnection(_sock)
+        # read full banner, server of protocol 1 does not tell about protocols
+        _banner = ""
+        while not _banner.endswith("target_dir? "):
+            _buf = _sock.recv(1024).decode("utf-8")
+            if not _buf:
+                break
+            _banner += _buf
+        _protocols = []
+        for _line in _banner.split("\n"):
+            if _line.startswith("protocols: "):
+                _protocols = _line[len("protocols: "):].split()
+        _version = self.__config.get("protocol", PROTOCOL_VERSION)
+        if _version > 1 and str(_version) in _protocols:
+            self.__send_command("PROTOCOL " + str(_version))
+            resp = self.__conn.recv_message()
+            if not resp.startswith("ACCEPTED "):
+                fatal(7, "Expected [ACCEPTED] but got [" + str(resp) + "]")
+            self.__conn.set_version(int(resp[len("ACCEPTED "):]))
+        STATS.add_time("handshake", time.perf_counter() - _start)
+        log_debug("Protocol: " + str(self.__conn.get_version()))
+
+    def __send_command(self, command):
+        """ send command without waiting of response """
+        if self.__conn.get_version() == 1:
+            command += "\n"
+        self.__conn.send_message(command)
+
     def __send_param(self, name, value):
         """ send command """
         name = name.strip()
         value = str(value).strip()
         command = name + " " + value
         command = command.strip()
-        print(command)
-        command += "\n"
-        self.__sock.send(command.encode())
-        resp = self.__sock.recv(1024).decode("utf-8")
+        log_debug(command)
+        self.__send_command(command)
+        resp = self.__conn.recv_message()
         accepted = ""
         if len(resp) >= 8:
             accepted = resp[:8]
         # LATER: check value
         if accepted != "ACCEPTED":
             fatal(7, "Expected [ACCEPTED] but got [" + str(resp) + "]")
-        print(resp)
+        log_debug(resp)
 
     def __action_request(self):
         """ action_request """
         command = "ACTION_REQUEST"
-        print(command)
-        command += "\n"
-        self.__sock.send(command.encode())
-        resp = self.__sock.recv(1024).decode("utf-8")
+        log_debug(command)
+        self.__send_command(command)
+        resp = self.__conn.recv_message()
         resp = resp.strip()
-        print(resp)
+        log_debug(resp)
         return resp
 
     def __output_request(self):
         """ OUTPUT_request """
         command = "OUTPUT_REQUEST"
         # print(command)
-        command += "\n"
-        self.__sock.send(command.encode())
-        resp = self.__sock.recv(1024).decode("utf-8")
+        self.__send_command(command)
+        resp = self.__conn.recv_message()
         if resp.startswith("OUTPUT "):
             print(resp[len("OUTPUT "):], end='', sep='')
         if resp.startswith("OUTPUT_FINISHED "):
             print(">>>> Exit status: " + resp[len("OUTPUT_FINISHED "):] + "\n\n", end='', sep='')
+            self.__exit_status = int(resp[len("OUTPUT_FINISHED "):])
             return None
         if resp.startswith("OUTPUT_FAILED "):
             print(">>>> FAILED status: " + resp[len("OUTPUT_FAILED "):] + "\n\n", end='', sep='')
@@ -310,41 +2227,388 @@ class BoSocketClient:
         # print("[" + resp + "]")
         return resp
 
+    def __recv_output(self):
+        """ print output pushed by server until exit frame, return exit status """
+        with STATS.timer("remote_exec"):
+            while True:
+                _type, _payload = self.__conn.recv_frame()
+                if _type == FRAME_OUTPUT:
+                    sys.stdout.buffer.write(_payload)
+                    sys.stdout.buffer.flush()
+                elif _type == FRAME_EXIT:
+                    _status = EXIT_STATUS.unpack(_payload)[0]
+                    print(">>>> Exit status: " + str(_status) + "\n\n", end='', sep='')
+                    return _status
+                elif _type == FRAME_TEXT:
+                    _message = _payload.decode("utf-8")
+                    if not _message.startswith("OUTPUT_FAILED "):
+                        raise BoProtocolError(
+                            "Expected [OUTPUT_FAILED] but got [" + _message[:200] + "]"
+                        )
+                    _reason = _message[len("OUTPUT_FAILED "):]
+                    print(">>>> FAILED status: " + _reason + "\n\n", end='', sep='')
+                    return 1
+                else:
+                    raise BoProtocolError("Unexpected frame with type " + str(_type))
+
+    def __recv_stack_output(self, _steps):
+        """ print output of steps prefixed by step name until exit frame, return exit status """
+        _prefixes = [("[" + _step["name"] + "] ").encode("utf-8") for _step in _steps]
+        # incomplete last line of every step
+        _tails = {}
+        _finished = set()
+        with STATS.timer("remote_exec"):
+            while True:
+                _type, _payload = self.__conn.recv_frame()
+                if _type == FRAME_STEP_OUTPUT:
+                    _index = STEP_ID.unpack_from(_payload)[0]
+                    _lines = (_tails.pop(_index, b"") + _payload[STEP_ID.size:]).split(b"\n")
+                    _tails[_index] = _lines.pop()
+                    sys.stdout.buffer.write(b"".join(
+                        _prefixes[_index] + _line + b"\n" for _line in _lines
+                    ))
+                    sys.stdout.buffer.flush()
+                elif _type == FRAME_STEP_EXIT:
+                    _index, _status = STEP_EXIT_STATUS.unpack(_payload)
+                    _finished.add(_index)
+                    if _tails.get(_index):
+                        sys.stdout.buffer.write(_prefixes[_index] + _tails[_index] + b"\n")
+                    _tails.pop(_index, None)
+                    sys.stdout.flush()
+                    print(">>>> [" + _steps[_index]["name"] + "] Exit status: " + str(_status))
+                elif _type == FRAME_EXIT:
+                    for _index, _step in enumerate(_steps):
+                        if _index not in _finished:
+                            print(">>>> [" + _step["name"] + "] Skipped")
+                    _status = EXIT_STATUS.unpack(_payload)[0]
+                    print(">>>> Exit status: " + str(_status) + "\n\n", end='', sep='')
+                    return _status
+                else:
+                    raise BoProtocolError("Unexpected frame with type " + str(_type))
+
+    def __send_chunk(self, _data):
+        """ send chunk of file data """
+        if self.__conn.get_version() == 1:
+            self.__conn.get_socket().sendall(_data)
+        else:
+            self.__conn.send_frame(FRAME_DATA, _data)
+
     def __send_file(self, _filepath):
         """ send file """
-        print("SEND FILE " + _filepath)
+        log_debug("SEND FILE " + _filepath)
         with open(_filepath, 'rb') as _file:
             while True:
                 data = _file.read(SEND_BUFFER_SIZE)
                 if not data:
                     break
-                self.__sock.send(data)
-        self.__sock.send("".encode())
-        resp = self.__sock.recv(1024).decode("utf-8")
+                self.__send_chunk(data)
+        self.__wait_accepted()
+
+    def __send_data(self, _data):
+        """ send data from memory """
+        for _pos in range(0, len(_data), SEND_BUFFER_SIZE):
+            self.__send_chunk(_data[_pos:_pos + SEND_BUFFER_SIZE])
+        self.__wait_accepted()
+
+    def __wait_accepted(self):
+        """ wait ACCEPTED after sent file """
+        if self.__conn.get_version() > 1:
+            self.__conn.send_frame(FRAME_DATA_END)
+        resp = self.__conn.recv_message()
         accepted = ""
         if len(resp) >= 8:
             accepted = resp[:8]
         if accepted != "ACCEPTED":
             fatal(8, "Expected [ACCEPTED] but got [" + str(resp) + "]")
-        print(resp)
+        log_debug(resp)
+
+    def __stream_file(self, _file, _fullpath):
+        """ send file without waiting of response (protocol 2) """
+        log_debug("SEND FILE " + _fullpath)
+        _start = time.perf_counter()
+        try:
+            _fd = open(_fullpath, 'rb')  # pylint: disable=consider-using-with
+        except OSError as _err:
+            self.__conn.send_message("FILE " + json.dumps({"path": _file, "skip": str(_err)}))
+            self.__conn.send_frame(FRAME_DATA_END)
+            return
+        with _fd:
+            _offset = self.__resume.get(_file, 0)
+            STATS.add("files_sent")
+            STATS.add("file_bytes_sent", os.fstat(_fd.fileno()).st_size - _offset)
+            if _offset == 0 and _file in self.__delta and self.__stream_delta(_file, _fd):
+                STATS.observe("send_file", time.perf_counter() - _start)
+                return
+            _header = {"path": _file}
+            if _offset > 0:
+                log_debug("Resume from " + str(_offset) + " bytes")
+                _header["offset"] = _offset
+            send_file_frames(self.__conn, _header, _fd, self.__compression, _offset)
+        STATS.observe("send_file", time.perf_counter() - _start)
+
+    def __stream_delta(self, _file, _fd):
+        """ send only changed parts of file, return False if it is better to send full file """
+        _signature = self.__delta[_file]
+        _size = os.fstat(_fd.fileno()).st_size
+        if _size == 0:
+            return False
+        with mmap.mmap(_fd.fileno(), 0, access=mmap.ACCESS_READ) as _data:
+            _ops = delta_ops(_data, _signature)
+            if _ops is None:
+                say("Delta: too many changes, send full file")
+                return False
+            self.__conn.send_message("FILE " + json.dumps({"path": _file, "delta": True}))
+            _literal = 0
+            for _op in _ops:
+                if _op[0] == "copy":
+                    self.__conn.send_frame(FRAME_DELTA_COPY, DELTA_COPY.pack(_op[1], _op[2]))
+                    continue
+                _literal += _op[2] - _op[1]
+                for _pos in range(_op[1], _op[2], FRAME_DATA_MAX_SIZE):
+                    _end = min(_pos + FRAME_DATA_MAX_SIZE, _op[2])
+                    self.__conn.send_frame(FRAME_DATA, _data[_pos:_end])
+        self.__conn.send_frame(FRAME_DATA_END)
+        log_debug(
+            "Delta: sent " + str(_literal) + " of " + str(_size) + " bytes "
+            "(block size " + str(_signature["block_size"]) + ")"
+        )
+        return True
+
+    def __add_to_pack(self, _file, _fullpath):
+        """ collect small file to pack """
+        try:
+            with open(_fullpath, 'rb') as _fd:
+                _data = _fd.read()
+        except OSError as _err:
+            self.__pack_files.append({"path": _file, "size": 0, "skip": str(_err)})
+            return
+        self.__pack_files.append({"path": _file, "size": len(_data)})
+        self.__pack_data += _data
+        if len(self.__pack_data) >= PACK_MAX_SIZE or len(self.__pack_files) >= PACK_MAX_FILES:
+            self.__flush_pack()
+
+    def __flush_pack(self):
+        """ send collected small files by one stream """
+        if not self.__pack_files:
+            return
+        _data = bytes(self.__pack_data)
+        log_debug("SEND PACK of " + str(len(self.__pack_files)) + " files")
+        _start = time.perf_counter()
+        STATS.add("files_sent", len(self.__pack_files))
+        STATS.add("file_bytes_sent", len(_data))
+        self.__compression.set_link(*self.__conn.get_send_stats())
+        _compression = self.__compression.choose("", len(_data), _data[:COMPRESSION_SAMPLE_SIZE])
+        self.__conn.send_message("PACK " + json.dumps({
+            "files": self.__pack_files,
+            "compression": None if _compression is None else _compression[0],
+        }))
+        _wire = _data
+        if _compression is not None:
+            _start = time.perf_counter()
+            _compressor = new_compressor(*_compression)
+            _wire = _compressor.compress(_data) + _compressor.flush()
+            self.__compression.on_compressed(
+                _compression[1], len(_data), len(_wire), time.perf_counter() - _start
+            )
+        for _pos in range(0, len(_wire), FRAME_DATA_MAX_SIZE):
+            self.__conn.send_frame(FRAME_DATA, _wire[_pos:_pos + FRAME_DATA_MAX_SIZE])
+        self.__conn.send_frame(FRAME_DATA_END)
+        self.__compression.on_sent(len(_data), len(_wire))
+        STATS.observe("send_pack", time.perf_counter() - _start)
+        self.__pack_files = []
+        self.__pack_data = bytearray()
+        self.__packs_in_flight += 1
+        if self.__packs_in_flight > PACK_WINDOW:
+            self.__recv_pack_done()
+
+    def __send_queue(self, _queue, _files: BoFilesCache):
+        """ send files from queue shared with other streams until it is empty """
+        while True:
+            try:
+                _file = _queue.popleft()
+            except IndexError:
+                break
+            self.__taken.append(_file)
+            _fullpath = os.path.join(self.__config["workdir"], _file)
+            if _file not in self.__delta and _files.has(_file) \
+                    and _files.get(_file)["size"] < PACK_MAX_FILE_SIZE:
+                self.__add_to_pack(_file, _fullpath)
+            else:
+                self.__stream_file(_file, _fullpath)
+        self.__flush_pack()
+        while self.__packs_in_flight > 0:
+            self.__recv_pack_done()
+
+    def join_sync(  # pylint: disable=too-many-arguments
+        self, _session, _queue, _files: BoFilesCache, _delta, _resume, _compression
+    ):
+        """
+            additional stream of batch sync, runs in own thread;
+            if stream failed all files taken by it keep required_sync
+        """
+        self.__delta = _delta
+        self.__resume = _resume
+        self.__compression = _compression
+        try:
+            self.__connect(15)
+            if self.__stopped:
+                raise BoProtocolError("stopped")
+            self.__send_param("TARGET_DIR", self.__config['target_dir'])
+            if self.__conn.get_version() < 2:
+                raise BoProtocolError("Server does not support protocol 2")
+            self.__send_command("SYNC_JOIN " + json.dumps({"session": _session}))
+            _resp = self.__conn.recv_message()
+            if _resp.startswith("SYNC_JOIN_FAILED "):
+                # late stream: session is finished by other streams, queue is empty
+                self.__conn.close()
+                return
+            if not _resp.startswith("SYNC_JOINED "):
+                raise BoProtocolError("Expected [SYNC_JOINED] but got [" + _resp[:200] + "]")
+            self.__send_queue(_queue, _files)
+            self.__send_command("SYNC_BATCH_END")
+            self.__results = self.__recv_response("SYNC_RESULTS")
+            self.__conn.close()
+        except (OSError, BoProtocolError, ValueError, SystemExit) as _err:
+            # fatal() already printed the reason
+            _reason = "stream failed"
+            if not isinstance(_err, SystemExit):
+                _reason += ": " + str(_err)
+            say("Stream " + threading.current_thread().name + " " + _reason)
+            self.__results = {
+                "accepted": [],
+                "failed": {_file: _reason for _file in self.__taken},
+            }
+
+    def stop(self):
+        """ break joined stream from other thread (main stream failed) """
+        self.__stopped = True
+        if self.__conn is not None:
+            try:
+                self.__conn.get_socket().shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def get_server_stats(self):
+        """ return metrics of server process """
+        try:
+            self.__connect(15)
+            if self.__conn.get_version() < 2:
+                fatal(24, "Stats require server with protocol 2")
+            self.__send_command("STATS")
+            _stats = self.__recv_response("STATS")
+            self.__conn.close()
+        except (OSError, BoProtocolError, ValueError) as _err:
+            fatal(24, "Could not get stats of server: " + str(_err))
+        return _stats
+
+    def get_results(self):
+        """ accepted and failed files of joined stream """
+        return self.__results
+
+    def __recv_pack_done(self):
+        """ wait until server wrote the oldest pack """
+        self.__recv_response("PACK_DONE")
+        self.__packs_in_flight -= 1
+
+    def __recv_response(self, _name):
+        """ receive response like NAME <json> """
+        resp = self.__conn.recv_message()
+        if not resp.startswith(_name + " "):
+            fatal(8, "Expected [" + _name + "] but got [" + resp[:200] + "]")
+        return json.loads(resp[len(_name) + 1:])
+
+    def __run_sync_batch(self, _files: BoFilesCache):
+        """
+            sync by protocol 2: one manifest exchange,
+            then all files are sent one by one without waiting
+        """
+        _start = time.perf_counter()
+        self.__send_command("SYNC_BATCH " + json.dumps({
+            "files": _files.get_files_to_update(),
+            "delta_min_size": self.__config.get("delta_min_size", DELTA_MIN_SIZE),
+        }))
+        _manifest = self.__recv_response("SYNC_MANIFEST")
+        self.__delta = _manifest.get("delta", {})
+        self.__resume = _manifest.get("resume", {})
+        self.__compression = BoCompressionPolicy(
+            self.__config.get("compression", "auto"), _manifest.get("compression", [])
+        )
+        for _file in _manifest["deleted"]:
+            if _files.has(_file):
+                _files.remove(_file)
+        for _file in _manifest.get("local", []):
+            if _files.has(_file):
+                _files.update(_file, {"required_sync": "NONE"})
+        _files.resave_cache()
+        print(
+            "Deleted: " + str(len(_manifest["deleted"])) + ", "
+            "created from server content: " + str(len(_manifest.get("local", []))) + ", "
+            "to send: " + str(len(_manifest["send"])) + ", "
+            "resumed: " + str(len(self.__resume))
+        )
+        # biggest files first, so any stream could take the rest of small ones
+        _queue = collections.deque(sorted(
+            _manifest["send"],
+            key=lambda _file: _files.get(_file)["size"] if _files.has(_file) else 0,
+            reverse=True,
+        ))
+        _streams = []
+        if "session" in _manifest:
+            for _ in range(1, min(self.__config.get("streams", 1), len(_queue))):
+                _stream = BoSocketClient(self.__config)
+                _thread = threading.Thread(target=_stream.join_sync, args=(
+                    _manifest["session"], _queue, _files,
+                    self.__delta, self.__resume, self.__compression
+                ))
+                _thread.start()
+                _streams.append((_stream, _thread))
+        try:
+            self.__send_queue(_queue, _files)
+            self.__send_command("SYNC_BATCH_END")
+            _results = self.__recv_response("SYNC_RESULTS")
+        except BaseException:
+            # fatal() should not leave streams running
+            _queue.clear()
+            for _stream, _thread in _streams:
+                _stream.stop()
+                _thread.join()
+            raise
+        for _stream, _thread in _streams:
+            _thread.join()
+            _results["accepted"] += _stream.get_results()["accepted"]
+            _results["failed"].update(_stream.get_results()["failed"])
+        for _file in _results["accepted"]:
+            if _files.has(_file):
+                _files.update(_file, {"required_sync": "NONE"})
+        _failed = dict(_manifest["failed"], **_results["failed"])
+        STATS.add_time("transfer", time.perf_counter() - _start)
+        for _file, _reason in _failed.items():
+            print("FAILED " + _file + ": " + _reason)
+        _files.resave_cache()
+        print(
+            "Accepted: " + str(len(_results["accepted"])) + ", "
+            "failed: " + str(len(_failed))
+        )
+        print(self.__compression.report())
 
     def run_sync(self, _files: BoFilesCache):
-        """ run sync """
-        cache_md5 = md5_by_file(_files.get_cache_path_to_update())
-        cache_size = os.path.getsize(_files.get_cache_path_to_update())
-        try:
-            print("Connecting... " + self.__hostport)
-            self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.__sock.settimeout(15)
-            self.__sock.connect((self.__config['server_host'], self.__config['server_port']))
-            _ = self.__sock.recv(1024).decode("utf-8")
+        """ run sync, errors are reported by fatal() """
+        try:
+            self.__connect(15)
             self.__send_param("TARGET_DIR", self.__config['target_dir'])
+            if self.__conn.get_version() > 1:
+                self.__run_sync_batch(_files)
+                self.__conn.close()
+                return
+            cache_data = _files.dump_files_to_update(True)
+            cache_md5 = hashlib.md5(cache_data).hexdigest()
+            cache_size = len(cache_data)
             self.__send_param("CACHE_MD5", cache_md5)
             self.__send_param("CACHE_SIZE", cache_size)
             self.__send_param("SEND_BUFFER_SIZE", SEND_BUFFER_SIZE)
             self.__send_param("CACHE_SEND", 1)
             print("Sending cache... ")
-            self.__send_file(_files.get_cache_path_to_update())
+            self.__send_data(cache_data)
 
             _action = self.__action_request()
             while _action != "ACTIONS_COMPLETED":
@@ -355,7 +2619,7 @@ class BoSocketClient:
                     _files.resave_cache()
                 elif _action.startswith("ACTION_SEND_ME_FILE "):
                     _file = _action[len("ACTION_SEND_ME_FILE "):]
-                    _fullpath = os.path.join(BO_WORKDIR, _file)
+                    _fullpath = os.path.join(self.__config["workdir"], _file)
                     self.__send_file(_fullpath)
                     _files.update(_file, {"required_sync": "NONE"})
                 else:
@@ -367,7 +2631,7 @@ class BoSocketClient:
             # _ = s.recv(1024).decode("utf-8")
             # s.send(str(flag + "\n").encode())
             # _ = s.recv(1024).decode("utf-8")
-            self.__sock.close()
+            self.__conn.close()
         except socket.timeout:
             fatal(8, "Socket timeout")
         except socket.error as serr:
@@ -379,22 +2643,212 @@ class BoSocketClient:
         except Exception as err:  # pylint: disable=broad-except
             fatal(11, "Exception is " + str(err))
             # self.__sock = None
-        sys.exit(0)
 
-    def run_command(self, _subdir, _command):
-        """ Run remote command """
+    def run_watch(self, _files: BoFilesCache, _watcher):
+        """ keep connection and sync files changed in workdir """
+        while True:
+            try:
+                self.__connect(15)
+                self.__send_param("TARGET_DIR", self.__config['target_dir'])
+                if self.__conn.get_version() < 2:
+                    fatal(15, "Watch mode requires server with protocol 2")
+                while True:
+                    if _files.get_files_to_update():
+                        self.__run_sync_batch(_files)
+                    print("Watching for changes...")
+                    _changed, _dirs = _watcher.wait_changes()
+                    _start = time.time()
+                    _changes = _files.rescan_paths(self.__config["workdir"], _changed, _dirs)
+                    _files.resave_cache()
+                    print(
+                        "Changes: " + str(_changes) + ", rescan elapsed " +
+                        str(round(time.time() - _start, 3)) + " sec"
+                    )
+            except KeyboardInterrupt:
+                print("Bye!")
+                _watcher.close()
+                if self.__conn is not None:
+                    self.__conn.close()
+                return
+            except (OSError, BoProtocolError, ValueError, SystemExit) as _err:
+                if self.__conn is not None:
+                    self.__conn.close()
+                print(
+                    "Connection lost (" + str(_err) + "), reconnect in " +
+                    str(WATCH_RECONNECT_DELAY) + " sec"
+                )
+                time.sleep(WATCH_RECONNECT_DELAY)
+
+    def __receive_artifact(self, _header, _files: BoFilesCache, _workdir):
+        """ receive pulled file into workdir through temporary file, return error or None """
+        _file = _header["path"]
+        _fullpath = os.path.normpath(os.path.join(_workdir, _file))
+        if "skip" in _header or os.path.isabs(_file) \
+                or not _fullpath.startswith(os.path.join(_workdir, "")):
+            receive_data_frames(self.__conn, None)
+            return _header.get("skip", "wrong path")
+        log_debug("RECEIVE FILE " + _fullpath)
+        _start = time.perf_counter()
+        _hash = hashlib.new(_files.get_hash_algo())
+        _tmp = _fullpath + ".bo-pull"
+        try:
+            os.makedirs(os.path.dirname(_fullpath), exist_ok=True)
+            _fd = open(_tmp, 'wb')  # pylint: disable=consider-using-with
+        except OSError as _err:
+            receive_data_frames(self.__conn, None)
+            return str(_err)
+        with _fd:
+            _compression = _header.get("compression")
+            receive_data_frames(
+                self.__conn, _fd, _hash, None, 0,
+                None if _compression is None else new_decompressor(_compression)
+            )
+            STATS.add("files_received")
+            STATS.add("file_bytes_received", _fd.tell())
+        STATS.observe("receive_file", time.perf_counter() - _start)
+        if _hash.hexdigest() != _header["hash"]:
+            os.remove(_tmp)
+            return "WRONG_HASH expected " + _header["hash"] + " got " + _hash.hexdigest()
+        os.replace(_tmp, _fullpath)
+        _files.add(_file, _fullpath, None, _header["hash"])
+        _files.update(_file, {"required_sync": "NONE"})
+        return None
+
+    @staticmethod
+    def __pulled_hashes(_files: BoFilesCache, _workdir):
+        """
+            hashes of pulled files which are not changed locally since the last pull,
+            entries of removed files are forgotten
+        """
+        _have = {}
+        for _file, _fileinfo in list(_files.get_files().items()):
+            try:
+                _stat = BoScannedFile(os.stat(os.path.join(_workdir, _file)))
+            except OSError:
+                _files.remove(_file)
+                continue
+            if _stat.fingerprint() == _fileinfo.get("fingerprint") \
+                    and get_file_hash(_fileinfo)[0] == _files.get_hash_algo():
+                _have[_file] = _fileinfo["hash"]
+        return _have
+
+    def run_pull(self, _patterns, _files: BoFilesCache, _workdir):
+        """
+            download artifacts matched by patterns on server which are changed,
+            files cache keeps hashes of pulled files; return count of failed files
+        """
+        _failed = {}
+        try:
+            self.__connect(15)
+            self.__send_param("TARGET_DIR", self.__config['target_dir'])
+            if self.__conn.get_version() < 2:
+                fatal(19, "Pull requires server with protocol 2")
+            self.__send_command("PULL " + json.dumps({
+                "patterns": _patterns,
+                "files": self.__pulled_hashes(_files, _workdir),
+                "hash_algo": _files.get_hash_algo(),
+                "compression": self.__config.get("compression", "auto"),
+            }))
+            _manifest = self.__recv_response("PULL_MANIFEST")
+            print(
+                "Found: " + str(len(_manifest["files"])) + ", "
+                "to download: " + str(len(_manifest["send"]))
+            )
+            with STATS.timer("transfer"):
+                for _ in _manifest["send"]:
+                    _header = self.__recv_response("FILE")
+                    _error = self.__receive_artifact(_header, _files, _workdir)
+                    if _error is not None:
+                        _failed[_header["path"]] = _error
+                self.__recv_response("PULL_DONE")
+            self.__conn.close()
+            for _file, _reason in _failed.items():
+                print("FAILED " + _file + ": " + _reason)
+            print(
+                "Downloaded: " + str(len(_manifest["send"]) - len(_failed)) + ", "
+                "failed: " + str(len(_failed))
+            )
+        except socket.timeout:
+            fatal(8, "Socket timeout")
+        except socket.error as serr:
+            if serr.errno == errno.ECONNREFUSED:
+                fatal(9, "Connection refused")
+            else:
+                print(serr)
+                fatal(10, "Socker error " + str(serr))
+        except Exception as err:  # pylint: disable=broad-except
+            fatal(11, "Exception is " + str(err))
+        finally:
+            _files.resave_cache()
+        return len(_failed)
+
+    def __ensure_connection(self):
+        """
+            connect or reuse connection kept by agent,
+            idle kept connection is readable only if server closed it
+        """
+        if self.__conn is not None:
+            if not select.select([self.__conn.get_socket()], [], [], 0)[0]:
+                return
+            self.__conn.close()
+            self.__conn = None
+        self.__connect(15)
+        self.__force_run = False
+        self.__send_param("TARGET_DIR", self.__config['target_dir'])
+        if self.__conn.get_version() < 2:
+            fatal(20, "Agent requires server with protocol 2")
+
+    def __drop_connection(self):
+        """ close kept connection after error """
+        if self.__conn is not None:
+            self.__conn.close()
+            self.__conn = None
+
+    def sync_kept(self, _files: BoFilesCache):
+        """ batch sync by connection kept between calls (agent) """
+        try:
+            self.__ensure_connection()
+            self.__conn.get_socket().settimeout(15)
+            self.__run_sync_batch(_files)
+        except (OSError, BoProtocolError, ValueError, SystemExit):
+            self.__drop_connection()
+            raise
+
+    def run_command_kept(self, _subdir, _command, _force_run=False):
+        """ run remote command by connection kept between calls (agent), return exit status """
+        try:
+            self.__ensure_connection()
+            self.__conn.get_socket().settimeout(None)
+            self.__send_param("SUB_DIR", _subdir)
+            if _force_run != self.__force_run:
+                self.__send_param("FORCE_RUN", 1 if _force_run else 0)
+                self.__force_run = _force_run
+            self.__send_param("RUN_COMMAND_STREAM", json.dumps(_command))
+            return self.__recv_output()
+        except (OSError, BoProtocolError, ValueError, SystemExit):
+            self.__drop_connection()
+            raise
+
+    def run_command(self, _subdir, _command, _force_run=False):
+        """
+            Run remote command, return its exit status
+            force_run - do not use cached result of previous run
+        """
         try:
-            print("Connecting... " + self.__hostport)
-            self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # self.__sock.settimeout(15)
-            self.__sock.connect((self.__config['server_host'], self.__config['server_port']))
-            _ = self.__sock.recv(1024).decode("utf-8")
+            self.__connect()
             self.__send_param("TARGET_DIR", self.__config['target_dir'])
             self.__send_param("SUB_DIR", _subdir)
-            self.__send_param("RUN_COMMAND", json.dumps(_command))
-            _output = self.__output_request()
-            while _output is not None:
+            if self.__conn.get_version() > 1:
+                if _force_run:
+                    self.__send_param("FORCE_RUN", 1)
+                self.__send_param("RUN_COMMAND_STREAM", json.dumps(_command))
+                self.__exit_status = self.__recv_output()
+            else:
+                self.__send_param("RUN_COMMAND", json.dumps(_command))
                 _output = self.__output_request()
+                while _output is not None:
+                    _output = self.__output_request()
+            self.__conn.close()
         except socket.timeout:
             fatal(8, "Socket timeout")
         except socket.error as serr:
@@ -406,6 +2860,37 @@ class BoSocketClient:
         except Exception as err:  # pylint: disable=broad-except
             fatal(11, "Exception is " + str(err))
             # self.__sock = None
+        return self.__exit_status
+
+    def run_stack(self, _subdir, _steps, _files=None, _fail_fast=True):
+        """
+            Run steps of command stack by one connection, files are synced
+            before in the same session if given; return exit status
+        """
+        try:
+            self.__connect(15)
+            self.__send_param("TARGET_DIR", self.__config['target_dir'])
+            if self.__conn.get_version() < 2:
+                fatal(18, "Command stacks require server with protocol 2")
+            if _files is not None:
+                self.__run_sync_batch(_files)
+            # steps could be silent for long time
+            self.__conn.get_socket().settimeout(None)
+            self.__send_param("SUB_DIR", _subdir)
+            self.__send_param("RUN_STACK", json.dumps({"steps": _steps, "fail_fast": _fail_fast}))
+            self.__exit_status = self.__recv_stack_output(_steps)
+            self.__conn.close()
+        except socket.timeout:
+            fatal(8, "Socket timeout")
+        except socket.error as serr:
+            if serr.errno == errno.ECONNREFUSED:
+                fatal(9, "Connection refused")
+            else:
+                print(serr)
+                fatal(10, "Socker error " + str(serr))
+        except Exception as err:  # pylint: disable=broad-except
+            fatal(11, "Exception is " + str(err))
+        return self.__exit_status
 
 
 class BoCommand:
@@ -437,148 +2922,953 @@ class BoCommand:
         return self.__command
 
 
-class BoServerSocketHandler(threading.Thread):
+class BoStackRunner:  # pylint: disable=too-many-instance-attributes,too-few-public-methods
     """
-        handler for process connection in different thread
+        runs steps of command stack on server: steps with done needs are started
+        in parallel, output of all steps is pushed by one connection;
+        with fail fast the first failed step stops all the others
     """
-    def __init__(self, _sock, _addr, _server):
-        self.__sock = _sock
+
+    def __init__(self, _conn, _cwd, _steps, _fail_fast=True):
+        self.__conn = _conn
+        self.__cwd = _cwd
+        self.__steps = _steps
+        self.__fail_fast = _fail_fast
+        # (step, chunk), empty chunk - end of output; bounded like output of one command
+        self.__events = queue.Queue(OUTPUT_QUEUE_CHUNKS)
+        self.__procs = {}
+        # step -> exit status, None while running
+        self.__done = {}
+        self.__status = 0
+        # time when cancelled steps are killed if they ignore SIGTERM
+        self.__kill_at = None
+
+    def __start(self, _index):
+        """ start process of step and reader of its output """
+        _cmds = [self.__steps[_index]["command"]]
+        if is_linux():
+            _cmds = ['sh', '-c'] + _cmds
+        if is_windows():
+            _cmds = ['cmd', '/c'] + _cmds
+        # own process group, so cancel stops children of shell too
+        _proc = start_process(_cmds, self.__cwd, not is_windows())
+        self.__procs[_index] = _proc
+
+        def _reader():
+            with _proc.stdout:
+                while True:
+                    _chunk = os.read(_proc.stdout.fileno(), OUTPUT_CHUNK_SIZE)
+                    self.__events.put((_index, _chunk))
+                    if not _chunk:
+                        break
+
+        threading.Thread(target=_reader, daemon=True).start()
+
+    def __cancel(self):
+        """ SIGTERM to all running steps, they are killed after timeout """
+        for _proc in self.__procs.values():
+            kill_process_group(_proc)
+        self.__kill_at = time.monotonic() + STACK_STOP_TIMEOUT
+
+    def __kill(self):
+        """ SIGKILL to steps which are still running after cancel """
+        for _proc in self.__procs.values():
+            kill_process_group(_proc, True)
+        self.__kill_at = None
+
+    def __stop_all(self):
+        """ cancel running steps and wait for all of them """
+        import subprocess  # pylint: disable=import-outside-toplevel
+        if not self.__procs:
+            return
+        self.__cancel()
+        _deadline = self.__kill_at
+        for _proc in self.__procs.values():
+            try:
+                _proc.wait(max(0.0, _deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                self.__kill()
+                _proc.wait()
+        # let readers put the rest of output and finish
+        _reading = set(self.__procs)
+        self.__procs = {}
+        try:
+            while _reading:
+                _index, _chunk = self.__events.get(timeout=STACK_STOP_TIMEOUT)
+                if not _chunk:
+                    _reading.discard(_index)
+        except queue.Empty:
+            pass
+
+    def __finish(self, _index, _returncode):
+        """ send exit status of step, the first failed one cancels others with fail fast """
+        self.__done[_index] = _returncode
+        self.__conn.send_frame(FRAME_STEP_EXIT, STEP_EXIT_STATUS.pack(_index, _returncode))
+        if _returncode != 0 and self.__status == 0:
+            self.__status = _returncode
+            if self.__fail_fast:
+                self.__cancel()
+
+    def __start_ready(self):
+        """ start steps which needs are done successfully """
+        for _index, _step in enumerate(self.__steps):
+            if self.__status != 0 and self.__fail_fast:
+                break
+            if len(self.__procs) >= STACK_MAX_PARALLEL:
+                break
+            if _index in self.__done:
+                continue
+            if all(self.__done.get(_need) == 0 for _need in _step["needs"]):
+                self.__done[_index] = None
+                try:
+                    self.__start(_index)
+                except OSError as _err:
+                    self.__conn.send_frame(
+                        FRAME_STEP_OUTPUT,
+                        STEP_ID.pack(_index) + (str(_err) + "\n").encode("utf-8")
+                    )
+                    self.__finish(_index, 127)
+
+    def run(self):
+        """ run all steps, return 0 or exit status of the first failed step """
+        try:
+            self.__start_ready()
+            while self.__procs:
+                try:
+                    _index, _chunk = self.__events.get(timeout=(
+                        None if self.__kill_at is None
+                        else max(0.0, self.__kill_at - time.monotonic())
+                    ))
+                except queue.Empty:
+                    self.__kill()
+                    continue
+                if _chunk:
+                    self.__conn.send_frame(FRAME_STEP_OUTPUT, STEP_ID.pack(_index) + _chunk)
+                    continue
+                self.__finish(_index, self.__procs.pop(_index).wait())
+                self.__start_ready()
+        finally:
+            # steps left after client is disconnected
+            self.__stop_all()
+        return self.__status
+
+
+def temp_path(_path):
+    """ unique temporary file next to path, it is renamed into place when complete """
+    return _path + ".bo-tmp-" + os.urandom(4).hex()
+
+
+def fsync_path(_path):
+    """ write data of closed file to disk before it is renamed into place, return error """
+    try:
+        with open(_path, 'rb+') as _fd:
+            os.fsync(_fd.fileno())
+    except OSError as _err:
+        return str(_err)
+    return None
+
+
+def fsync_dir(_path):
+    """ make renames in directory durable (directories could not be opened on windows) """
+    if is_windows():
+        return
+    try:
+        _fd = os.open(_path, os.O_RDONLY)
+        try:
+            os.fsync(_fd)
+        finally:
+            os.close(_fd)
+    except OSError as _err:
+        print("Could not flush directory " + _path + ": " + str(_err))
+
+
+class BoStreamWriter:
+    """
+        file object for receive_data_frames: received chunks are queued
+        and written to file by a thread of BoFileWriter
+    """
+
+    def __init__(self, _fd):
+        self.__fd = _fd
+        self.__chunks = queue.Queue(SERVER_WRITER_QUEUE)
+
+    def write(self, _chunk):
+        """ queue copy of chunk (buffer of connection is reused) """
+        self.__chunks.put(bytes(_chunk))
+
+    def finish(self, _action):
+        """ end of file: 'commit', 'keep' (for resume) or 'discard' """
+        self.__chunks.put(_action)
+
+    def drain(self):
+        """ write chunks until finish(), return action and error of writing """
+        _error = None
+        while True:
+            _chunk = self.__chunks.get()
+            if not isinstance(_chunk, bytes):
+                return _chunk, _error
+            if _error is None:
+                try:
+                    self.__fd.write(_chunk)
+                except OSError as _err:
+                    # keep reading of queue, so receiving is not blocked
+                    _error = str(_err)
+
+
+class BoFileWriter:
+    """
+        writes files received by one server connection in background threads,
+        so the next data is received while previous files land on disk;
+        files are written into temporary files, which wait for sync() at the end
+        of session: then they are flushed by fsync in parallel and renamed into
+        place in one pass, results (file, info, error) are reported by callback
+    """
+
+    def __init__(self, _on_done):
+        import concurrent.futures  # pylint: disable=import-outside-toplevel
+        self.__pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=SERVER_WRITER_THREADS, thread_name_prefix="bo-writer"
+        )
+        self.__on_done = _on_done
+        self.__futures = []
+        # (tmp, fullpath, file, info) of checked files waiting for sync()
+        self.__pending = []
+        self.__lock = threading.Lock()
+
+    def write_files(self, _files):
+        """ write checked content, files is list of (file, info, fullpath, content) """
+        self.__submit(self.__write_files, _files)
+
+    def open_stream(self, _file, _info, _fd, _path, _fullpath):
+        """
+            file object for receiving into opened fd of path,
+            path is moved to fullpath by sync() if stream is finished by 'commit'
+        """
+        _stream = BoStreamWriter(_fd)
+        self.__submit(self.__write_stream, _file, _info, _stream, _fd, _path, _fullpath)
+        return _stream
+
+    def wait(self):
+        """ wait until queued files are written """
+        with self.__lock:
+            _futures, self.__futures = self.__futures, []
+        for _future in _futures:
+            _future.result()
+
+    def sync(self):
+        """ wait for queued files, move all written files into place and report them """
+        self.wait()
+        with self.__lock:
+            _pending, self.__pending = self.__pending, []
+        if not _pending:
+            return
+        _errors = self.commit([(_tmp, _fullpath) for _tmp, _fullpath, _, _ in _pending])
+        self.__on_done([
+            (_file, _info, _error) for (_, _, _file, _info), _error in zip(_pending, _errors)
+        ])
+
+    def commit(self, _files):
+        """
+            fsync temporary files in parallel, rename them into place and flush
+            their directories, files is list of (tmp, fullpath), return errors
+        """
+        with STATS.timer("fsync"):
+            _errors = list(self.__pool.map(fsync_path, [_tmp for _tmp, _ in _files]))
+        _dirs = set()
+        for _index, (_tmp, _fullpath) in enumerate(_files):
+            if _errors[_index] is None:
+                try:
+                    os.replace(_tmp, _fullpath)
+                    _dirs.add(os.path.dirname(_fullpath))
+                    continue
+                except OSError as _err:
+                    _errors[_index] = str(_err)
+            if os.path.exists(_tmp):
+                os.remove(_tmp)
+        with STATS.timer("fsync"):
+            list(self.__pool.map(fsync_dir, _dirs))
+        return _errors
+
+    def close(self):
+        """ finish queued files (they are indexed for next sync) and stop threads """
+        try:
+            self.sync()
+        finally:
+            self.__pool.shutdown()
+
+    def __submit(self, _job, *_args):
+        _future = self.__pool.submit(self.__run, _job, _args)
+        with self.__lock:
+            self.__futures.append(_future)
+
+    def __run(self, _job, _args):
+        _pending, _failed = _job(*_args)
+        with self.__lock:
+            self.__pending += _pending
+        if _failed:
+            self.__on_done(_failed)
+
+    @staticmethod
+    def __write_files(_files):
+        """ write all files into temporary files, return (pending, failed) """
+        _pending = []
+        _failed = []
+        with STATS.timer("disk_write"):
+            for _file, _info, _fullpath, _content in _files:
+                _tmp = temp_path(_fullpath)
+                try:
+                    with open(_tmp, 'wb') as _fd:
+                        _fd.write(_content)
+                    _pending.append((_tmp, _fullpath, _file, _info))
+                except OSError as _err:
+                    if os.path.exists(_tmp):
+                        os.remove(_tmp)
+                    _failed.append((_file, _info, str(_err)))
+        return _pending, _failed
+
+    @staticmethod
+    def __write_stream(  # pylint: disable=too-many-arguments
+        _file, _info, _stream: BoStreamWriter, _fd, _path, _fullpath
+    ):
+        """ write queued chunks into opened file, return (pending, failed) """
+        with _fd:
+            _action, _error = _stream.drain()
+            if _action == "commit" and _error is None \
+                    and os.path.dirname(_path) != os.path.dirname(_fullpath):
+                # complete partial file leaves partial dir while it is still locked,
+                # so it is not resumed or removed as stale before sync()
+                _tmp = temp_path(_fullpath)
+                try:
+                    os.replace(_path, _tmp)
+                    _path = _tmp
+                except OSError as _err:
+                    _error = str(_err)
+        if _action == "keep":
+            # partial file of interrupted transfer
+            return [], []
+        if _action == "commit" and _error is None:
+            return [(_path, _fullpath, _file, _info)], []
+        if os.path.exists(_path):
+            os.remove(_path)
+        if _action != "commit":
+            # failure is reported by receiving thread
+            return [], []
+        return [], [(_file, _info, _error)]
+
+
+class BoServerProtocol:  # pylint: disable=too-many-instance-attributes
+    """
+        state of one client connection on the server side,
+        commands are processed one by one by process_command()
+    """
+    def __init__(self, _conn, _addr, _server):
+        self.__conn = _conn
         self.__addr = _addr
-        self.__is_kill = False
         self.__send_buffer_size = 512
         self.__options = {}
         self.__server = _server
         self.__cache = {}
+        self.__batch = {"accepted": [], "failed": {}}
+        self.__batch_lock = threading.Lock()
+        self.__writer = None
+        self.__delta_block_sizes = {}
+        self.__created_dirs = set()
+        self.__session = None
+        self.__content_index = _server.get_content_index()
         print("Connected from " + str(self.__addr))
-        threading.Thread.__init__(self)
+        self.__handlers = {
+            "TARGET_DIR": self.__handle_command_target_dir,
+            "SUB_DIR": self.__handle_command_sub_dir,
+            "CACHE_MD5": self.__handle_command_cache_md5,
+            "SEND_BUFFER_SIZE": self.__handle_command_send_buffer_size,
+            "CACHE_SIZE": self.__handle_command_cache_size,
+            "CACHE_SEND": self.__handle_command_cache_send,
+            "ACTION_REQUEST": self.__handle_command_action_request,
+            "RUN_COMMAND": self.__handle_command_run_command,
+            "RUN_COMMAND_STREAM": self.__handle_command_run_command_stream,
+            "RUN_STACK": self.__handle_command_run_stack,
+            "FORCE_RUN": self.__handle_command_force_run,
+            "PULL": self.__handle_command_pull,
+            "PROTOCOL": self.__handle_command_protocol,
+            "SYNC_BATCH": self.__handle_command_sync_batch,
+            "FILE": self.__handle_command_file,
+            "SYNC_BATCH_END": self.__handle_command_sync_batch_end,
+            "PACK": self.__handle_command_pack,
+            "SYNC_JOIN": self.__handle_command_sync_join,
+            "STATS": self.__handle_command_stats,
+        }
 
-    def __receive_file(self, filepath, file_md5, file_size):
-        """ __process_command_get """
-        print(
-            "Receiving file... " + filepath + " (" + str(file_size) + " bytes) " +
+    def __receive_file(  # pylint: disable=too-many-arguments
+        self, _out, file_md5, file_size, hash_algo="md5", _pending=None
+    ):
+        """
+            receive file into path or file object, hash is computed while bytes arrive,
+            path is written into temporary file, (tmp, path) is added to pending
+            after check and is moved into place by BoFileWriter.commit()
+        """
+        log_debug(
+            "Receiving file... " + str(_out) + " (" + str(file_size) + " bytes) " +
             "per " + str(self.__send_buffer_size) + " bytes"
         )
-        _received_bytes = 0
-        with open(filepath, 'wb') as _file:
+        _hash = hashlib.new(hash_algo if hash_algo in HASH_ALGOS else "md5")
+        _tmp = None
+        _file = _out
+        if isinstance(_out, str):
+            _tmp = temp_path(_out)
+            _file = open(_tmp, 'wb')  # pylint: disable=consider-using-with
+        try:
+            _received_bytes = 0
+            if self.__conn.get_version() > 1:
+                _received_bytes = receive_data_frames(self.__conn, _file, _hash)
             while _received_bytes < file_size:
-                data = self.__sock.recv(self.__send_buffer_size)
+                data = self.__conn.get_socket().recv(self.__send_buffer_size)
                 if len(data) > 0:
                     _received_bytes += len(data)
                     _file.write(data)
+                    _hash.update(data)
                 else:
                     break
-        got_file_md5 = md5_by_file(filepath)
-        if file_md5 != got_file_md5:
-            self.__sock.send("WRONG_MD5".encode())
+        finally:
+            if _tmp is not None:
+                _file.close()
+        if hash_algo not in HASH_ALGOS or file_md5 != _hash.hexdigest():
+            if _tmp is not None:
+                os.remove(_tmp)
+            if hash_algo not in HASH_ALGOS:
+                self.__conn.send_message("WRONG_HASH_ALGO")
+                print("WRONG_HASH_ALGO " + str(hash_algo))
+                return False
+            self.__conn.send_message("WRONG_MD5")
             print("WRONG_MD5")
             print("Expected: " + file_md5)
-            print("Got: " + got_file_md5)
+            print("Got: " + _hash.hexdigest())
             return False
-        print("Done")
-        self.__sock.send("ACCEPTED".encode())
+        if _tmp is not None:
+            _pending.append((_tmp, _out))
+        log_debug("Done")
+        self.__conn.send_message("ACCEPTED")
         return True
 
+    def __partial_path(self, _info):
+        """ where big file is received before it is complete """
+        _hash_algo, _hash = get_file_hash(_info)
+        return os.path.join(
+            self.__options["target_dir"], PARTIAL_DIR, _hash_algo + "-" + _hash
+        )
+
+    def __remove_stale_partials(self):
+        """ remove partial files which are not requested anymore """
+        _partial_dir = os.path.join(self.__options["target_dir"], PARTIAL_DIR)
+        if not os.path.isdir(_partial_dir):
+            return
+        _requested = set()
+        for _info in self.__cache.values():
+            if _info['required_sync'] == 'UPDATE':
+                _requested.add(os.path.basename(self.__partial_path(_info)))
+        for _name in os.listdir(_partial_dir):
+            # locked file is being received by other connection
+            if _name not in _requested \
+                    and not is_file_locked(os.path.join(_partial_dir, _name)):
+                try:
+                    os.remove(os.path.join(_partial_dir, _name))
+                except OSError as _err:
+                    print("Could not remove partial file " + _name + ": " + str(_err))
+        try:
+            if not os.listdir(_partial_dir):
+                os.rmdir(_partial_dir)
+        except OSError:
+            # partial file is created by other connection
+            pass
+
+    def __open_partial(self, _info, _offset, _hash):
+        """
+            open partial file locked by this connection for continue from offset,
+            hash its beginning; return (None, None) if the same content is received
+            from offset 0 by other connection
+        """
+        _path = self.__partial_path(_info)
+        os.makedirs(os.path.dirname(_path), exist_ok=True)
+        if _offset > 0 and (not os.path.isfile(_path) or os.path.getsize(_path) < _offset):
+            raise OSError("No partial file to resume from " + str(_offset) + " bytes")
+        # file is not truncated before it is locked
+        _file = os.fdopen(os.open(_path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+        if not lock_file(_file):
+            _file.close()
+            if _offset > 0:
+                raise OSError("Partial file is received by other connection")
+            return None, None
+        _file.seek(0)
+        _left = _offset
+        while _left > 0:
+            _chunk = _file.read(min(_left, BUF_READ_SIZE))
+            _hash.update(_chunk)
+            _left -= len(_chunk)
+        _file.truncate(_offset)
+        return _path, _file
+
+    def __receive_file_frames(  # pylint: disable=too-many-arguments
+        self, _file, _info, _block_size=0, _compression=None, _offset=0
+    ):
+        """
+            receive file by frames, hash is computed while bytes arrive and data is
+            written by writer thread into temporary (or partial) file, which is renamed
+            into place if hash is right; return error or None if file is queued
+            block_size is set for delta transfer against current copy of file,
+            offset is set for continue of interrupted transfer
+        """
+        filepath = os.path.join(self.__options["target_dir"], _file)
+        log_debug("Receiving file... " + filepath + " (" + str(_info["size"]) + " bytes)")
+        _hash_algo, _expected_hash = get_file_hash(_info)
+        if _hash_algo not in HASH_ALGOS:
+            receive_data_frames(self.__conn, None)
+            return "WRONG_HASH_ALGO " + str(_hash_algo)
+        _hash = hashlib.new(_hash_algo)
+        _path = temp_path(filepath)
+        _partial = _block_size == 0 and (_info["size"] >= RESUME_MIN_SIZE or _offset > 0)
+        _basis = None
+        try:
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            if _block_size > 0:
+                _basis = open(filepath, 'rb')  # pylint: disable=consider-using-with
+                _fd = open(_path, 'wb')  # pylint: disable=consider-using-with
+            elif _partial:
+                _path, _fd = self.__open_partial(_info, _offset, _hash)
+                if _fd is None:
+                    _partial = False
+                    _path = temp_path(filepath)
+                    _fd = open(_path, 'wb')  # pylint: disable=consider-using-with
+            else:
+                _fd = open(_path, 'wb')  # pylint: disable=consider-using-with
+        except OSError as _err:
+            if _basis is not None:
+                _basis.close()
+            receive_data_frames(self.__conn, None)
+            return str(_err)
+        _stream = self.__get_writer().open_stream(_file, _info, _fd, _path, filepath)
+        # received part of big file is kept for resume if connection is lost
+        _action = "keep" if _partial else "discard"
+        try:
+            receive_data_frames(
+                self.__conn, _stream, _hash, _basis, _block_size,
+                None if _compression is None else new_decompressor(_compression)
+            )
+            _action = "commit" if _hash.hexdigest() == _expected_hash else "discard"
+        finally:
+            if _basis is not None:
+                _basis.close()
+            _stream.finish(_action)
+        if _action != "commit":
+            return "WRONG_HASH expected " + _expected_hash + " got " + _hash.hexdigest()
+        return None
+
+    def __get_writer(self):
+        """ threads which write received files, started by the first file """
+        if self.__writer is None:
+            self.__writer = BoFileWriter(self.__report)
+        return self.__writer
+
+    def __wait_writes(self):
+        """ move queued files into place and add them to results of batch """
+        if self.__writer is not None:
+            self.__writer.sync()
+
+    def __report(self, _results):
+        """
+            add results (file, info, error) to batch, accepted files
+            are recorded in content index as soon as they land
+        """
+        _indexed = []
+        with self.__batch_lock:
+            for _file, _info, _error in _results:
+                if _error is None:
+                    self.__batch["accepted"].append(_file)
+                    _indexed.append((_file,) + get_file_hash(_info))
+                else:
+                    print("FAILED " + _file + ": " + _error)
+                    self.__batch["failed"][_file] = _error
+        self.__content_index.add(self.__options["target_dir"], _indexed)
+        STATS.add("files_received", len(_indexed))
+
     def __read_command(self, command: BoCommand):
-        buf = self.__sock.recv(1024).decode("utf-8").strip()
-        print("buf=", buf)
+        buf = self.__conn.recv_message().strip()
+        log_debug("buf=", buf[:200])
         if buf == "":
             command.parse(None)
         # print(buf)
         command.parse(buf)
 
+    def __handle_command_protocol(self, command):
+        if command.get_command() == "PROTOCOL":
+            _version = min(int(command.get_value()), PROTOCOL_VERSION)
+            log_debug("protocol: " + str(_version))
+            self.__conn.send_message("ACCEPTED " + str(_version))
+            self.__conn.set_version(_version)
+        return True
+
     def __handle_command_target_dir(self, command):
         if command.get_command() == "TARGET_DIR":
+            self.__wait_writes()
             self.__options["target_dir"] = command.get_value()
-            print("target_dir: '" + self.__options["target_dir"] + "'")
-            self.__sock.send(str("ACCEPTED " + self.__options["target_dir"]).encode())
+            log_debug("target_dir: '" + self.__options["target_dir"] + "'")
+            self.__conn.send_message(str("ACCEPTED " + self.__options["target_dir"]))
+        return True
+
+    def __handle_command_sub_dir(self, command):
+        if command.get_command() == "SUB_DIR":
+            self.__options["sub_dir"] = command.get_value()
+            log_debug("sub_dir: '" + self.__options["sub_dir"] + "'")
+            self.__conn.send_message(str("ACCEPTED " + self.__options["sub_dir"]))
+        return True
+
+    def __handle_command_cache_md5(self, command):
+        if command.get_command() == "CACHE_MD5":
+            self.__options["cache_md5"] = command.get_value()
+            log_debug("cache_md5: " + self.__options["cache_md5"])
+            self.__conn.send_message(str("ACCEPTED " + self.__options["cache_md5"]))
+        return True
+
+    def __handle_command_cache_size(self, command):
+        if command.get_command() == "CACHE_SIZE":
+            self.__options["cache_size"] = command.get_value()
+            self.__options["cache_size"] = int(self.__options["cache_size"])
+            log_debug("cache_size: " + str(self.__options["cache_size"]))
+            self.__conn.send_message(str("ACCEPTED " + str(self.__options["cache_size"])))
+        return True
+
+    def __handle_command_send_buffer_size(self, command):
+        if command.get_command() == "SEND_BUFFER_SIZE":
+            self.__send_buffer_size = command.get_value()
+            self.__send_buffer_size = min(int(self.__send_buffer_size), RECV_BUFFER_MAX_SIZE)
+            log_debug("send_buffer_size: " + str(self.__send_buffer_size))
+            self.__conn.send_message(str("ACCEPTED " + str(self.__send_buffer_size)))
+        return True
+
+    def __handle_command_cache_send(self, command):
+        if command.get_command() == "CACHE_SEND":
+            self.__conn.send_message("ACCEPTED")
+            # cache is kept in memory, concurrent clients do not share any file
+            _buf = io.BytesIO()
+            if self.__receive_file(
+                _buf, self.__options["cache_md5"],
+                self.__options["cache_size"]
+            ):
+                import yaml  # pylint: disable=import-outside-toplevel
+                try:
+                    self.__cache = yaml.safe_load(_buf.getvalue())
+                except yaml.YAMLError as _exc:
+                    print(_exc)
+                    self.__conn.send_message("FAILED")
+                    return False
+        return True
+
+    def __handle_command_action_request(self, command):
+        if command.get_command() == "ACTION_REQUEST":
+            # received files wait in temporary files until the end of actions
+            _pending = []
+            _received = {}
+            _deleted = []
+            try:
+                for _file, _info in self.__cache.items():
+                    log_debug(_file, _info)
+                    _fullpath = os.path.join(self.__options["target_dir"], _file)
+                    if _info['required_sync'] == 'DELETE':
+                        if os.path.isfile(_fullpath):
+                            os.remove(_fullpath)
+                        if not os.path.isfile(_fullpath):
+                            _deleted.append(_file)
+                            self.__conn.send_message(str("ACTION_DELETED " + _file))
+                            self.__read_command(command)
+                    elif _info['required_sync'] == 'UPDATE':
+                        _parent_dir = os.path.dirname(_fullpath)
+                        log_debug("_parent_dir", _parent_dir)
+                        os.makedirs(_parent_dir, exist_ok=True)
+                        self.__conn.send_message(str("ACTION_SEND_ME_FILE " + _file))
+                        _hash_algo, _hash = get_file_hash(_info)
+                        _received[_fullpath] = (_file, _hash_algo, _hash)
+                        if not self.__receive_file(
+                            _fullpath, _hash, _info["size"], _hash_algo, _pending
+                        ):
+                            break
+                        self.__read_command(command)
+            finally:
+                _errors = self.__get_writer().commit(_pending)
+                # digest of synced files (key of cached results) follows every write
+                self.__content_index.remove(self.__options["target_dir"], _deleted)
+                self.__content_index.add(self.__options["target_dir"], [
+                    _received[_fullpath]
+                    for (_, _fullpath), _error in zip(_pending, _errors) if _error is None
+                ])
+            for (_, _fullpath), _error in zip(_pending, _errors):
+                if _error is not None:
+                    print("FAILED " + _fullpath + ": " + _error)
+            self.__conn.send_message(str("ACTIONS_COMPLETED"))
         return True
 
-    def __handle_command_sub_dir(self, command):
-        if command.get_command() == "SUB_DIR":
-            self.__options["sub_dir"] = command.get_value()
-            print("sub_dir: '" + self.__options["sub_dir"] + "'")
-            self.__sock.send(str("ACCEPTED " + self.__options["sub_dir"]).encode())
+    def __handle_command_sync_batch(self, command):
+        if command.get_command() == "SYNC_BATCH":
+            _request = json.loads(command.get_value())
+            self.__wait_writes()
+            self.__cache = _request["files"]
+            self.__batch = {"accepted": [], "failed": {}}
+            self.__delta_block_sizes = {}
+            self.__created_dirs = set()
+            _delta_min_size = _request.get("delta_min_size", 0)
+            _deleted = []
+            _send = []
+            _failed = {}
+            _delta = {}
+            _resume = {}
+            _local = self.__sync_from_local_content()
+            for _file, _info in self.__cache.items():
+                _fullpath = os.path.join(self.__options["target_dir"], _file)
+                if _file in _local:
+                    if _info['required_sync'] == 'DELETE':
+                        _deleted.append(_file)
+                    continue
+                if _info['required_sync'] == 'DELETE':
+                    try:
+                        if os.path.isfile(_fullpath):
+                            os.remove(_fullpath)
+                        _deleted.append(_file)
+                    except OSError as _err:
+                        _failed[_file] = str(_err)
+                elif _info['required_sync'] == 'UPDATE':
+                    _send.append(_file)
+                    _partial = self.__partial_path(_info)
+                    if _info["size"] >= RESUME_MIN_SIZE and os.path.isfile(_partial) \
+                            and 0 < os.path.getsize(_partial) < _info["size"] \
+                            and not is_file_locked(_partial):
+                        _resume[_file] = os.path.getsize(_partial)
+                    elif 0 < _delta_min_size <= _info["size"] and os.path.isfile(_fullpath) \
+                            and os.path.getsize(_fullpath) >= DELTA_BLOCK_MIN_SIZE:
+                        _delta[_file] = delta_signature(_fullpath)
+                        self.__delta_block_sizes[_file] = _delta[_file]["block_size"]
+            self.__content_index.remove(self.__options["target_dir"], _deleted)
+            self.__remove_stale_partials()
+            _local = [_file for _file in _local if _file not in _deleted]
+            print("sync batch: created from local content " + str(len(_local)))
+            print(
+                "sync batch: files " + str(len(self.__cache)) + ", "
+                "deleted " + str(len(_deleted)) + ", to receive " + str(len(_send))
+            )
+            self.__remove_session()
+            self.__session = self.__server.add_sync_session({
+                "target_dir": self.__options["target_dir"],
+                "files": self.__cache,
+                "delta_block_sizes": self.__delta_block_sizes,
+                "created_dirs": self.__created_dirs,
+            })
+            self.__conn.send_message("SYNC_MANIFEST " + json.dumps({
+                "session": self.__session,
+                "local": _local,
+                "deleted": _deleted,
+                "send": _send,
+                "failed": _failed,
+                "delta": _delta,
+                "resume": _resume,
+                "compression": COMPRESSION_ALGOS,
+            }))
+        return True
+
+    def __sync_from_local_content(self):
+        """
+            create requested files from content which server already has:
+            skip files received before, rename files deleted in the same batch,
+            copy files from content index;
+            return set of created files and of consumed deleted files
+        """
+        import shutil  # pylint: disable=import-outside-toplevel
+        _target_dir = self.__options["target_dir"]
+        _moved = {}
+        for _file, _info in self.__cache.items():
+            if _info['required_sync'] == 'DELETE' and _info.get("size", 0) > 0:
+                _moved.setdefault(get_file_hash(_info), []).append(_file)
+        _done = set()
+        _indexed = []
+        for _file, _info in self.__cache.items():
+            if _info['required_sync'] != 'UPDATE' or _info["size"] == 0:
+                continue
+            _key = get_file_hash(_info)
+            if self.__content_index.has(_target_dir, _file, _key[0], _key[1]):
+                # received already by interrupted sync
+                _done.add(_file)
+                continue
+            _fullpath = os.path.join(_target_dir, _file)
+            try:
+                _source = self.__find_moved_content(_moved.get(_key, []), _key)
+                if _source is not None:
+                    os.makedirs(os.path.dirname(_fullpath), exist_ok=True)
+                    os.replace(os.path.join(_target_dir, _source), _fullpath)
+                    _done.add(_source)
+                else:
+                    _source = self.__content_index.find(_target_dir, _key[0], _key[1])
+                    if _source is None:
+                        continue
+                    os.makedirs(os.path.dirname(_fullpath), exist_ok=True)
+                    shutil.copyfile(os.path.join(_target_dir, _source), _fullpath)
+            except OSError as _err:
+                print("Could not create " + _file + " from local content: " + str(_err))
+                continue
+            _done.add(_file)
+            _indexed.append((_file, _key[0], _key[1]))
+        self.__content_index.add(_target_dir, _indexed)
+        return _done
+
+    def __find_moved_content(self, _candidates, _key):
+        """ take deleted file which still has the content on the server side """
+        _target_dir = self.__options["target_dir"]
+        while _candidates:
+            _file = _candidates.pop()
+            _fullpath = os.path.join(_target_dir, _file)
+            if not os.path.isfile(_fullpath):
+                continue
+            if self.__content_index.has(_target_dir, _file, _key[0], _key[1]) \
+                    or (_key[0] in HASH_ALGOS and hash_by_file(_fullpath, _key[0]) == _key[1]):
+                return _file
+        return None
+
+    def __handle_command_sync_join(self, command):
+        if command.get_command() == "SYNC_JOIN":
+            _session = self.__server.get_sync_session(json.loads(command.get_value())["session"])
+            if _session is None or _session["target_dir"] != self.__options.get("target_dir"):
+                self.__conn.send_message("SYNC_JOIN_FAILED {}")
+                return False
+            self.__wait_writes()
+            self.__cache = _session["files"]
+            self.__delta_block_sizes = _session["delta_block_sizes"]
+            self.__created_dirs = _session["created_dirs"]
+            self.__batch = {"accepted": [], "failed": {}}
+            self.__conn.send_message("SYNC_JOINED {}")
         return True
 
-    def __handle_command_cache_md5(self, command):
-        if command.get_command() == "CACHE_MD5":
-            self.__options["cache_md5"] = command.get_value()
-            print("cache_md5: " + self.__options["cache_md5"])
-            self.__sock.send(str("ACCEPTED " + self.__options["cache_md5"]).encode())
+    def __handle_command_stats(self, command):
+        if command.get_command() == "STATS":
+            self.__conn.send_message("STATS " + json.dumps(STATS.to_dict()))
         return True
 
-    def __handle_command_cache_size(self, command):
-        if command.get_command() == "CACHE_SIZE":
-            self.__options["cache_size"] = command.get_value()
-            self.__options["cache_size"] = int(self.__options["cache_size"])
-            print("cache_size: " + str(self.__options["cache_size"]))
-            self.__sock.send(str("ACCEPTED " + str(self.__options["cache_size"])).encode())
-        return True
+    def __remove_session(self):
+        """ forget sync session started by this connection """
+        if self.__session is not None:
+            self.__server.remove_sync_session(self.__session)
+            self.__session = None
 
-    def __handle_command_send_buffer_size(self, command):
-        if command.get_command() == "SEND_BUFFER_SIZE":
-            self.__send_buffer_size = command.get_value()
-            self.__send_buffer_size = int(self.__send_buffer_size)
-            print("send_buffer_size: " + str(self.__send_buffer_size))
-            self.__sock.send(str("ACCEPTED " + str(self.__send_buffer_size)).encode())
+    def __handle_command_file(self, command):
+        if command.get_command() == "FILE":
+            _start = time.perf_counter()
+            _header = json.loads(command.get_value())
+            _file = _header["path"]
+            _info = self.__cache.get(_file)
+            _error = None
+            if "skip" in _header:
+                _error = _header["skip"]
+            elif _info is None or _info['required_sync'] != 'UPDATE':
+                _error = "file was not requested"
+            if _error is None:
+                _block_size = 0
+                if _header.get("delta", False):
+                    _block_size = self.__delta_block_sizes.get(_file, 0)
+                    if _block_size == 0:
+                        raise BoProtocolError("Delta for file without signature: " + _file)
+                _error = self.__receive_file_frames(
+                    _file, _info, _block_size,
+                    _header.get("compression"), _header.get("offset", 0)
+                )
+            else:
+                receive_data_frames(self.__conn, None)
+            if _error is None:
+                # file is accepted by writer thread when it lands
+                STATS.add("file_bytes_received", _info["size"] - _header.get("offset", 0))
+            else:
+                self.__report([(_file, _info, _error)])
+            STATS.add_time("transfer", time.perf_counter() - _start)
+            STATS.observe("receive_file", time.perf_counter() - _start)
         return True
 
-    def __handle_command_cache_send(self, command):
-        if command.get_command() == "CACHE_SEND":
-            self.__sock.send("ACCEPTED".encode())
-            self.__receive_file(
-                "test", self.__options["cache_md5"],
-                self.__options["cache_size"]
+    def __handle_command_pack(self, command):
+        if command.get_command() == "PACK":
+            _start = time.perf_counter()
+            _header = json.loads(command.get_value())
+            _compression = _header.get("compression")
+            _buf = io.BytesIO()
+            receive_data_frames(
+                self.__conn, _buf, None, None, 0,
+                None if _compression is None else new_decompressor(_compression)
             )
-            if os.path.isfile("test"):
-                with open("test", encoding="utf-8") as _file:
-                    try:
-                        self.__cache = yaml.safe_load(_file)
-                    except yaml.YAMLError as _exc:
-                        print(_exc)
-                        self.__sock.send("FAILED".encode())
-                        return False
-                os.remove("test")
+            _data = memoryview(_buf.getvalue())
+            _pos = 0
+            _checked = []
+            _failed = []
+            log_debug("Receiving pack of " + str(len(_header["files"])) + " files")
+            for _entry in _header["files"]:
+                _file = _entry["path"]
+                _content = _data[_pos:_pos + _entry["size"]]
+                _pos += _entry["size"]
+                _info = self.__cache.get(_file)
+                if "skip" in _entry:
+                    _error = _entry["skip"]
+                elif _info is None or _info['required_sync'] != 'UPDATE':
+                    _error = "file was not requested"
+                else:
+                    _error = self.__check_small_file(_file, _info, _content)
+                if _error is None:
+                    _checked.append((
+                        _file, _info, os.path.join(self.__options["target_dir"], _file), _content
+                    ))
+                else:
+                    _failed.append((_file, _info, _error))
+            self.__report(_failed)
+            # files are written while the next pack is received
+            self.__get_writer().write_files(_checked)
+            STATS.add("file_bytes_received", len(_data))
+            STATS.add_time("transfer", time.perf_counter() - _start)
+            STATS.observe("receive_pack", time.perf_counter() - _start)
+            self.__conn.send_message("PACK_DONE {}")
         return True
 
-    def __handle_command_action_request(self, command):
-        if command.get_command() == "ACTION_REQUEST":
-            for _file, _info in self.__cache.items():
-                print(_file, _info)
-                _fullpath = os.path.join(self.__options["target_dir"], _file)
-                if _info['required_sync'] == 'DELETE':
-                    if os.path.isfile(_fullpath):
-                        os.remove(_fullpath)
-                        if not os.path.isfile(_fullpath):
-                            self.__sock.send(str("ACTION_DELETED " + _file).encode())
-                            self.__read_command(command)
-                            continue
-                    else:
-                        self.__sock.send(str("ACTION_DELETED " + _file).encode())
-                        self.__read_command(command)
-                        continue
-                elif _info['required_sync'] == 'UPDATE':
-                    _parent_dir = os.path.dirname(_fullpath)
-                    print("_parent_dir", _parent_dir)
-                    os.makedirs(_parent_dir, exist_ok=True)
-                    self.__sock.send(str("ACTION_SEND_ME_FILE " + _file).encode())
-                    if not self.__receive_file(_fullpath, _info["md5"], _info["size"]):
-                        break
-                    self.__read_command(command)
-            self.__sock.send(str("ACTIONS_COMPLETED").encode())
+    def __check_small_file(self, _file, _info, _content):
+        """ check file from pack and create its directory, return error or None """
+        _hash_algo, _expected_hash = get_file_hash(_info)
+        if _hash_algo not in HASH_ALGOS:
+            return "WRONG_HASH_ALGO " + str(_hash_algo)
+        _got_hash = hashlib.new(_hash_algo, _content).hexdigest()
+        if _got_hash != _expected_hash:
+            return "WRONG_HASH expected " + _expected_hash + " got " + _got_hash
+        _fullpath = os.path.join(self.__options["target_dir"], _file)
+        _dirpath = os.path.dirname(_fullpath)
+        try:
+            if _dirpath not in self.__created_dirs:
+                os.makedirs(_dirpath, exist_ok=True)
+                self.__created_dirs.add(_dirpath)
+        except OSError as _err:
+            return str(_err)
+        return None
+
+    def __handle_command_sync_batch_end(self, command):
+        if command.get_command() == "SYNC_BATCH_END":
+            # all files of session are flushed and renamed at once
+            self.__wait_writes()
+            print(
+                "sync batch: accepted " + str(len(self.__batch["accepted"])) + ", "
+                "failed " + str(len(self.__batch["failed"]))
+            )
+            self.__conn.send_message("SYNC_RESULTS " + json.dumps(self.__batch))
+            self.__batch = {"accepted": [], "failed": {}}
+            if self.__session is not None:
+                self.__remove_stale_partials()
+            self.__remove_session()
         return True
 
     def __send_output_line(self, command: BoCommand, _line):
-        print("_line1", _line)
-        self.__sock.send(str("OUTPUT " + _line).encode())
+        log_debug("_line1", _line)
+        self.__conn.send_message(str("OUTPUT " + _line))
         self.__read_command(command)
 
     def __handle_command_run_command(self, command: BoCommand):
         cmds = json.loads(command.get_value())
-        self.__sock.send(str("ACCEPTED " + str(cmds)).encode())
+        self.__conn.send_message(str("ACCEPTED " + str(cmds)))
         self.__read_command(command)
         if command.get_command() != "OUTPUT_REQUEST":
-            self.__sock.send(str("FAILED").encode())
+            self.__conn.send_message(str("FAILED"))
             return False
         if is_linux():
             cmds = ['sh', '-c'] + cmds
@@ -586,18 +3876,18 @@ class BoServerSocketHandler(threading.Thread):
             cmds = ['cmd', '/c'] + cmds
         _cwd = os.path.join(self.__options["target_dir"], self.__options["sub_dir"])
         if not os.path.isdir(_cwd):
-            self.__sock.send(str("OUTPUT_FAILED " + _cwd + " - not found directory").encode())
+            self.__conn.send_message(str("OUTPUT_FAILED " + _cwd + " - not found directory"))
             return False
         self.__send_output_line(command, ">>>> Directory: " + _cwd + "\n")
         self.__send_output_line(command, ">>>> Command: " + str(cmds) + "\n")
         self.__send_output_line(command, ">>>> Output: " + str(cmds) + "\n")
-        _proc = subprocess.Popen(  # pylint: disable=consider-using-with
-            cmds,
-            cwd=_cwd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            shell=False,
-        )
+        _returncode = self.__server.run_job(self.__run_by_output_requests, command, cmds, _cwd)
+        self.__conn.send_message(str("OUTPUT_FINISHED " + str(_returncode)))
+        return True
+
+    def __run_by_output_requests(self, command: BoCommand, cmds, _cwd):
+        """ run command, every line of output is sent by OUTPUT_REQUEST (protocol 1) """
+        _proc = start_process(cmds, _cwd)
         _returncode = _proc.poll()
         _line = _proc.stdout.readline()
         if _line:
@@ -613,45 +3903,250 @@ class BoServerSocketHandler(threading.Thread):
                 self.__send_output_line(command, _line.decode("utf-8"))
             else:
                 break
-        self.__sock.send(str("OUTPUT_FINISHED " + str(_returncode)).encode())
+        return _returncode
+
+    def __handle_command_run_command_stream(self, command: BoCommand):
+        """ run command and push its output by frames without waiting of client """
+        cmds = json.loads(command.get_value())
+        self.__conn.send_message(str("ACCEPTED " + str(cmds)))
+        if is_linux():
+            cmds = ['sh', '-c'] + cmds
+        if is_windows():
+            cmds = ['cmd', '/c'] + cmds
+        _cwd = os.path.join(self.__options["target_dir"], self.__options["sub_dir"])
+        if not os.path.isdir(_cwd):
+            self.__conn.send_message(str("OUTPUT_FAILED " + _cwd + " - not found directory"))
+            return False
+        self.__conn.send_frame(FRAME_OUTPUT, (
+            ">>>> Directory: " + _cwd + "\n" +
+            ">>>> Command: " + str(cmds) + "\n" +
+            ">>>> Output: " + str(cmds) + "\n"
+        ).encode("utf-8"))
+        _key, _result = self.__find_result(cmds)
+        if _result is not None:
+            self.__replay_result(*_result)
+            return True
+        _spool = None if _key is None else BoResultSpool(self.__server.get_result_cache(), _key)
+        try:
+            _returncode = self.__server.run_job(self.__run_streamed, cmds, _cwd, _spool)
+        except BaseException:
+            # client is disconnected or command could not be started
+            if _spool is not None:
+                _spool.discard()
+            raise
+        if _spool is not None:
+            _spool.store(_returncode)
+        self.__conn.send_frame(FRAME_EXIT, EXIT_STATUS.pack(_returncode))
         return True
 
-    def run(self):
+    def __run_streamed(self, cmds, _cwd, _spool):
+        """ run command, push its output by frames, return exit status """
+        # own session, so children of shell are killed with it
+        _proc = start_process(cmds, _cwd, not is_windows())
+        # reader keeps pipe empty while network is slow, queue limits memory
+        _chunks = queue.Queue(OUTPUT_QUEUE_CHUNKS)
+
+        def _reader():
+            while True:
+                _chunk = os.read(_proc.stdout.fileno(), OUTPUT_CHUNK_SIZE)
+                _chunks.put(_chunk)
+                if not _chunk:
+                    break
+
+        _thread = threading.Thread(target=_reader, daemon=True)
+        _thread.start()
+        try:
+            _finished = False
+            while not _finished:
+                _data = [_chunks.get()]
+                _size = len(_data[0])
+                while _data[-1] and _size < OUTPUT_FRAME_MAX_SIZE and not _chunks.empty():
+                    _data.append(_chunks.get())
+                    _size += len(_data[-1])
+                _finished = not _data[-1]
+                if _size > 0:
+                    self.__conn.send_frame(FRAME_OUTPUT, b"".join(_data))
+                    if _spool is not None:
+                        _spool.write(_data)
+            _returncode = _proc.wait()
+        except OSError:
+            # client is disconnected
+            kill_process_group(_proc, True)
+            _proc.wait()
+            raise
+        finally:
+            _proc.stdout.close()
+            if _spool is not None:
+                _spool.close()
+        return _returncode
+
+    def __find_result(self, _cmds):
+        """
+            return (key, cached result) of command on current synced files,
+            key is None if the result cache is disabled
+        """
+        _result_cache = self.__server.get_result_cache()
+        if _result_cache is None:
+            return None, None
+        _key = BoResultCache.make_key(
+            self.__options["target_dir"], self.__options["sub_dir"], _cmds,
+            self.__content_index.digest(self.__options["target_dir"])
+        )
+        if self.__options.get("force_run"):
+            return _key, None
+        return _key, _result_cache.get(_key)
+
+    def __replay_result(self, _output, _exit_status):
+        """ send output and exit status of the same command run on the same files """
+        self.__conn.send_frame(FRAME_OUTPUT, b">>>> Cached result of previous run\n")
+        with _output:
+            while True:
+                _data = _output.read(OUTPUT_FRAME_MAX_SIZE)
+                if not _data:
+                    break
+                self.__conn.send_frame(FRAME_OUTPUT, _data)
+        self.__conn.send_frame(FRAME_EXIT, EXIT_STATUS.pack(_exit_status))
+
+    def __handle_command_force_run(self, command: BoCommand):
+        """ do not use cached result for commands of the connection """
+        self.__options["force_run"] = command.get_value() == "1"
+        self.__conn.send_message("ACCEPTED " + command.get_value())
+        return True
+
+    def __artifact_hashes(self, _files, _hash_algo):
+        """ hash files of target dir, unchanged files are hashed once by content index """
+        _target_dir = self.__options["target_dir"]
+        _index = self.__server.get_content_index()
+        _hashes = {}
+        _to_hash = []
+        for _file in _files:
+            _hashes[_file] = _index.get_hash(_target_dir, _file, _hash_algo)
+            if _hashes[_file] is None:
+                _to_hash.append(_file)
+        _hashes.update(hash_files(_target_dir, _to_hash, _hash_algo))
+        # build outputs are not part of digest of synced files
+        _index.add(_target_dir, [
+            (_file, _hash_algo, _hashes[_file]) for _file in _to_hash if _hashes[_file]
+        ], False)
+        return {_file: _hash for _file, _hash in _hashes.items() if _hash is not None}
+
+    def __handle_command_pull(self, command: BoCommand):
+        """
+            send artifacts matched by patterns which client does not have,
+            hashes of unchanged files are taken from content index
+        """
+        _request = json.loads(command.get_value())
+        _target_dir = self.__options["target_dir"]
+        _hash_algo = _request.get("hash_algo", "md5")
+        if _hash_algo not in HASH_ALGOS:
+            self.__conn.send_message("PULL_FAILED WRONG_HASH_ALGO " + str(_hash_algo))
+            return False
+        try:
+            _found = find_artifacts(_target_dir, _request.get("patterns", []))
+        except ValueError as _err:
+            self.__conn.send_message("PULL_FAILED " + str(_err))
+            return False
+        _hashes = self.__artifact_hashes(_found, _hash_algo)
+        _have = _request.get("files", {})
+        _send = sorted(_file for _file, _hash in _hashes.items() if _have.get(_file) != _hash)
+        self.__conn.send_message("PULL_MANIFEST " + json.dumps({"files": _hashes, "send": _send}))
+        print("Pull: found " + str(len(_hashes)) + ", to send " + str(len(_send)))
+        _compression = BoCompressionPolicy(_request.get("compression", "auto"), COMPRESSION_ALGOS)
+        for _file in _send:
+            _header = {"path": _file, "hash": _hashes[_file]}
+            _fullpath = os.path.join(_target_dir, _file)
+            try:
+                _fd = open(_fullpath, 'rb')  # pylint: disable=consider-using-with
+            except OSError as _err:
+                self.__conn.send_message("FILE " + json.dumps(dict(_header, skip=str(_err))))
+                self.__conn.send_frame(FRAME_DATA_END)
+                continue
+            with _fd:
+                send_file_frames(self.__conn, _header, _fd, _compression)
+        self.__conn.send_message("PULL_DONE " + json.dumps({}))
+        print(_compression.report())
+        return True
+
+    def __handle_command_run_stack(self, command: BoCommand):
+        """ run steps of command stack, output is pushed by frames """
+        _stack = json.loads(command.get_value())
+        _steps = _stack.get("steps", [])
+        for _index, _step in enumerate(_steps):
+            if not isinstance(_step.get("command"), str) or not all(
+                isinstance(_need, int) and 0 <= _need < _index for _need in _step["needs"]
+            ):
+                self.__conn.send_message("STACK_FAILED wrong step " + str(_index))
+                return False
+        if len(_steps) > STACK_MAX_STEPS:
+            self.__conn.send_message("STACK_FAILED too many steps")
+            return False
+        _cwd = os.path.join(self.__options["target_dir"], self.__options["sub_dir"])
+        if not os.path.isdir(_cwd):
+            self.__conn.send_message("STACK_FAILED " + _cwd + " - not found directory")
+            return False
+        self.__conn.send_message("ACCEPTED " + str(len(_steps)) + " steps")
+        _runner = BoStackRunner(self.__conn, _cwd, _steps, _stack.get("fail_fast", True))
+        self.__conn.send_frame(FRAME_EXIT, EXIT_STATUS.pack(self.__server.run_job(_runner.run)))
+        return True
+
+    def welcome(self):
+        """ send banner """
         welcome_s = "Welcome to bo server\n"
+        welcome_s += "protocols: " + " ".join(str(_v) for _v in range(1, PROTOCOL_VERSION + 1))
+        welcome_s += "\n"
         welcome_s += "target_dir? "
-        self.__sock.send(welcome_s.encode())
-        _handlers = {
-            "TARGET_DIR": self.__handle_command_target_dir,
-            "SUB_DIR": self.__handle_command_sub_dir,
-            "CACHE_MD5": self.__handle_command_cache_md5,
-            "SEND_BUFFER_SIZE": self.__handle_command_send_buffer_size,
-            "CACHE_SIZE": self.__handle_command_cache_size,
-            "CACHE_SEND": self.__handle_command_cache_send,
-            "ACTION_REQUEST": self.__handle_command_action_request,
-            "RUN_COMMAND": self.__handle_command_run_command,
-        }
+        self.__conn.send_message(welcome_s)
+
+    def process_command(self):
+        """ read and process one command, return False if connection should be closed """
         command = BoCommand()
-        while True:
-            if self.__is_kill is True:
-                break
-            self.__read_command(command)
-            if command.get_command() is None:
-                print("command is none. break")
-                break
-            if command.get_command() in _handlers:
-                if not _handlers[command.get_command()](command):
-                    print("command is failed. break")
-                    break
-            else:
-                resp = "\n '" + command.get_command() + "' unknown command\n\n"
-                print("FAIL: unknown command '" + command.get_command() + "'")
-                self.__sock.send(resp.encode())
-                break
-        self.__close_socket()
+        self.__read_command(command)
+        if command.get_command() is None:
+            log_debug("command is none. break")
+            return False
+        if command.get_command() not in self.__handlers:
+            resp = "\n '" + command.get_command() + "' unknown command\n\n"
+            print("FAIL: unknown command '" + command.get_command() + "'")
+            self.__conn.send_message(resp)
+            return False
+        with STATS.timer("command " + command.get_command()):
+            _ok = self.__handlers[command.get_command()](command)
+        if not _ok:
+            print("command is failed. break")
+            return False
+        return True
+
+    def get_addr(self):
+        """ address of client """
+        return self.__addr
+
+    def close(self):
+        """ forget sync session, close connection and finish queued writes """
+        self.__remove_session()
+        self.__conn.close()
+        if self.__writer is not None:
+            self.__writer.close()
+
+
+class BoServerSocketHandler(threading.Thread):
+    """
+        handler for process connection in different thread
+    """
+    def __init__(self, _sock, _addr, _server):
+        self.__protocol = BoServerProtocol(BoConnection(_sock), _addr, _server)
+        self.__server = _server
+        self.__is_kill = False
+        threading.Thread.__init__(self)
 
-    def __close_socket(self):
+    def run(self):
+        try:
+            self.__protocol.welcome()
+            while not self.__is_kill and self.__protocol.process_command():
+                pass
+        except (OSError, BoProtocolError, ValueError) as _err:
+            print("Connection " + str(self.__protocol.get_addr()) + " failed: " + str(_err))
         self.__is_kill = True
-        self.__sock.close()
+        self.__protocol.close()
         self.__server.remove_thread(self)
 
     def kill(self):
@@ -659,29 +4154,78 @@ class BoServerSocketHandler(threading.Thread):
         if self.__is_kill is True:
             return
         self.__is_kill = True
-        self.__sock.close()
-        # thrs.remove(self)
+        self.__protocol.close()
 
 
-class BoServer():
+class BoServer():  # pylint: disable=too-many-instance-attributes
     """
         Server multitreading implementation
     """
-    def __init__(self, host, port):
+    def __init__(self, host, port, result_cache_size=0):
         self.__host = host
         self.__port = port
         self.__thrs = []
+        self.__thrs_lock = threading.Lock()
+        self.__sessions = {}
+        self.__sessions_lock = threading.Lock()
+        # limit of commands running at once, not limited by default
+        self.__job_slots = None
+        _server_dir = os.path.join(BO_HOME_CONFIG_DIR, "server")
+        os.makedirs(_server_dir, exist_ok=True)
+        self.__content_index = BoContentIndex(os.path.join(_server_dir, "content.db"))
+        self.__result_cache = None
+        if result_cache_size > 0:
+            self.__result_cache = BoResultCache(
+                os.path.join(_server_dir, "results"), result_cache_size
+            )
+
+    def set_max_jobs(self, _max_jobs):
+        """ limit count of commands running at once """
+        self.__job_slots = threading.BoundedSemaphore(_max_jobs)
+
+    def run_job(self, _job, *_args):
+        """ run command by job(*args), wait for free slot while max jobs are running """
+        if self.__job_slots is None:
+            return _job(*_args)
+        with self.__job_slots:
+            return _job(*_args)
+
+    def get_content_index(self):
+        """ index of received content shared by connections """
+        return self.__content_index
+
+    def get_result_cache(self):
+        """ cache of command results or None if it is disabled """
+        return self.__result_cache
 
     def remove_thread(self, thrd):
         """ remove from threads """
-        self.__thrs.remove(thrd)
+        with self.__thrs_lock:
+            self.__thrs.remove(thrd)
+
+    def add_sync_session(self, _session):
+        """ register state of batch sync shared by several connections, return id """
+        _session_id = os.urandom(16).hex()
+        with self.__sessions_lock:
+            self.__sessions[_session_id] = _session
+        return _session_id
+
+    def get_sync_session(self, _session_id):
+        """ state of batch sync or None """
+        with self.__sessions_lock:
+            return self.__sessions.get(_session_id)
+
+    def remove_sync_session(self, _session_id):
+        """ forget batch sync """
+        with self.__sessions_lock:
+            self.__sessions.pop(_session_id, None)
 
     def start(self):
         """ start server """
         _srv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         _srv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         _srv_sock.bind((self.__host, self.__port))
-        _srv_sock.listen(10)
+        _srv_sock.listen(128)
 
         print('Start service listening ' + self.__host + ':' + str(self.__port))
 
@@ -689,41 +4233,391 @@ class BoServer():
             while True:
                 _cli_sock, addr = _srv_sock.accept()
                 thr = BoServerSocketHandler(_cli_sock, addr, self)
-                self.__thrs.append(thr)
+                with self.__thrs_lock:
+                    self.__thrs.append(thr)
                 thr.start()
         except KeyboardInterrupt:
+            print(BoStats.report(STATS.to_dict()))
             print('Bye! Write me letters!')
             _srv_sock.close()
-            for thr in self.__thrs:
+            with self.__thrs_lock:
+                _thrs = list(self.__thrs)
+            for thr in _thrs:
                 thr.kill()
 
 
-if os.path.isfile(BO_CONFIG_FILEPATH):
-    with open(BO_CONFIG_FILEPATH, encoding="utf-8") as _file:
+class BoAsyncServer(BoServer):
+    """
+        Server on asyncio: waiting connections do not take threads, received
+        commands are processed by pool of threads (one thread per active
+        connection at most), only max_jobs commands (processes) run at once,
+        new connections are not accepted while max_connections are open
+    """
+    def __init__(  # pylint: disable=too-many-arguments
+        self, host, port, max_connections, max_jobs, result_cache_size=0
+    ):
+        BoServer.__init__(self, host, port, result_cache_size)
+        self.set_max_jobs(max_jobs)
+        self.__address = (host, port)
+        self.__max_connections = max_connections
+        self.__max_jobs = max_jobs
+        self.__tasks = set()
+
+    def start(self):
+        """ start server """
+        import asyncio  # pylint: disable=import-outside-toplevel
+        try:
+            asyncio.run(self.__serve())
+        except KeyboardInterrupt:
+            print(BoStats.report(STATS.to_dict()))
+            print('Bye! Write me letters!')
+
+    async def __serve(self):
+        """ accept connections while there are free slots """
+        import asyncio  # pylint: disable=import-outside-toplevel
+        import concurrent.futures  # pylint: disable=import-outside-toplevel
+        _loop = asyncio.get_running_loop()
+        _srv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        _srv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        _srv_sock.bind(self.__address)
+        _srv_sock.listen(128)
+        _srv_sock.setblocking(False)
+        _slots = asyncio.Semaphore(self.__max_connections)
+        print(
+            'Start async service listening ' + self.__address[0] + ':' + str(self.__address[1]) +
+            ' (connections: ' + str(self.__max_connections) + ', jobs: ' +
+            str(self.__max_jobs) + ')'
+        )
+        # slow client holds only its own thread, commands wait for job slots separately
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.__max_connections) as _pool:
+            while True:
+                # not accepted connections wait in backlog of socket
+                await _slots.acquire()
+                _sock, _addr = await _loop.sock_accept(_srv_sock)
+                _task = asyncio.ensure_future(self.__serve_connection(_sock, _addr, _pool, _slots))
+                self.__tasks.add(_task)
+                _task.add_done_callback(self.__tasks.discard)
+
+    async def __serve_connection(self, _sock, _addr, _pool, _slots):
+        """ wait commands of client without thread, process them in pool """
+        import asyncio  # pylint: disable=import-outside-toplevel
+        _loop = asyncio.get_running_loop()
+        # socket is used by blocking calls in pool, timeout drops stuck clients
+        _sock.settimeout(SERVER_CLIENT_TIMEOUT)
+        _protocol = BoServerProtocol(BoConnection(_sock), _addr, self)
+        try:
+            await _loop.run_in_executor(_pool, _protocol.welcome)
+            while True:
+                await self.__wait_readable(_loop, _sock)
+                if not await _loop.run_in_executor(
+                    _pool, self.__process_while_active, _protocol, _sock
+                ):
+                    break
+        except (OSError, BoProtocolError, ValueError) as _err:
+            print("Connection " + str(_addr) + " failed: " + str(_err))
+        finally:
+            _protocol.close()
+            _slots.release()
+
+    @staticmethod
+    async def __wait_readable(_loop, _sock):
+        """ wait next command without taking of thread """
+        _future = _loop.create_future()
+
+        def _on_readable():
+            if not _future.done():
+                _future.set_result(None)
+
+        _loop.add_reader(_sock.fileno(), _on_readable)
+        try:
+            await _future
+        finally:
+            _loop.remove_reader(_sock.fileno())
+
+    @staticmethod
+    def __process_while_active(_protocol, _sock):
+        """ process commands while client sends them, return False if connection is closed """
+        while _protocol.process_command():
+            if not select.select([_sock], [], [], 0)[0]:
+                return True
+        return False
+
+
+class BoThreadOutput:
+    """
+        stdout of agent: output of thread which serves request is sent to its client,
+        output of other threads goes to real stdout
+    """
+
+    def __init__(self, _stdout):
+        self.__stdout = _stdout
+        self.__local = threading.local()
+        # print() writes text, output of remote command is written to buffer as bytes
+        self.buffer = self
+
+    def set_target(self, _send):
+        """ send(bytes) for output of current thread, None for real stdout """
+        self.__local.send = _send
+
+    def write(self, _data):
+        """ write text or bytes """
+        _send = getattr(self.__local, "send", None)
+        if _send is None:
+            if isinstance(_data, bytes):
+                return self.__stdout.buffer.write(_data)
+            return self.__stdout.write(_data)
+        _send(_data.encode("utf-8") if isinstance(_data, str) else bytes(_data))
+        return len(_data)
+
+    def flush(self):
+        """ flush real stdout, output of request is not buffered """
+        self.__stdout.flush()
+
+
+class BoAgentWorkdir:
+    """
+        workdir kept by agent: caches of servers are loaded once and updated by
+        changes from watcher, connections to servers are kept between requests
+    """
+
+    def __init__(self, _workdir, _workdir_cfg):
+        self.__workdir = _workdir
+        self.__cfg = _workdir_cfg
+        self.__lock = threading.Lock()
+        # watch before scan, so changes made while scanning are not lost
+        self.__watcher = new_watcher(_workdir, get_ignore_names(_workdir_cfg))
+        # one scan for caches of all servers, kept up to date by changes from watcher
+        self.__scan = None
+        # server -> (client, files cache)
+        self.__targets = {}
+
+    def __get_target(self, _server):
+        """ client and cache of server, created by the first request """
+        if _server not in self.__targets:
+            if self.__scan is None:
+                self.__scan = BoWorkdirScan(self.__workdir, get_ignore_names(self.__cfg))
+            self.__targets[_server] = new_sync_target(
+                self.__workdir, self.__cfg, self.__cfg["servers"][_server], self.__scan
+            )
+        return self.__targets[_server]
+
+    def __apply_changes(self):
+        """ update caches by changes since the previous request """
+        _changed, _dirs = self.__watcher.poll_changes()
+        if not _changed and not _dirs:
+            return
+        _start = time.time()
+        _changes = 0
+        if self.__scan is not None:
+            self.__scan.rescan_paths(_changed, _dirs)
+        for _, _files in self.__targets.values():
+            _changes = max(
+                _changes, _files.rescan_paths(self.__workdir, _changed, _dirs, self.__scan)
+            )
+            _files.resave_cache()
+        print(
+            "Changes: " + str(_changes) + ", rescan elapsed " +
+            str(round(time.time() - _start, 3)) + " sec"
+        )
+
+    def sync(self, _servers):
+        """ sync workdir to servers one by one, return exit status """
+        _status = 0
+        with self.__lock:
+            for _server in _servers:
+                _client, _files = self.__get_target(_server)
+                self.__apply_changes()
+                try:
+                    _client.sync_kept(_files)
+                except (OSError, BoProtocolError, ValueError, SystemExit) as _err:
+                    print("Server '" + _server + "': failed " + str(_err))
+                    _status = 1
+        return _status
+
+    def run_command(self, _server, _subdir, _command, _force_run=False):
+        """ run remote command by kept connection, return exit status """
+        with self.__lock:
+            _client, _ = self.__get_target(_server)
+            return _client.run_command_kept(_subdir, _command, _force_run)
+
+    def close(self):
+        """ stop watching, connections are closed with the agent """
+        with self.__lock:
+            self.__watcher.close()
+
+
+class BoAgent:  # pylint: disable=too-few-public-methods
+    """
+        local daemon which keeps state of workdirs between invocations of bo,
+        'bo sync' and 'bo remote run' are sent to it by unix socket
+    """
+
+    def __init__(self, _socket_path):
+        self.__socket_path = _socket_path
+        self.__lock = threading.Lock()
+        self.__workdirs = {}
+        self.__config_mtime = None
+        self.__output = None
+
+    def __get_workdir(self, _cwd):
+        """ state of workdir of directory, config is reloaded when it is changed """
+        with self.__lock:
+            _mtime = None
+            if os.path.isfile(BO_CONFIG_FILEPATH):
+                _mtime = os.path.getmtime(BO_CONFIG_FILEPATH)
+            if _mtime != self.__config_mtime:
+                print("Loading config " + BO_CONFIG_FILEPATH)
+                load_config()
+                for _workdir in self.__workdirs.values():
+                    _workdir.close()
+                self.__workdirs = {}
+                self.__config_mtime = _mtime
+            _workdir = find_root_bo_work_dir(_cwd)
+            if _workdir is None:
+                fatal(6, "Not found config for directory '" + _cwd + "'")
+            if _workdir not in self.__workdirs:
+                print("Found workdir in config: ", _workdir)
+                self.__workdirs[_workdir] = BoAgentWorkdir(
+                    _workdir, BO_CONFIG["workdirs"][_workdir]
+                )
+            return _workdir, self.__workdirs[_workdir]
+
+    def __process(self, _request):
+        """ process request of 'bo sync' or 'bo remote run', return exit status """
+        _path, _workdir = self.__get_workdir(_request["cwd"])
+        _argv = _request["argv"]
+        _cfg_servers = BO_CONFIG["workdirs"][_path]["servers"]
+        if _argv[0] == "sync":
+            return _workdir.sync(
+                select_servers(_cfg_servers, _argv[1:], _request["options"].get("all", False))
+            )
+        _server = _argv[2] if _argv[2] in _cfg_servers else "base"
+        _command = _argv[2:]
+        while _command and _command[-1] == "":
+            _command = _command[:-1]
+        return _workdir.run_command(
+            _server, _request["cwd"][len(_path)+1:], _command,
+            _request["options"].get("force-run", False)
+        )
+
+    def __serve(self, _sock):
+        """ process one request, output is sent to requester by frames """
+        _conn = BoConnection(_sock)
+        _conn.set_version(PROTOCOL_VERSION)
         try:
-            BO_CONFIG = yaml.safe_load(_file)
-        except yaml.YAMLError as exc:
-            print(exc)
-            fatal(2, "Problem with reading config, description: " + str(exc))
-else:
-    resave_config()
+            _request = json.loads(_conn.recv_message())
+            self.__output.set_target(lambda _data: _conn.send_frame(FRAME_OUTPUT, _data))
+            try:
+                _status = self.__process(_request)
+            except SystemExit:
+                # fatal() already printed the reason
+                _status = 1
+            finally:
+                self.__output.set_target(None)
+            _conn.send_frame(FRAME_EXIT, EXIT_STATUS.pack(_status))
+        except (OSError, BoProtocolError, ValueError, KeyError) as _err:
+            print("Request failed: " + str(_err))
+        finally:
+            _conn.close()
+
+    def start(self):
+        """ listen unix socket until Ctrl+C """
+        if not hasattr(socket, "AF_UNIX"):
+            fatal(21, "Agent requires unix sockets")
+        if os.path.exists(self.__socket_path):
+            _probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                _probe.connect(self.__socket_path)
+                fatal(22, "Agent is already running: " + self.__socket_path)
+            except OSError:
+                os.remove(self.__socket_path)
+            finally:
+                _probe.close()
+        _sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # only owner could connect
+        _umask = os.umask(0o177)
+        try:
+            _sock.bind(self.__socket_path)
+        finally:
+            os.umask(_umask)
+        _sock.listen(16)
+        self.__output = BoThreadOutput(sys.stdout)
+        sys.stdout = self.__output
+        print("Agent is listening on " + self.__socket_path)
+        try:
+            while True:
+                _conn, _ = _sock.accept()
+                threading.Thread(target=self.__serve, args=(_conn,), daemon=True).start()
+        except KeyboardInterrupt:
+            print("Bye!")
+        finally:
+            _sock.close()
+            os.remove(self.__socket_path)
+
+
+def run_by_agent(_request):
+    """
+        pass request to running 'bo agent' and print its output,
+        return exit status or None if agent is not running
+    """
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(AGENT_SOCKET_PATH):
+        return None
+    _sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        _sock.connect(AGENT_SOCKET_PATH)
+    except OSError:
+        _sock.close()
+        return None
+    _conn = BoConnection(_sock)
+    _conn.set_version(PROTOCOL_VERSION)
+    try:
+        _conn.send_message(json.dumps(_request))
+        while True:
+            _type, _payload = _conn.recv_frame()
+            if _type == FRAME_OUTPUT:
+                sys.stdout.buffer.write(_payload)
+                sys.stdout.buffer.flush()
+            elif _type == FRAME_EXIT:
+                return EXIT_STATUS.unpack(_payload)[0]
+            else:
+                raise BoProtocolError("Unexpected frame with type " + str(_type))
+    except (OSError, BoProtocolError) as _err:
+        fatal(23, "Connection to agent failed: " + str(_err))
+    finally:
+        _conn.close()
+    return None
+
+
+RESERVED_SUBCOMMAND_0 = ["config", "sync", "pull", "server", "remote", "agent"]
+
+
+def parse_args(_argv):
+    """ split command line to subcommands (padded by empty strings) and --options """
+    _subcommands = []
+    _options = {}
+    for _arg in _argv:
+        # arguments of remote command are not options of bo
+        if _arg.startswith("--") and _subcommands[:2] != ["remote", "run"]:
+            _name, _, _value = _arg[2:].partition("=")
+            _options[_name] = _value if _value != "" else True
+        else:
+            _subcommands.append(_arg)
+    while len(_subcommands) < 10:
+        _subcommands.append("")
+    return _subcommands, _options
 
-if "workdirs" not in BO_CONFIG:
-    BO_CONFIG["workdirs"] = {}
-# print(BO_HOME_CONFIG_DIR)
-# print(CURRENT_DIR)
 
-RESERVED_SUBCOMMAND_0 = ["config", "sync", "server", "remote"]
+def print_welcome():
+    """ print name and version """
+    print(
+        "Welcom to bo (" + VERSION + ")!\n"
+        "Utilite for sync files (like rsync) and "
+        "run build on remote server (or Virtual Machine in local network)\n"
+    )
 
-SUBCOMMANDS = []
-i = 1  # skip first element
-while i < len(sys.argv):
-    SUBCOMMANDS.append(sys.argv[i])
-    i += 1
-while len(SUBCOMMANDS) < 10:
-    SUBCOMMANDS.append("")
 
-if "help" in SUBCOMMANDS:
+def print_help():
+    """ print usage """
     print(
         "Usage:\n"
         "    'bo config init' - add current directory to config\n"
@@ -733,11 +4627,22 @@ if "help" in SUBCOMMANDS:
         "    'bo config ls' - print configs\n"
         "    'bo config path' - path to config file\n"
         "    'bo sync' - partial sync to remote server\n"
+        "    'bo sync [<server> ...]' - partial sync to named remote servers\n"
+        "    'bo sync --all' - partial sync to all configured remote servers\n"
+        "    'bo sync --watch' - keep syncing changed files to remote server\n"
+        "    'bo pull [<server>] [<glob> ...]' - download changed artifacts from remote server\n"
         "    'bo remote run <cmd> <arg1> <arg2> ... <argN>' - call command on remote host \n"
-        "    'bo server' - start server\n"
+        "    'bo remote --force-run run <cmd> ...' - call command, do not use cached result\n"
+        "    'bo remote stats [<server>] [--json]' - print metrics of server\n"
+        "    'bo <cmd_name> [<server>] [--sync] [--keep-going]' - run configured command\n"
+        "    'bo server [--host=<host>] [--port=<port>]' - start server\n"
+        "    'bo server --async [--max-connections=<n>] [--max-jobs=<n>]' - start async server\n"
+        "    'bo server --result-cache[=<MiB>]' - start server with cache of command results\n"
+        "    'bo agent' - start local agent which makes 'bo sync' and 'bo remote run' faster\n"
+        "    '--stats[=json]' - print metrics of run (time of phases, traffic, latency)\n"
+        "    '--verbose' - print details of protocol and every file\n"
         "\n"
     )
-    sys.exit(0)
 
 
 def find_root_bo_work_dir(_current_dir):
@@ -760,99 +4665,91 @@ def find_root_bo_work_dir(_current_dir):
     return _ret
 
 
-BO_WORKDIR = find_root_bo_work_dir(CURRENT_DIR)
-
-
-if BO_WORKDIR is not None:
-    print("Found workdir in config: ", BO_WORKDIR)
-
-if SUBCOMMANDS[0] == "config":
-    if SUBCOMMANDS[1] == "deinit":
-        if BO_WORKDIR is None:
-            fatal(5, "Not found initialize diretory: " + BO_WORKDIR)
-        print("Removing " + BO_WORKDIR + " from config\n")
-        del BO_CONFIG["workdirs"][BO_WORKDIR]
+def run_config(_subcommands, _current_dir, _workdir):
+    # pylint: disable=too-many-branches,too-many-statements
+    """ bo config ... """
+    if _subcommands[1] == "deinit":
+        if _workdir is None:
+            fatal(5, "Not found initialize diretory: " + _current_dir)
+        print("Removing " + _workdir + " from config\n")
+        del BO_CONFIG["workdirs"][_workdir]
         resave_config()
         print("Done.")
-    elif SUBCOMMANDS[1] == "init":
-        if BO_WORKDIR is not None:
-            fatal(4, "Already initialized directory: " + CURRENT_DIR)
-        SERVER0 = input("Server: ")
-        TARGET_DIR = input("Target dir: ")
-        _cache_filename = CURRENT_DIR + "|" + TARGET_DIR + "|" + SERVER0
-        CACHE_PATH = os.path.join(
+    elif _subcommands[1] == "init":
+        if _workdir is not None:
+            fatal(4, "Already initialized directory: " + _current_dir)
+        _server0 = input("Server: ")
+        _target_dir = input("Target dir: ")
+        _cache_filename = _current_dir + "|" + _target_dir + "|" + _server0
+        _cache_path = os.path.join(
             BO_HOME_CONFIG_DIR,
             hashlib.md5(_cache_filename.encode('utf-8')).hexdigest() + ".yml"
         )
-        BO_CONFIG["workdirs"][CURRENT_DIR] = {
+        BO_CONFIG["workdirs"][_current_dir] = {
             "servers": {
                 "base": {
-                    "host": SERVER0,
+                    "host": _server0,
                     "port": 4319,
-                    "target_dir": TARGET_DIR,
-                    "cache_path": CACHE_PATH,
+                    "target_dir": _target_dir,
+                    "cache_path": _cache_path,
                 }
             },
         }
         resave_config()
         print("Done.")
-        sys.exit(0)
-    elif SUBCOMMANDS[1] == "command":
-        if BO_WORKDIR is None:
-            fatal(4, "Not initialized current directory: " + CURRENT_DIR)
-        if "commands" not in BO_CONFIG["workdirs"][BO_WORKDIR]:
-            BO_CONFIG["workdirs"][BO_WORKDIR]["commands"] = {}
-        _cfg_cmds = BO_CONFIG["workdirs"][BO_WORKDIR]["commands"]
-        COMMAND_NAME = SUBCOMMANDS[2]  # possible get from command line params
-        if COMMAND_NAME == "":
-            COMMAND_NAME = input("Command Name: ").strip()
+    elif _subcommands[1] == "command":
+        if _workdir is None:
+            fatal(4, "Not initialized current directory: " + _current_dir)
+        if "commands" not in BO_CONFIG["workdirs"][_workdir]:
+            BO_CONFIG["workdirs"][_workdir]["commands"] = {}
+        _cfg_cmds = BO_CONFIG["workdirs"][_workdir]["commands"]
+        _command_name = _subcommands[2]  # possible get from command line params
+        if _command_name == "":
+            _command_name = input("Command Name: ").strip()
         else:
-            print("Command Name: " + COMMAND_NAME)
-        if COMMAND_NAME == "":
-            fatal(103, "Command '" + COMMAND_NAME + "' could not be empty")
-        if COMMAND_NAME in _cfg_cmds:
+            print("Command Name: " + _command_name)
+        if _command_name == "":
+            fatal(103, "Command '" + _command_name + "' could not be empty")
+        if _command_name in _cfg_cmds:
             fatal(
                 104,
-                "Command '" + COMMAND_NAME + "' - alredy defined, please " +
-                "try another command or remove: 'bo config remove-command " + COMMAND_NAME + "'"
+                "Command '" + _command_name + "' - alredy defined, please " +
+                "try another command or remove: 'bo config remove-command " + _command_name + "'"
             )
-        if COMMAND_NAME in RESERVED_SUBCOMMAND_0:
+        if _command_name in RESERVED_SUBCOMMAND_0:
             fatal(
                 105,
-                "Command '" + COMMAND_NAME + "' is reserved command name, " +
+                "Command '" + _command_name + "' is reserved command name, " +
                 "please try again with another name"
             )
-        _cfg_cmds[COMMAND_NAME] = []
-        NEW_COMMAND = "."
-        while NEW_COMMAND != "":
-            COMMAND = input("Command (empty string will be finish entry): ")
-            COMMAND = COMMAND.strip()
-            if COMMAND == "":
+        _cfg_cmds[_command_name] = []
+        while True:
+            _command = input("Command (empty string will be finish entry): ")
+            _command = _command.strip()
+            if _command == "":
                 break
-            _cfg_cmds[COMMAND_NAME].append(COMMAND)
-        BO_CONFIG["workdirs"][CURRENT_DIR]["commands"] = _cfg_cmds
+            _cfg_cmds[_command_name].append(_command)
+        BO_CONFIG["workdirs"][_current_dir]["commands"] = _cfg_cmds
         resave_config()
         print("Done.")
-        sys.exit(0)
-    elif SUBCOMMANDS[1] == "remove-command":
-        command_name = SUBCOMMANDS[2]
-        if command_name == "":
+    elif _subcommands[1] == "remove-command":
+        _command_name = _subcommands[2]
+        if _command_name == "":
             fatal(
                 110,
                 "Expected name of command for remove, like " +
                 "'bo config remove-command cmd_name' replace cmd_name to your existing command"
             )
-        if CURRENT_DIR not in BO_CONFIG["workdirs"]:
-            fatal(111, "Not initialized current directory: " + CURRENT_DIR)
-        if "commands" not in BO_CONFIG["workdirs"][CURRENT_DIR]:
-            BO_CONFIG["workdirs"][CURRENT_DIR]["commands"] = {}
-        if command_name not in BO_CONFIG["workdirs"][CURRENT_DIR]["commands"]:
-            fatal(112, "Not found registered command " + command_name)
-        del BO_CONFIG["workdirs"][CURRENT_DIR]["commands"][command_name]
+        if _current_dir not in BO_CONFIG["workdirs"]:
+            fatal(111, "Not initialized current directory: " + _current_dir)
+        if "commands" not in BO_CONFIG["workdirs"][_current_dir]:
+            BO_CONFIG["workdirs"][_current_dir]["commands"] = {}
+        if _command_name not in BO_CONFIG["workdirs"][_current_dir]["commands"]:
+            fatal(112, "Not found registered command " + _command_name)
+        del BO_CONFIG["workdirs"][_current_dir]["commands"][_command_name]
         resave_config()
         print("Done.")
-        sys.exit(0)
-    elif SUBCOMMANDS[1] == "ls":
+    elif _subcommands[1] == "ls":
         for _workdir in BO_CONFIG["workdirs"]:
             _item = BO_CONFIG["workdirs"][_workdir]
             print("Dir: " + _workdir)
@@ -863,85 +4760,301 @@ if SUBCOMMANDS[0] == "config":
                 print("     - Target Directory: " + _server["target_dir"])
                 print("     - Cache: " + _server["cache_path"])
         print("")
-        sys.exit(0)
-    elif SUBCOMMANDS[1] == "path":
+    elif _subcommands[1] == "path":
         print("BO_CONFIG_FILEPATH: " + BO_CONFIG_FILEPATH)
     else:
-        fatal(3, "Unknown sub command '" + SUBCOMMANDS[1] + "'")
-    sys.exit(0)
-
-if SUBCOMMANDS[0] == "sync":
-    if BO_WORKDIR is None:
-        fatal(6, "Not found config for directory '" + CURRENT_DIR + "'")
-    TO_SERVER = "base"
-    if SUBCOMMANDS[1] in BO_CONFIG["workdirs"][BO_WORKDIR]["servers"]:
-        TO_SERVER = SUBCOMMANDS[1]
-    cfg = BO_CONFIG["workdirs"][BO_WORKDIR]["servers"][TO_SERVER]
-    SERVER_HOST = cfg["host"]
-    SERVER_PORT = cfg["port"]
-    TARGET_DIR = cfg["target_dir"]
+        fatal(3, "Unknown sub command '" + _subcommands[1] + "'")
+    return 0
+
+
+def sync_to_servers(_targets):
+    """
+        push to several servers at once, each in own thread
+        targets - list of (server name, BoSocketClient, BoFilesCache)
+        return dict: server name -> None or reason of fail
+    """
+    _results = {}
+
+    def _sync(_name, _client, _files):
+        try:
+            _client.run_sync(_files)
+            _results[_name] = None
+        except SystemExit:
+            # fatal() already printed the reason
+            _results[_name] = "failed"
+        except Exception as _err:  # pylint: disable=broad-except
+            _results[_name] = "failed: " + str(_err)
+        print("Server '" + _name + "': " + (_results[_name] or "done"))
+
+    _threads = []
+    for _target in _targets:
+        _thread = threading.Thread(target=_sync, args=_target, name="sync-" + _target[0])
+        _thread.start()
+        _threads.append(_thread)
+    for _thread in _threads:
+        _thread.join()
+    return _results
+
+
+def select_servers(_cfg_servers, _names, _all=False):
+    """ configured servers named in arguments, all of them or 'base' """
+    if _all:
+        return list(_cfg_servers)
+    _selected = [_name for _name in _names if _name in _cfg_servers]
+    return list(dict.fromkeys(_selected)) or ["base"]
+
+
+def get_ignore_names(_workdir_cfg):
+    """ names of files with ignore rules used for workdir """
+    if not _workdir_cfg.get("use_gitignore", True):
+        return (".boignore",)
+    return IGNORE_FILES
+
+
+def new_sync_target(_workdir, _workdir_cfg, _server_cfg, _scan):
+    """ return client and cache of server updated by scan of workdir """
     print(
-        "Start syncing files\n    >from: " + BO_WORKDIR + " \n"
-        "    >to: " + SERVER_HOST + ":" + str(SERVER_PORT)
+        "Start syncing files\n    >from: " + _workdir + " \n"
+        "    >to: " + _server_cfg["host"] + ":" + str(_server_cfg["port"])
     )
-    cache_path = cfg["cache_path"]
-    FILES = BoFilesCache(cache_path)
-
-    FILES.rescan_files(BO_WORKDIR)
-    start = time.time()
+    _files = BoFilesCache(
+        _server_cfg["cache_path"], _workdir_cfg.get("hash_algo", "md5"),
+        get_ignore_names(_workdir_cfg)
+    )
+    _files.rescan_files(_workdir, _scan)
+    _start = time.time()
     print("Updating cache...")
-    FILES.resave_cache()
-    end = time.time()
-    print("Done. Elapsed ", end - start, "sec")
-    client = BoSocketClient({
-        "target_dir": TARGET_DIR,
-        "server_host": SERVER_HOST,
-        "server_port": SERVER_PORT,
+    _files.resave_cache()
+    print("Done. Elapsed ", time.time() - _start, "sec")
+    _client = BoSocketClient({
+        "workdir": _workdir,
+        "target_dir": _server_cfg["target_dir"],
+        "server_host": _server_cfg["host"],
+        "server_port": _server_cfg["port"],
+        "protocol": _server_cfg.get("protocol", PROTOCOL_VERSION),
+        "delta_min_size": _workdir_cfg.get("delta_min_size", DELTA_MIN_SIZE),
+        "compression": _workdir_cfg.get("compression", "auto"),
+        "streams": _workdir_cfg.get("streams", 1),
+    })
+    return _client, _files
+
+
+def run_sync_command(_subcommands, _options, _workdir):
+    """ bo sync ... """
+    _cfg_servers = BO_CONFIG["workdirs"][_workdir]["servers"]
+    _to_servers = select_servers(_cfg_servers, _subcommands[1:], _options.get("all", False))
+    if _options.get("watch", False) and len(_to_servers) > 1:
+        fatal(16, "Watch mode supports only one server")
+    _ignore_names = get_ignore_names(BO_CONFIG["workdirs"][_workdir])
+
+    _watcher = None
+    if _options.get("watch", False):
+        # watch before scan, so changes made while scanning are not lost
+        _watcher = new_watcher(_workdir, _ignore_names)
+    # one scan and hashing for all servers, required_sync is tracked by cache of each server
+    _scan = BoWorkdirScan(_workdir, _ignore_names)
+    _targets = []
+    for _to_server in _to_servers:
+        _client, _files = new_sync_target(
+            _workdir, BO_CONFIG["workdirs"][_workdir], _cfg_servers[_to_server], _scan
+        )
+        _targets.append((_to_server, _client, _files))
+    if _watcher is not None:
+        _client.run_watch(_files, _watcher)
+        return 0
+    if len(_targets) == 1:
+        _client.run_sync(_files)
+        return 0
+    _failed = [_name for _name, _reason in sync_to_servers(_targets).items() if _reason]
+    if _failed:
+        fatal(17, "Sync failed for servers: " + ", ".join(_failed))
+    return 0
+
+
+def run_pull_command(_subcommands, _workdir):
+    """ bo pull ... """
+    _workdir_cfg = BO_CONFIG["workdirs"][_workdir]
+    _to_server = "base"
+    _patterns = [_arg for _arg in _subcommands[1:] if _arg != ""]
+    if _patterns and _patterns[0] in _workdir_cfg["servers"]:
+        _to_server = _patterns.pop(0)
+    _patterns = _patterns or _workdir_cfg.get("artifacts", [])
+    if not _patterns:
+        fatal(19, "Nothing to pull, set 'artifacts' in the workdir config")
+    _cfg = _workdir_cfg["servers"][_to_server]
+    print("Pull artifacts " + str(_patterns) + " from " + _cfg["host"] + ":" + str(_cfg["port"]))
+    # hashes of pulled files, like cache of sync but in reverse direction
+    _files = BoFilesCache(
+        os.path.splitext(_cfg["cache_path"])[0] + "_artifacts.yml",
+        _workdir_cfg.get("hash_algo", "md5"), ()
+    )
+    _client = BoSocketClient({
+        "target_dir": _cfg["target_dir"],
+        "server_host": _cfg["host"],
+        "server_port": _cfg["port"],
+        "protocol": _cfg.get("protocol", PROTOCOL_VERSION),
+        "compression": _workdir_cfg.get("compression", "auto"),
     })
-    client.run_sync(FILES)
-
-if SUBCOMMANDS[0] == "server":
-    bo_server = BoServer("", 4319)
-    bo_server.start()
-
-if SUBCOMMANDS[0] == "remote":
-    TO_SERVER = "base"
-    if SUBCOMMANDS[2] in BO_CONFIG["workdirs"][BO_WORKDIR]["servers"]:
-        TO_SERVER = SUBCOMMANDS[2]
-    cfg = BO_CONFIG["workdirs"][BO_WORKDIR]["servers"][TO_SERVER]
-    SERVER_HOST = cfg["host"]
-    SERVER_PORT = cfg["port"]
-    TARGET_DIR = cfg["target_dir"]
-
-    if SUBCOMMANDS[1] == "run":
-        print("Run command on remote host " + SERVER_HOST + ":" + str(SERVER_PORT))
-        client = BoSocketClient({
-            "target_dir": TARGET_DIR,
-            "server_host": SERVER_HOST,
-            "server_port": SERVER_PORT,
+    return 1 if _client.run_pull(_patterns, _files, _workdir) else 0
+
+
+def run_server_command(_options):
+    """ bo server ... """
+    _host = str(_options.get("host", ""))
+    _port = int(_options.get("port", SERVER_PORT))
+    # --result-cache=<size in MiB>
+    _result_cache_size = _options.get("result-cache", False)
+    if _result_cache_size is True:
+        _result_cache_size = RESULT_CACHE_SIZE
+    else:
+        _result_cache_size = int(_result_cache_size) * 1024 * 1024
+    if _options.get("async", False):
+        _server = BoAsyncServer(
+            _host, _port,
+            int(_options.get("max-connections", SERVER_MAX_CONNECTIONS)),
+            int(_options.get("max-jobs", SERVER_MAX_JOBS)),
+            _result_cache_size,
+        )
+    else:
+        _server = BoServer(_host, _port, _result_cache_size)
+    _server.start()
+    return 0
+
+
+def run_remote_command(_subcommands, _options, _current_dir, _workdir):
+    """ bo remote run ... """
+    _to_server = "base"
+    if _subcommands[2] in BO_CONFIG["workdirs"][_workdir]["servers"]:
+        _to_server = _subcommands[2]
+    _cfg = BO_CONFIG["workdirs"][_workdir]["servers"][_to_server]
+
+    if _subcommands[1] == "run":
+        print("Run command on remote host " + _cfg["host"] + ":" + str(_cfg["port"]))
+        _client = BoSocketClient({
+            "target_dir": _cfg["target_dir"],
+            "server_host": _cfg["host"],
+            "server_port": _cfg["port"],
+            "protocol": _cfg.get("protocol", PROTOCOL_VERSION),
+        })
+        _commands = _subcommands[2:]
+        while _commands[-1] == "":
+            _commands = _commands[:-1]
+        return _client.run_command(
+            _current_dir[len(_workdir)+1:], _commands, _options.get("force-run", False)
+        )
+    if _subcommands[1] == "stats":
+        _client = BoSocketClient({
+            "target_dir": _cfg["target_dir"],
+            "server_host": _cfg["host"],
+            "server_port": _cfg["port"],
+            "protocol": _cfg.get("protocol", PROTOCOL_VERSION),
         })
-        _SUB_DIR = CURRENT_DIR[len(BO_WORKDIR)+1:]
-        _COMMANDS = SUBCOMMANDS[2:]
-        while _COMMANDS[-1] == "":
-            _COMMANDS = _COMMANDS[:-1]
-        client.run_command(_SUB_DIR, _COMMANDS)
-        sys.exit(0)
-    # elif SUBCOMMANDS[1] == "nowait-run":
-    #     sys.exit(0)
-    # elif SUBCOMMANDS[1] == "kill-process":
-    #     sys.exit(0)
+        print_stats(_client.get_server_stats(), "json" if _options.get("json", False) else "")
+        return 0
+    # elif _subcommands[1] == "nowait-run":
+    # elif _subcommands[1] == "kill-process":
+    return "Unknown subcomannd for remote '" + _subcommands[1] + "'"
+
+
+def run_workdir_command(_subcommands, _options, _current_dir, _workdir):
+    """ bo <cmd_name> ... - command stack configured for workdir """
+    _workdir_cfg = BO_CONFIG["workdirs"][_workdir]
+    _command = _subcommands[0]
+    print("Found command ", _command)
+    try:
+        _steps = parse_command_stack(_workdir_cfg['commands'][_command])
+    except ValueError as _err:
+        fatal(18, "Wrong command '" + _command + "': " + str(_err))
+    _to_server = "base"
+    if _subcommands[1] in _workdir_cfg["servers"]:
+        _to_server = _subcommands[1]
+    _cfg = _workdir_cfg["servers"][_to_server]
+    _files = None
+    if _options.get("sync", _workdir_cfg.get("sync_before_commands", False)):
+        _client, _files = new_sync_target(
+            _workdir, _workdir_cfg, _cfg,
+            BoWorkdirScan(_workdir, get_ignore_names(_workdir_cfg))
+        )
+    else:
+        _client = BoSocketClient({
+            "target_dir": _cfg["target_dir"],
+            "server_host": _cfg["host"],
+            "server_port": _cfg["port"],
+            "protocol": _cfg.get("protocol", PROTOCOL_VERSION),
+        })
+    print("Run command stack on remote host " + _cfg["host"] + ":" + str(_cfg["port"]))
+    return _client.run_stack(
+        _current_dir[len(_workdir)+1:], _steps, _files, not _options.get("keep-going", False)
+    )
+
+
+def print_stats(_stats, _format):
+    """ print metrics as text or json """
+    if _format == "json":
+        print(json.dumps(_stats))
     else:
-        sys.exit("Unknown subcomannd for remote '" + SUBCOMMANDS[1] + "'")
+        print(BoStats.report(_stats))
+
+
+def run_subcommand(_subcommands, _options):  # pylint: disable=too-many-return-statements
+    """
+        dispatch subcommand first, so each subcommand pays only for
+        what it uses (help and server do not read config)
+    """
+    if "help" in _subcommands:
+        print_help()
+        return 0
+    if _subcommands[0] == "server":
+        return run_server_command(_options)
+    if _subcommands[0] == "agent":
+        init_home_config_dir()
+        BoAgent(AGENT_SOCKET_PATH).start()
+        return 0
+
+    _current_dir = os.path.normpath(os.path.realpath(os.getcwd()))
+    # served by running agent without loading of config and caches,
+    # stats are measured only by own run
+    if not _options.get("no-agent", False) and not _options.get("stats", False) and (
+        (_subcommands[0] == "sync" and not _options.get("watch", False))
+        or _subcommands[:2] == ["remote", "run"]
+    ):
+        _status = run_by_agent({"cwd": _current_dir, "argv": _subcommands, "options": _options})
+        if _status is not None:
+            return _status
+
+    load_config()
+    _workdir = find_root_bo_work_dir(_current_dir)
+    if _workdir is not None:
+        print("Found workdir in config: ", _workdir)
+
+    if _subcommands[0] == "config":
+        return run_config(_subcommands, _current_dir, _workdir)
+    if _subcommands[0] in ("sync", "pull", "remote") and _workdir is None:
+        fatal(6, "Not found config for directory '" + _current_dir + "'")
+    if _subcommands[0] == "sync":
+        return run_sync_command(_subcommands, _options, _workdir)
+    if _subcommands[0] == "pull":
+        return run_pull_command(_subcommands, _workdir)
+    if _subcommands[0] == "remote":
+        return run_remote_command(_subcommands, _options, _current_dir, _workdir)
+    if _workdir is not None and _subcommands[0] in BO_CONFIG["workdirs"][_workdir].get(
+        "commands", {}
+    ):
+        return run_workdir_command(_subcommands, _options, _current_dir, _workdir)
+    return "Could not understand please call 'bo help'"
+
 
-if BO_WORKDIR is not None:
-    WORKDIR_CFG = BO_CONFIG["workdirs"][BO_WORKDIR]
-    if 'commands' in WORKDIR_CFG and SUBCOMMANDS[0] in WORKDIR_CFG['commands']:
-        _command = SUBCOMMANDS[0]
-        _commands = BO_CONFIG["workdirs"][BO_WORKDIR]['commands'][_command]
-        print("Found command ", _command)
-        for _cmd in _commands:
-            print("TODO run> ", _cmd)
-        sys.exit(0)
+def main():
+    """ entry point """
+    _subcommands, _options = parse_args(sys.argv[1:])
+    if _options.get("verbose", False):
+        BO_LOG["level"] = LOG_DEBUG
+    print_welcome()
+    _status = run_subcommand(_subcommands, _options)
+    if _options.get("stats", False):
+        print_stats(STATS.to_dict(), _options["stats"])
+    return _status
 
 
-sys.exit("Could not understand please call 'bo help'")
+if __name__ == "__main__":
+    sys.exit(main())
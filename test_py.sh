@@ -20,3 +20,18 @@ check_ret $? "pylint bo.py"
 
 python3 -m pycodestyle --max-line-length=100 bo.py
 check_ret $? "pycodestyle bo.py"
+
+python3 -m pylint benchmarks/*.py
+check_ret $? "pylint benchmarks"
+
+python3 -m pycodestyle --max-line-length=100 benchmarks/*.py
+check_ret $? "pycodestyle benchmarks"
+
+python3 -m pylint tests/*.py
+check_ret $? "pylint tests"
+
+python3 -m pycodestyle --max-line-length=100 tests/*.py
+check_ret $? "pycodestyle tests"
+
+python3 -m pytest -q tests
+check_ret $? "pytest tests"
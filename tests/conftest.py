@@ -0,0 +1,171 @@
+"""
+Local bo server and workdir for tests
+
+Every test gets temporary homes of client and server, a workdir and a target dir.
+bo is started by command line like by user, config of workdir is written as JSON
+(yaml is superset of json).
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest  # pylint: disable=import-error
+
+BO_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bo.py")
+sys.path.insert(0, os.path.dirname(BO_PY))
+
+
+def free_port():
+    """ free tcp port on loopback """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as _sock:
+        _sock.bind(("127.0.0.1", 0))
+        return _sock.getsockname()[1]
+
+
+def wait_for(_check, _timeout=10.0):
+    """ wait until check() is true """
+    _deadline = time.time() + _timeout
+    while not _check():
+        if time.time() > _deadline:
+            raise TimeoutError("condition is not reached in time")
+        time.sleep(0.05)
+
+
+class BoEnv:  # pylint: disable=too-many-instance-attributes
+    """ temporary client home, workdir and local server """
+
+    def __init__(self, _root):
+        self.root = _root
+        self.home = os.path.join(_root, "home")
+        self.server_home = os.path.join(_root, "server-home")
+        self.workdir = os.path.join(_root, "workdir")
+        self.target_dir = os.path.join(_root, "target")
+        self.port = free_port()
+        self.__server = None
+        self.__server_log = None
+        for _dir in (self.home, self.server_home, self.workdir, self.target_dir):
+            os.makedirs(_dir)
+        self.__env = dict(os.environ, HOME=self.home, PYTHONUNBUFFERED="1")
+        self.configure()
+
+    def start_server(self, *_args):
+        """ start 'bo server' on loopback and wait until it listens """
+        self.stop_server()
+        self.__server_log = open(  # pylint: disable=consider-using-with
+            os.path.join(self.root, "server.log"), "a", encoding="utf-8"
+        )
+        self.__server = subprocess.Popen(  # pylint: disable=consider-using-with
+            [sys.executable, BO_PY, "server", "--host=127.0.0.1", "--port=" + str(self.port)]
+            + list(_args),
+            cwd=self.root, env=dict(self.__env, HOME=self.server_home),
+            stdout=self.__server_log, stderr=subprocess.STDOUT,
+        )
+
+        def _is_listening():
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as _sock:
+                return _sock.connect_ex(("127.0.0.1", self.port)) == 0
+        wait_for(_is_listening)
+
+    def stop_server(self):
+        """ stop server if it is running """
+        if self.__server is not None:
+            self.__server.terminate()
+            self.__server.wait()
+            self.__server = None
+            self.__server_log.close()
+
+    def server_log(self):
+        """ output of server """
+        with open(os.path.join(self.root, "server.log"), encoding="utf-8") as _file:
+            return _file.read()
+
+    def configure(self, _server=None, _servers=None, **_workdir_cfg):
+        """ write config with the workdir, 'base' server and other servers """
+        _base = {
+            "host": "127.0.0.1",
+            "port": self.port,
+            "target_dir": self.target_dir,
+            "cache_path": os.path.join(self.home, "cache.yml"),
+        }
+        _base.update(_server or {})
+        _workdir_cfg["servers"] = dict(_servers or {}, base=_base)
+        os.makedirs(os.path.join(self.home, ".bo-by-sea5kg"), exist_ok=True)
+        with open(os.path.join(self.home, ".bo-by-sea5kg", "config.yml"), "w",
+                  encoding="utf-8") as _file:
+            json.dump({"bo_version": "", "workdirs": {self.workdir: _workdir_cfg}}, _file)
+
+    def bo(self, *_args, _check=True):
+        """ run bo in workdir, return completed process with text output """
+        _proc = subprocess.run(
+            [sys.executable, BO_PY] + list(_args), cwd=self.workdir, env=self.__env,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, check=False,
+            timeout=120,
+        )
+        if _check and _proc.returncode != 0:
+            raise AssertionError("bo " + " ".join(_args) + " failed:\n" + _proc.stdout)
+        return _proc
+
+    def sync(self):
+        """ bo sync without agent, return output """
+        return self.bo("sync", "--no-agent").stdout
+
+    def run(self, *_cmd):
+        """ bo remote run without agent, return completed process """
+        return self.bo("remote", "--no-agent", "run", *_cmd, _check=False)
+
+    def write(self, _path, _content):
+        """ create or rewrite file of workdir """
+        _fullpath = os.path.join(self.workdir, _path)
+        os.makedirs(os.path.dirname(_fullpath), exist_ok=True)
+        with open(_fullpath, "wb") as _file:
+            _file.write(_content if isinstance(_content, bytes) else _content.encode("utf-8"))
+
+    def target(self, _path):
+        """ content of synced file in target dir or None """
+        try:
+            with open(os.path.join(self.target_dir, _path), "rb") as _file:
+                return _file.read()
+        except FileNotFoundError:
+            return None
+
+    def assert_synced(self):
+        """ target dir has the same files as workdir, without temporary files """
+        _source = {}
+        for _dirpath, _, _filenames in os.walk(self.workdir):
+            for _name in _filenames:
+                _path = os.path.relpath(os.path.join(_dirpath, _name), self.workdir)
+                with open(os.path.join(_dirpath, _name), "rb") as _file:
+                    _source[_path] = _file.read()
+        _target = {}
+        for _dirpath, _, _filenames in os.walk(self.target_dir):
+            for _name in _filenames:
+                _path = os.path.relpath(os.path.join(_dirpath, _name), self.target_dir)
+                _target[_path] = self.target(_path)
+        assert _target == _source
+
+
+@pytest.fixture(name="bo_env")
+def fixture_bo_env(tmp_path):
+    """ environment with running server """
+    _env = BoEnv(str(tmp_path))
+    _env.start_server()
+    yield _env
+    _env.stop_server()
+
+
+@pytest.fixture(name="hashed")
+def fixture_hashed(monkeypatch):
+    """ list of files which are hashed by client """
+    import bo  # pylint: disable=import-error,import-outside-toplevel
+    _hashed = []
+    _hash_files = bo.hash_files
+
+    def _count_hash_files(_workdir, _files, *_args):
+        _hashed.extend(_files)
+        return _hash_files(_workdir, _files, *_args)
+    monkeypatch.setattr(bo, "hash_files", _count_hash_files)
+    return _hashed
@@ -0,0 +1,34 @@
+""" workdir state kept by agent between requests """
+
+import os
+
+import bo  # pylint: disable=import-error
+
+
+def test_one_scan_for_all_servers(bo_env, hashed):
+    """ files are scanned and hashed once for caches of all servers, changes too """
+    _servers = {
+        _name: {
+            "host": "127.0.0.1",
+            "port": bo_env.port,
+            "target_dir": os.path.join(bo_env.root, _name),
+            "cache_path": os.path.join(bo_env.home, _name + ".yml"),
+        } for _name in ("base", "second")
+    }
+    bo_env.write("a.txt", "a")
+    bo_env.write("dir/b.txt", "b")
+    _workdir = bo.BoAgentWorkdir(bo_env.workdir, {"servers": _servers})
+    try:
+        assert _workdir.sync(["base", "second"]) == 0
+        assert sorted(hashed) == ["a.txt", os.path.join("dir", "b.txt")]
+        del hashed[:]
+        bo_env.write("a.txt", "changed")
+        bo_env.write("dir/c.txt", "c")
+        assert _workdir.sync(["base", "second"]) == 0
+        assert sorted(hashed) == ["a.txt", os.path.join("dir", "c.txt")]
+    finally:
+        _workdir.close()
+    for _name in ("base", "second"):
+        with open(os.path.join(bo_env.root, _name, "a.txt"), encoding="utf-8") as _file:
+            assert _file.read() == "changed"
+        assert os.path.isfile(os.path.join(bo_env.root, _name, "dir", "c.txt"))
@@ -0,0 +1,31 @@
+""" server started with --async """
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from conftest import BO_PY, wait_for  # pylint: disable=import-error
+
+
+def test_sync_while_jobs_are_busy(bo_env):
+    """ running command takes the only job slot, but sync and stalled client are served """
+    bo_env.start_server("--async", "--max-jobs=1")
+    _marker = os.path.join(bo_env.root, "started")
+    _long = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, BO_PY, "remote", "--no-agent", "run", "touch " + _marker + "; sleep 3"],
+        cwd=bo_env.workdir, env=dict(os.environ, HOME=bo_env.home),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    with socket.create_connection(("127.0.0.1", bo_env.port)):
+        try:
+            wait_for(lambda: os.path.exists(_marker))
+            bo_env.write("a.txt", "a")
+            _start = time.time()
+            assert "Accepted: 1, failed: 0" in bo_env.sync()
+            assert time.time() - _start < 2
+        finally:
+            _long.wait()
+    bo_env.assert_synced()
+    assert bo_env.run("echo after").returncode == 0
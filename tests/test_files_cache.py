@@ -0,0 +1,132 @@
+""" client cache of files: migration from yaml, fingerprints, hash algorithm """
+
+import hashlib
+import os
+import shutil
+
+import pytest  # pylint: disable=import-error
+
+import bo  # pylint: disable=import-error
+
+
+def write(_path, _content):
+    """ create or rewrite file """
+    os.makedirs(os.path.dirname(_path), exist_ok=True)
+    with open(_path, "w", encoding="utf-8") as _file:
+        _file.write(_content)
+
+
+def synced_cache(_cache_path, _workdir, _hash_algo="md5"):
+    """ cache after scan where all files are synced """
+    _files = bo.BoFilesCache(_cache_path, _hash_algo)
+    _files.rescan_files(_workdir)
+    for _file in list(_files.get_files_to_update()):
+        _files.update(_file, {"required_sync": "NONE"})
+    _files.resave_cache()
+    return _files
+
+
+def test_migration_from_yaml(tmp_path, hashed):
+    """ cache of previous version is moved to database once, its hashes are trusted """
+    import yaml  # pylint: disable=import-error,import-outside-toplevel
+    _workdir = str(tmp_path / "workdir")
+    write(os.path.join(_workdir, "a.txt"), "synced")
+    write(os.path.join(_workdir, "b.txt"), "not synced yet")
+    _cache_path = str(tmp_path / "cache.yml")
+    _legacy = {}
+    for _name, _required_sync in (("a.txt", "NONE"), ("b.txt", "UPDATE"), ("gone.txt", "NONE")):
+        _fullpath = os.path.join(_workdir, _name)
+        _legacy[_name] = {
+            "required_sync": _required_sync,
+            "md5": hashlib.md5(_name.encode()).hexdigest(),
+            "size": 1,
+            "last_modify": 0.0,
+        }
+        if os.path.isfile(_fullpath):
+            with open(_fullpath, "rb") as _file:
+                _legacy[_name]["md5"] = hashlib.md5(_file.read()).hexdigest()
+            _legacy[_name]["size"] = os.path.getsize(_fullpath)
+            _legacy[_name]["last_modify"] = os.path.getmtime(_fullpath)
+    with open(_cache_path, "w", encoding="utf-8") as _file:
+        yaml.safe_dump(_legacy, _file)
+    write(str(tmp_path / "cache_to_update.yml"), "{}")
+
+    _files = bo.BoFilesCache(_cache_path)
+    assert os.path.isfile(_cache_path + ".migrated")
+    assert not os.path.exists(_cache_path)
+    assert not os.path.exists(str(tmp_path / "cache_to_update.yml"))
+    assert bo.get_file_hash(_files.get("a.txt")) == ("md5", _legacy["a.txt"]["md5"])
+    assert sorted(_files.get_files_to_update()) == ["b.txt"]
+    _files.rescan_files(_workdir)
+    _files.resave_cache()
+    # mtime of previous version is trusted once, then fingerprint is kept
+    assert not hashed
+    assert sorted(_files.get_files_to_update()) == ["b.txt", "gone.txt"]
+    assert _files.get("gone.txt")["required_sync"] == "DELETE"
+
+    _files = bo.BoFilesCache(_cache_path)
+    assert "fingerprint" in _files.get("a.txt")
+    assert _files.get("a.txt")["required_sync"] == "NONE"
+    _files.rescan_files(_workdir)
+    assert not hashed
+
+
+@pytest.mark.parametrize("_change", ["size", "mtime", "inode", "ctime"])
+def test_fingerprint_change(tmp_path, hashed, _change):
+    """ every part of fingerprint makes file hashed again, same content is not sent """
+    _workdir = str(tmp_path / "workdir")
+    _path = os.path.join(_workdir, "a.txt")
+    write(_path, "content")
+    _cache_path = str(tmp_path / "cache.yml")
+    synced_cache(_cache_path, _workdir)
+    del hashed[:]
+    _stat = os.stat(_path)
+    _content = "content"
+    if _change == "size":
+        _content = "longer content"
+        write(_path, _content)
+        os.utime(_path, ns=(_stat.st_atime_ns, _stat.st_mtime_ns))
+    elif _change == "mtime":
+        os.utime(_path, ns=(_stat.st_atime_ns, _stat.st_mtime_ns + 1000))
+    elif _change == "inode":
+        shutil.copy2(_path, _path + ".new")
+        os.replace(_path + ".new", _path)
+    else:
+        os.chmod(_path, 0o600)
+    _files = bo.BoFilesCache(_cache_path)
+    _files.rescan_files(_workdir)
+    assert hashed == ["a.txt"]
+    assert _files.get("a.txt")["fingerprint"] == bo.BoScannedFile(os.stat(_path)).fingerprint()
+    _expected = "NONE" if _content == "content" else "UPDATE"
+    assert _files.get("a.txt")["required_sync"] == _expected
+
+
+def test_switch_hash_algo(tmp_path, hashed):
+    """ unchanged files keep hashes of previous algorithm, changed ones get the new one """
+    _workdir = str(tmp_path / "workdir")
+    write(os.path.join(_workdir, "a.txt"), "a")
+    write(os.path.join(_workdir, "b.txt"), "b")
+    _cache_path = str(tmp_path / "cache.yml")
+    synced_cache(_cache_path, _workdir, "md5")
+    del hashed[:]
+    write(os.path.join(_workdir, "b.txt"), "changed")
+    _files = bo.BoFilesCache(_cache_path, "sha256")
+    _files.rescan_files(_workdir)
+    assert hashed == ["b.txt"]
+    assert bo.get_file_hash(_files.get("a.txt")) == ("md5", hashlib.md5(b"a").hexdigest())
+    assert bo.get_file_hash(_files.get("b.txt")) == (
+        "sha256", hashlib.sha256(b"changed").hexdigest()
+    )
+    assert sorted(_files.get_files_to_update()) == ["b.txt"]
+
+
+def test_sync_after_switch_of_hash_algo(bo_env):
+    """ server accepts files of both algorithms in one cache """
+    bo_env.write("a.txt", "a")
+    bo_env.write("b.txt", "b")
+    bo_env.sync()
+    bo_env.configure(hash_algo="sha256")
+    bo_env.write("b.txt", "changed")
+    bo_env.write("c.txt", "c")
+    assert "Accepted: 2, failed: 0" in bo_env.sync()
+    bo_env.assert_synced()
@@ -0,0 +1,107 @@
+""" files matched by .gitignore and .boignore """
+
+import os
+
+import bo  # pylint: disable=import-error
+
+
+def test_deleted_file_with_ignored_prefix(bo_env):
+    """ ignored file is not a prefix: deleted app.log.txt is deleted on server """
+    bo_env.write(".gitignore", "app.log\n")
+    bo_env.write("app.log.txt", "not ignored")
+    bo_env.sync()
+    assert bo_env.target("app.log.txt") == b"not ignored"
+    os.remove(os.path.join(bo_env.workdir, "app.log.txt"))
+    bo_env.write("app.log", "ignored")
+    assert "Deleted: 1" in bo_env.sync()
+    assert bo_env.target("app.log.txt") is None
+    assert bo_env.target("app.log") is None
+
+
+def write_tree(_root, _files):
+    """ create files with their paths as content """
+    for _path, _content in _files.items():
+        _fullpath = os.path.join(_root, _path)
+        os.makedirs(os.path.dirname(_fullpath), exist_ok=True)
+        with open(_fullpath, "w", encoding="utf-8") as _file:
+            _file.write(_path if _content is None else _content)
+
+
+def scanned(_root, _names=bo.IGNORE_FILES):
+    """ files found by scan of workdir """
+    return sorted(bo.BoWorkdirScan(_root, _names).get_files())
+
+
+def test_gitignore_rules(tmp_path):
+    """ negation, anchored, ** and dir-only rules """
+    write_tree(str(tmp_path), {
+        ".gitignore": "*.log\n!keep.log\n/root.txt\nbuild/\nout/\ndocs/**/*.tmp\n",
+        "a.log": None,
+        "keep.log": None,
+        "sub/b.log": None,
+        "sub/keep.log": None,
+        "root.txt": None,
+        "sub/root.txt": None,
+        "build/x.o": None,
+        "sub/build/y.o": None,
+        "out": None,
+        "docs/c.tmp": None,
+        "docs/a/b/c.tmp": None,
+        "docs/a/c.txt": None,
+        "other/c.tmp": None,
+    })
+    assert scanned(str(tmp_path)) == [
+        ".gitignore", "docs/a/c.txt", "keep.log", "other/c.tmp", "out",
+        "sub/keep.log", "sub/root.txt",
+    ]
+
+
+def test_ignored_directory_is_pruned(tmp_path):
+    """ ignored directory is reported once and not descended into """
+    write_tree(str(tmp_path), {
+        ".boignore": "node_modules/\n",
+        "node_modules/a/index.js": None,
+        "src/node_modules/b.js": None,
+        "src/main.js": None,
+    })
+    _scan = bo.BoWorkdirScan(str(tmp_path), bo.IGNORE_FILES)
+    assert sorted(_scan.get_files()) == [".boignore", "src/main.js"]
+    assert sorted(_scan.get_ignored()) == ["node_modules/", "src/node_modules/"]
+
+
+def test_nested_ignore_files(tmp_path):
+    """ deeper ignore files override upper ones, .boignore goes after .gitignore """
+    write_tree(str(tmp_path), {
+        ".gitignore": "*.txt\n",
+        "a.txt": None,
+        "sub/.gitignore": "!*.txt\n",
+        "sub/.boignore": "secret.txt\n",
+        "sub/a.txt": None,
+        "sub/secret.txt": None,
+        "sub/deeper/b.txt": None,
+        "sub/deeper/secret.txt": None,
+    })
+    assert scanned(str(tmp_path)) == [
+        ".gitignore", "sub/.boignore", "sub/.gitignore", "sub/a.txt", "sub/deeper/b.txt",
+    ]
+    # only .boignore with use_gitignore: false
+    assert scanned(str(tmp_path), (".boignore",)) == [
+        ".gitignore", "a.txt", "sub/.boignore", "sub/.gitignore", "sub/a.txt",
+        "sub/deeper/b.txt",
+    ]
+
+
+def test_ignored_later_is_kept_on_server(bo_env):
+    """ synced file which becomes ignored is forgotten without DELETE, copy on server stays """
+    bo_env.write("out/result.bin", "built")
+    bo_env.write("main.c", "int main;")
+    bo_env.sync()
+    bo_env.write(".boignore", "out/\n")
+    _output = bo_env.sync()
+    assert "Deleted: 0" in _output
+    assert bo_env.target("out/result.bin") == b"built"
+    # not ignored again: file is known as new and sent
+    os.remove(os.path.join(bo_env.workdir, ".boignore"))
+    bo_env.write("out/result.bin", "built again")
+    bo_env.sync()
+    bo_env.assert_synced()
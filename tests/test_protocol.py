@@ -0,0 +1,70 @@
+""" negotiation of protocol between client and server """
+
+import socket
+import threading
+
+import pytest  # pylint: disable=import-error
+
+import bo  # pylint: disable=import-error
+
+
+def read_banner(_sock):
+    """ banner of server up to question about target dir """
+    _banner = b""
+    while not _banner.endswith(b"target_dir? "):
+        _banner += _sock.recv(1024)
+    return _banner.decode("utf-8")
+
+
+def test_server_accepts_supported_version(bo_env):
+    """ server announces protocols and answers with the highest common version """
+    with socket.create_connection(("127.0.0.1", bo_env.port)) as _sock:
+        assert "protocols: 1 " + str(bo.PROTOCOL_VERSION) in read_banner(_sock)
+        _sock.sendall(b"PROTOCOL 99\n")
+        assert _sock.recv(1024) == b"ACCEPTED " + str(bo.PROTOCOL_VERSION).encode()
+
+
+def test_fallback_to_old_server():
+    """ server which does not announce protocols is served by protocol 1 """
+    _listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    _listener.bind(("127.0.0.1", 0))
+    _listener.listen(1)
+    _received = []
+
+    def _old_server():
+        _conn, _ = _listener.accept()
+        with _conn:
+            _conn.sendall(b"Welcome to bo server\ntarget_dir? ")
+            _received.append(_conn.recv(1024))
+
+    _thread = threading.Thread(target=_old_server)
+    _thread.start()
+    _client = bo.BoSocketClient({
+        "target_dir": "/tmp",
+        "server_host": "127.0.0.1",
+        "server_port": _listener.getsockname()[1],
+    })
+    with pytest.raises(SystemExit):
+        # old server closes connection after the first command
+        _client.run_command("", ["true"])
+    _thread.join()
+    _listener.close()
+    assert _received == [b"TARGET_DIR /tmp\n"]
+
+
+def test_protocol_1_and_2_share_target(bo_env):
+    """ files synced by protocol 1 are updated and deleted by protocol 2 and back """
+    bo_env.write("a.txt", "a")
+    bo_env.write("dir/b.txt", "b")
+    bo_env.configure({"protocol": 1})
+    assert "Sending cache" in bo_env.sync()
+    bo_env.assert_synced()
+    bo_env.configure()
+    bo_env.write("a.txt", "changed")
+    bo_env.write("c.txt", "c")
+    assert "Accepted: 2, failed: 0" in bo_env.sync()
+    bo_env.assert_synced()
+    bo_env.configure({"protocol": 1})
+    bo_env.write("dir/b.txt", "changed again")
+    bo_env.sync()
+    bo_env.assert_synced()
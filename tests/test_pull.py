@@ -0,0 +1,61 @@
+""" bo pull: build artifacts from server """
+
+import os
+
+
+def build(bo_env, _files):
+    """ files made on server side in target dir """
+    for _path, _content in _files.items():
+        _fullpath = os.path.join(bo_env.target_dir, _path)
+        os.makedirs(os.path.dirname(_fullpath), exist_ok=True)
+        with open(_fullpath, "w", encoding="utf-8") as _file:
+            _file.write(_content)
+
+
+def pulled(bo_env):
+    """ files of workdir """
+    _files = []
+    for _dirpath, _, _filenames in os.walk(bo_env.workdir):
+        for _name in _filenames:
+            _files.append(os.path.relpath(os.path.join(_dirpath, _name), bo_env.workdir))
+    return sorted(_files)
+
+
+def test_patterns(bo_env):
+    """ glob does not cross directories, ** does, directory means all files in it """
+    build(bo_env, {
+        "out/a.o": "a",
+        "out/sub/b.o": "b",
+        "out/c.txt": "c",
+        "lib/deep/x.so": "x",
+        "log.txt": "log",
+    })
+    assert "Found: 1, to download: 1" in bo_env.bo("pull", "out/*.o").stdout
+    assert pulled(bo_env) == [os.path.join("out", "a.o")]
+    assert "Found: 2, to download: 1" in bo_env.bo("pull", "out/**/*.o").stdout
+    assert "Found: 1, to download: 1" in bo_env.bo("pull", "lib").stdout
+    assert pulled(bo_env) == [
+        os.path.join("lib", "deep", "x.so"), os.path.join("out", "a.o"),
+        os.path.join("out", "sub", "b.o"),
+    ]
+    with open(os.path.join(bo_env.workdir, "out", "sub", "b.o"), encoding="utf-8") as _file:
+        assert _file.read() == "b"
+
+
+def test_unchanged_files_are_skipped(bo_env):
+    """ only artifacts changed on server are downloaded again """
+    bo_env.configure(artifacts=["out"])
+    build(bo_env, {"out/a.o": "a", "out/b.o": "b"})
+    assert "Found: 2, to download: 2" in bo_env.bo("pull").stdout
+    assert "Found: 2, to download: 0" in bo_env.bo("pull").stdout
+    build(bo_env, {"out/b.o": "rebuilt"})
+    _output = bo_env.bo("pull").stdout
+    assert "Found: 2, to download: 1" in _output
+    assert "Downloaded: 1, failed: 0" in _output
+    with open(os.path.join(bo_env.workdir, "out", "b.o"), encoding="utf-8") as _file:
+        assert _file.read() == "rebuilt"
+    # local copy is changed, so it differs from server
+    bo_env.write("out/a.o", "local")
+    assert "Found: 2, to download: 1" in bo_env.bo("pull").stdout
+    with open(os.path.join(bo_env.workdir, "out", "a.o"), encoding="utf-8") as _file:
+        assert _file.read() == "a"
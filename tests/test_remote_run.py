@@ -0,0 +1,111 @@
+""" remote commands and their output """
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest  # pylint: disable=import-error
+
+from conftest import BO_PY, wait_for  # pylint: disable=import-error
+import bo  # pylint: disable=import-error
+
+
+def test_output_and_exit_status(bo_env):
+    """ output is pushed to client, exit status of command is returned """
+    _proc = bo_env.run("echo hello; exit 3")
+    assert "hello" in _proc.stdout
+    assert ">>>> Exit status: 3" in _proc.stdout
+    assert _proc.returncode == 3
+
+
+def is_alive(_pid):
+    """ process exists and is not zombie """
+    try:
+        with open("/proc/" + str(_pid) + "/stat", encoding="utf-8") as _file:
+            return _file.read().split(") ")[1][0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="uses /proc")
+def test_disconnect_kills_children(bo_env):
+    """ children of command are killed when client is disconnected """
+    _pidfile = os.path.join(bo_env.root, "child.pid")
+    _client = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, BO_PY, "remote", "--no-agent", "run",
+         "sleep 60 & echo $! > " + _pidfile + "; while true; do echo tick; sleep 0.1; done"],
+        cwd=bo_env.workdir, env=dict(os.environ, HOME=bo_env.home),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for(lambda: os.path.exists(_pidfile) and os.path.getsize(_pidfile) > 0)
+        with open(_pidfile, encoding="utf-8") as _file:
+            _child = int(_file.read())
+        assert is_alive(_child)
+    finally:
+        _client.send_signal(signal.SIGKILL)
+        _client.wait()
+    wait_for(lambda: not is_alive(_child))
+    time.sleep(0.1)
+    assert not is_alive(_child)
+
+
+def serve_command(_frames):
+    """ server of protocol 2 which answers command by frames, return (port, thread) """
+    _listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    _listener.bind(("127.0.0.1", 0))
+    _listener.listen(1)
+
+    def _serve():
+        _sock, _ = _listener.accept()
+        _listener.close()
+        with _sock:
+            _sock.sendall(b"Welcome to bo server\nprotocols: 1 2\ntarget_dir? ")
+            assert _sock.recv(1024) == b"PROTOCOL 2\n"
+            _sock.sendall(b"ACCEPTED 2")
+            _conn = bo.BoConnection(_sock)
+            _conn.set_version(2)
+            _command = ""
+            while not _command.startswith("RUN_COMMAND_STREAM "):
+                _command = _conn.recv_message()
+                _conn.send_message("ACCEPTED")
+            for _type, _payload in _frames:
+                _conn.send_frame(_type, _payload)
+            _sock.recv(1024)
+
+    _thread = threading.Thread(target=_serve)
+    _thread.start()
+    return _listener.getsockname()[1], _thread
+
+
+def run_on(_port):
+    """ run command by client of server on port """
+    return bo.BoSocketClient({
+        "target_dir": "/tmp",
+        "server_host": "127.0.0.1",
+        "server_port": _port,
+    }).run_command("", ["true"])
+
+
+def test_output_failed():
+    """ text frame OUTPUT_FAILED is failed command """
+    _port, _thread = serve_command([(bo.FRAME_TEXT, b"OUTPUT_FAILED no such dir")])
+    assert run_on(_port) == 1
+    _thread.join()
+
+
+@pytest.mark.parametrize("_frame", [
+    (bo.FRAME_DATA, b"OUTPUT_FAILED no such dir"),
+    (bo.FRAME_TEXT, b"SOMETHING else"),
+    (42, b""),
+])
+def test_unexpected_frame(_frame):
+    """ only output, exit and OUTPUT_FAILED text frames are expected """
+    _port, _thread = serve_command([_frame])
+    with pytest.raises(SystemExit):
+        run_on(_port)
+    _thread.join()
@@ -0,0 +1,86 @@
+""" cached results of remote commands (server option --result-cache) """
+
+import os
+import signal
+import subprocess
+import sys
+
+import pytest  # pylint: disable=import-error
+
+from conftest import BO_PY, wait_for  # pylint: disable=import-error
+
+CACHED = ">>>> Cached result of previous run"
+
+
+@pytest.fixture(name="cache_env")
+def fixture_cache_env(bo_env):
+    """ server with result cache """
+    bo_env.start_server("--result-cache")
+    return bo_env
+
+
+def test_hit_and_miss(cache_env):
+    """ the same command on the same files is replayed, changes of files run it again """
+    cache_env.write("a.txt", "one")
+    cache_env.sync()
+    _first = cache_env.run("cat a.txt")
+    assert "one" in _first.stdout and CACHED not in _first.stdout
+    _second = cache_env.run("cat a.txt")
+    assert "one" in _second.stdout and CACHED in _second.stdout
+    assert CACHED not in cache_env.bo("remote", "--no-agent", "--force-run", "run", "cat a.txt")\
+        .stdout
+    cache_env.write("a.txt", "two")
+    cache_env.sync()
+    _third = cache_env.run("cat a.txt")
+    assert "two" in _third.stdout and CACHED not in _third.stdout
+
+
+def test_exit_status_is_cached(cache_env):
+    """ failed command is replayed with its exit status """
+    cache_env.sync()
+    assert cache_env.run("exit 5").returncode == 5
+    _again = cache_env.run("exit 5")
+    assert CACHED in _again.stdout and _again.returncode == 5
+
+
+def test_pulled_artifacts_are_not_in_key(cache_env):
+    """ build outputs rewritten by command do not change key after pull """
+    cache_env.write("src.txt", "source")
+    cache_env.sync()
+    _build = "mkdir -p out && date +%s%N > out/build.txt"
+    assert CACHED not in cache_env.run(_build).stdout
+    assert "Downloaded: 1" in cache_env.bo("pull", "out").stdout
+    assert CACHED in cache_env.run(_build).stdout
+    assert CACHED in cache_env.run(_build).stdout
+
+
+def test_protocol_1_sync_changes_key(cache_env):
+    """ files synced by protocol 1 are part of key too """
+    cache_env.write("a.txt", "a")
+    cache_env.sync()
+    assert CACHED not in cache_env.run("cat *.txt").stdout
+    cache_env.write("b.txt", "b")
+    cache_env.configure({"protocol": 1})
+    cache_env.sync()
+    cache_env.configure()
+    _output = cache_env.run("cat *.txt").stdout
+    assert CACHED not in _output
+    assert "ab" in _output
+
+
+def test_disconnect_removes_spool(cache_env):
+    """ output of command broken by disconnect is not left in result cache dir """
+    cache_env.sync()
+    _results_dir = os.path.join(cache_env.server_home, ".bo-by-sea5kg", "server", "results")
+    _client = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, BO_PY, "remote", "--no-agent", "run",
+         "while true; do echo tick; sleep 0.1; done"],
+        cwd=cache_env.workdir, env=dict(os.environ, HOME=cache_env.home),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for(lambda: any(_name.endswith(".tmp") for _name in os.listdir(_results_dir)))
+    finally:
+        _client.send_signal(signal.SIGKILL)
+        _client.wait()
+    wait_for(lambda: not any(_name.endswith(".tmp") for _name in os.listdir(_results_dir)))
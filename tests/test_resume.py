@@ -0,0 +1,44 @@
+""" continue of interrupted sync from partial file on the server """
+
+import hashlib
+import os
+
+import bo  # pylint: disable=import-error
+
+SIZE = bo.RESUME_MIN_SIZE + 1024 * 1024
+
+
+def write_partial(bo_env, _content, _size):
+    """ partial file like after dropped connection, return its path """
+    _path = os.path.join(
+        bo_env.target_dir, bo.PARTIAL_DIR, "md5-" + hashlib.md5(_content).hexdigest()
+    )
+    os.makedirs(os.path.dirname(_path))
+    with open(_path, "wb") as _file:
+        _file.write(_content[:_size])
+    return _path
+
+
+def test_resume_from_partial(bo_env):
+    """ big file continues from received part """
+    _content = os.urandom(SIZE)
+    bo_env.write("big.bin", _content)
+    write_partial(bo_env, _content, SIZE // 2)
+    _output = bo_env.sync()
+    assert "resumed: 1" in _output
+    assert "Accepted: 1, failed: 0" in _output
+    bo_env.assert_synced()
+
+
+def test_partial_of_other_connection(bo_env):
+    """ partial file locked by other connection is not resumed and not touched """
+    _content = os.urandom(SIZE)
+    bo_env.write("big.bin", _content)
+    _path = write_partial(bo_env, _content, SIZE // 2)
+    with open(_path, "rb") as _locked:
+        assert bo.lock_file(_locked)
+        _output = bo_env.sync()
+        assert "resumed: 0" in _output
+        assert "Accepted: 1, failed: 0" in _output
+        assert bo_env.target("big.bin") == _content
+        assert os.path.getsize(_path) == SIZE // 2
@@ -0,0 +1,86 @@
+""" configured command stacks: fail fast and keep going """
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest  # pylint: disable=import-error
+
+from conftest import BO_PY, wait_for  # pylint: disable=import-error
+
+STEPS = [
+    {"name": "fail", "run": "exit 3"},
+    {"name": "slow", "run": "sleep 2; echo slow done"},
+    {"name": "after", "run": "echo after slow", "needs": "slow"},
+]
+
+
+@pytest.fixture(name="stack_env")
+def fixture_stack_env(bo_env):
+    """ server with workdir which has command 'check' """
+    bo_env.configure(commands={"check": STEPS})
+    return bo_env
+
+
+def test_fail_fast(stack_env):
+    """ the first failed step stops running steps and the rest is skipped """
+    _proc = stack_env.bo("check", _check=False)
+    assert _proc.returncode == 3
+    assert ">>>> [fail] Exit status: 3" in _proc.stdout
+    assert "slow done" not in _proc.stdout
+    assert ">>>> [after] Skipped" in _proc.stdout
+    assert ">>>> Exit status: 3" in _proc.stdout
+
+
+def test_keep_going(stack_env):
+    """ steps which do not need the failed one are finished, status is of failed step """
+    _proc = stack_env.bo("check", "--keep-going", _check=False)
+    assert _proc.returncode == 3
+    assert ">>>> [fail] Exit status: 3" in _proc.stdout
+    assert "[slow] slow done" in _proc.stdout
+    assert ">>>> [slow] Exit status: 0" in _proc.stdout
+    assert "[after] after slow" in _proc.stdout
+    assert ">>>> [after] Exit status: 0" in _proc.stdout
+    assert ">>>> Exit status: 3" in _proc.stdout
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="uses /proc")
+def test_step_ignoring_sigterm_is_killed(bo_env):
+    """ cancelled step which ignores SIGTERM is killed and waited for """
+    _pidfile = os.path.join(bo_env.root, "step.pid")
+    bo_env.configure(commands={"check": [
+        {"name": "fail", "run": "sleep 0.5; exit 3"},
+        {"name": "stubborn", "run": "trap '' TERM; echo $$ > " + _pidfile + "; sleep 60"},
+    ]})
+    _start = time.monotonic()
+    _proc = bo_env.bo("check", _check=False)
+    assert _proc.returncode == 3
+    assert time.monotonic() - _start < 30
+    with open(_pidfile, encoding="utf-8") as _file:
+        assert not os.path.exists("/proc/" + _file.read().strip())
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="uses /proc")
+def test_disconnect_stops_steps(bo_env):
+    """ steps are stopped and waited for when client is disconnected """
+    _pidfile = os.path.join(bo_env.root, "step.pid")
+    bo_env.configure(commands={"check": [
+        {"name": "ticks", "run": "trap '' TERM; echo $$ > " + _pidfile +
+                                 "; while true; do echo tick; sleep 0.1; done"},
+    ]})
+    _client = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, BO_PY, "check"], cwd=bo_env.workdir,
+        env=dict(os.environ, HOME=bo_env.home),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for(lambda: os.path.exists(_pidfile) and os.path.getsize(_pidfile) > 0)
+    finally:
+        _client.send_signal(signal.SIGKILL)
+        _client.wait()
+    with open(_pidfile, encoding="utf-8") as _file:
+        _pid = _file.read().strip()
+    # not left running and not left as zombie
+    wait_for(lambda: not os.path.exists("/proc/" + _pid), 30)
@@ -0,0 +1,36 @@
+""" batch sync over several connections """
+
+import collections
+import os
+
+import bo  # pylint: disable=import-error
+
+
+def test_sync_by_streams(bo_env):
+    """ files are shared by streams and all of them land """
+    bo_env.configure(streams=3)
+    for _index in range(6):
+        bo_env.write("big/" + str(_index) + ".bin", os.urandom(200 * 1024))
+    for _index in range(50):
+        bo_env.write("small/" + str(_index) + ".txt", "file " + str(_index))
+    _output = bo_env.sync()
+    assert "Accepted: 56, failed: 0" in _output
+    assert "stream failed" not in _output
+    bo_env.assert_synced()
+
+
+def test_late_stream_is_noop(bo_env, capsys):
+    """ stream which joins finished session closes quietly """
+    _stream = bo.BoSocketClient({
+        "workdir": bo_env.workdir,
+        "target_dir": bo_env.target_dir,
+        "server_host": "127.0.0.1",
+        "server_port": bo_env.port,
+    })
+    _stream.join_sync(
+        "finished-session", collections.deque(), None, {}, {}, bo.BoCompressionPolicy("none")
+    )
+    assert _stream.get_results() == {"accepted": [], "failed": {}}
+    _output = capsys.readouterr().out
+    assert "failed" not in _output
+    assert "ERROR" not in _output
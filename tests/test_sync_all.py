@@ -0,0 +1,53 @@
+""" bo sync --all: one scan pushed to several servers """
+
+import os
+
+from conftest import BoEnv  # pylint: disable=import-error
+import bo  # pylint: disable=import-error
+
+
+def server_cfg(_env, _name):
+    """ config of server of env with own target dir and cache """
+    return {
+        "host": "127.0.0.1",
+        "port": _env.port,
+        "target_dir": os.path.join(_env.root, "target-" + _name),
+        "cache_path": os.path.join(_env.root, "cache-" + _name + ".yml"),
+    }
+
+
+def to_update(_env, _name):
+    """ files which are not synced to server by its cache """
+    return sorted(bo.BoFilesCache(server_cfg(_env, _name)["cache_path"]).get_files_to_update())
+
+
+def test_one_server_is_down(bo_env):
+    """ other servers are synced, cache of failed server keeps its files for next sync """
+    _down = BoEnv(os.path.join(bo_env.root, "down"))
+    bo_env.configure(_servers={
+        "second": server_cfg(bo_env, "second"),
+        "down": server_cfg(_down, "down"),
+    })
+    bo_env.write("a.txt", "a")
+    bo_env.write("dir/b.txt", "b")
+    _proc = bo_env.bo("sync", "--no-agent", "--all", _check=False)
+    assert _proc.returncode != 0
+    assert "Sync failed for servers: down" in _proc.stdout
+    assert bo_env.target("dir/b.txt") == b"b"
+    assert to_update(bo_env, "second") == []
+    assert to_update(_down, "down") == ["a.txt", os.path.join("dir", "b.txt")]
+
+    _down.start_server()
+    try:
+        bo_env.write("a.txt", "changed")
+        _output = bo_env.bo("sync", "--no-agent", "--all").stdout
+        assert "Server 'down': done" in _output
+        assert to_update(bo_env, "second") == []
+        assert to_update(_down, "down") == []
+        for _target in (bo_env.target_dir, server_cfg(bo_env, "second")["target_dir"],
+                        server_cfg(_down, "down")["target_dir"]):
+            with open(os.path.join(_target, "a.txt"), encoding="utf-8") as _file:
+                assert _file.read() == "changed"
+            assert os.path.isfile(os.path.join(_target, "dir", "b.txt"))
+    finally:
+        _down.stop_server()
@@ -0,0 +1,35 @@
+""" batch sync: delta of modified files and files created from server content """
+
+import os
+import re
+
+
+def test_delta_of_modified_file(bo_env):
+    """ only changed part of big file is sent """
+    bo_env.configure(delta_min_size=64 * 1024)
+    _content = bytearray(os.urandom(1024 * 1024))
+    bo_env.write("big.bin", bytes(_content))
+    bo_env.sync()
+    _content[500000:500010] = b"0123456789"
+    bo_env.write("big.bin", bytes(_content))
+    _output = bo_env.bo("sync", "--no-agent", "--verbose").stdout
+    _sent = re.search(r"Delta: sent (\d+) of (\d+) bytes", _output)
+    assert _sent is not None, _output
+    assert int(_sent.group(1)) < int(_sent.group(2)) // 10
+    assert "Accepted: 1, failed: 0" in _output
+    bo_env.assert_synced()
+
+
+def test_rename_and_copy(bo_env):
+    """ moved and copied files are created from content which is already on server """
+    _content = os.urandom(100 * 1024)
+    bo_env.write("old/a.bin", _content)
+    bo_env.write("b.txt", "small file")
+    bo_env.sync()
+    os.rename(os.path.join(bo_env.workdir, "old", "a.bin"),
+              os.path.join(bo_env.workdir, "new.bin"))
+    bo_env.write("copy/b.txt", "small file")
+    _output = bo_env.sync()
+    assert "Deleted: 1, created from server content: 2, to send: 0" in _output
+    bo_env.assert_synced()
+    assert bo_env.target("new.bin") == _content
@@ -0,0 +1,61 @@
+""" watcher of workdir for 'bo sync --watch' """
+
+import os
+import sys
+
+import pytest  # pylint: disable=import-error
+
+import bo  # pylint: disable=import-error
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is linux only")
+def test_overflow_rescans_active_directories(tmp_path):
+    """ after overflow of inotify queue only directories with events are rescanned """
+    for _dir in ("idle", "busy"):
+        os.makedirs(os.path.join(str(tmp_path), _dir))
+    _watcher = bo.BoInotifyWatcher(str(tmp_path))
+    try:
+        with open("/proc/sys/fs/inotify/max_queued_events", encoding="utf-8") as _file:
+            _max_events = int(_file.read())
+        for _index in range(_max_events + 100):
+            with open(os.path.join(str(tmp_path), "busy", str(_index)), "w", encoding="utf-8"):
+                pass
+        _files, _dirs = _watcher.poll_changes()
+        assert _dirs == {"busy"}
+        assert _files
+    finally:
+        _watcher.close()
+
+
+def test_rescan_reads_ignore_files_once(tmp_path, monkeypatch):
+    """ burst of changes in deep directory does not read ignore files of parents again """
+    _workdir = str(tmp_path / "workdir")
+    _deep = os.path.join("a", "b", "c", "d")
+    os.makedirs(os.path.join(_workdir, _deep))
+    with open(os.path.join(_workdir, ".gitignore"), "w", encoding="utf-8") as _file:
+        _file.write("*.o\n")
+    _changed = set()
+    for _index in range(100):
+        _changed.add(os.path.join(_deep, str(_index) + ".c"))
+        _changed.add(os.path.join(_deep, str(_index) + ".o"))
+    for _path in _changed:
+        with open(os.path.join(_workdir, _path), "w", encoding="utf-8") as _file:
+            _file.write(_path)
+    _loaded = []
+    _load = bo.load_ignore_matcher
+
+    def _count_load(_dirpath, *_args):
+        _loaded.append(_dirpath)
+        return _load(_dirpath, *_args)
+    monkeypatch.setattr(bo, "load_ignore_matcher", _count_load)
+    _files = bo.BoFilesCache(str(tmp_path / "cache.yml"))
+    assert _files.rescan_paths(_workdir, _changed, set()) == 100
+    assert len(_loaded) == 5
+    assert _files.rescan_paths(_workdir, _changed, set()) == 0
+    assert len(_loaded) == 5
+    # changed ignore file is read again, files which become ignored are forgotten
+    with open(os.path.join(_workdir, ".gitignore"), "w", encoding="utf-8") as _file:
+        _file.write("*.o\n*.c\n")
+    _files.rescan_paths(_workdir, {".gitignore"} | _changed, set())
+    assert len(_loaded) == 10
+    assert sorted(_files.get_files()) == [".gitignore"]
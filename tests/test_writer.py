@@ -0,0 +1,69 @@
+""" writing of received files on the server """
+
+import os
+
+import bo  # pylint: disable=import-error
+
+
+def test_files_are_flushed_without_global_sync(tmp_path, monkeypatch):
+    """ files are fsynced and renamed into place, os.sync() of whole host is not used """
+    _synced = []
+    monkeypatch.setattr(os, "sync", lambda: _synced.append(True), raising=False)
+    _results = []
+    _writer = bo.BoFileWriter(_results.extend)
+    _path = os.path.join(str(tmp_path), "small.txt")
+    _writer.write_files([("small.txt", {}, _path, b"small")])
+    _big = os.path.join(str(tmp_path), "big.bin")
+    _tmp = _big + ".part"
+    with open(_tmp, "wb") as _fd:
+        _stream = _writer.open_stream("big.bin", {}, _fd, _tmp, _big)
+        _stream.write(b"big")
+        _stream.finish("commit")
+        _writer.sync()
+    _writer.close()
+    assert sorted(_results) == [("big.bin", {}, None), ("small.txt", {}, None)]
+    assert sorted(os.listdir(str(tmp_path))) == ["big.bin", "small.txt"]
+    assert not _synced
+
+
+def test_discarded_stream_is_removed(tmp_path):
+    """ file with wrong hash does not land """
+    _results = []
+    _writer = bo.BoFileWriter(_results.extend)
+    _big = os.path.join(str(tmp_path), "big.bin")
+    with open(_big + ".part", "wb") as _fd:
+        _stream = _writer.open_stream("big.bin", {}, _fd, _big + ".part", _big)
+        _stream.write(b"broken")
+        _stream.finish("discard")
+        _writer.close()
+    assert not _results
+    assert not os.listdir(str(tmp_path))
+
+
+def test_files_land_at_sync(tmp_path, monkeypatch):
+    """ written files wait in temporary files and are flushed and renamed by sync() """
+    _fsynced = []
+    _fsync = os.fsync
+
+    def _count_fsync(_fd):
+        _fsynced.append(_fd)
+        _fsync(_fd)
+    monkeypatch.setattr(os, "fsync", _count_fsync)
+    _results = []
+    _writer = bo.BoFileWriter(_results.extend)
+    _files = [
+        (str(_index), {}, os.path.join(str(tmp_path), str(_index)), b"content")
+        for _index in range(20)
+    ]
+    _writer.write_files(_files[:10])
+    _writer.write_files(_files[10:])
+    _writer.wait()
+    assert not _results
+    assert not _fsynced
+    assert all(".bo-tmp-" in _name for _name in os.listdir(str(tmp_path)))
+    _writer.sync()
+    # every file and their directory
+    assert len(_fsynced) == 21
+    assert sorted(_results) == sorted((_file, {}, None) for _file, _, _, _ in _files)
+    assert sorted(os.listdir(str(tmp_path))) == sorted(_file for _file, _, _, _ in _files)
+    _writer.close()